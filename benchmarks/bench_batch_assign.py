@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+"""
+批量分流基准测试，比较逐个用户调用本地分流与 NumPy 向量化 batch_assign 每秒处理的用户数，需要安装 numpy
+
+运行方式::
+
+    python benchmarks/bench_batch_assign.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy
+import sensorsanalytics
+from sensorsabtesting.abtest import SensorsABTest
+
+EXPERIMENTS = 20
+LOOP_USERS = 100000
+BATCH_USERS = (100000, 1000000)
+
+
+class _NullConsumer:
+    def send(self, msg):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def build_config():
+    return {
+        "status": "SUCCESS",
+        "experiments": [
+            {
+                "abtest_experiment_id": str(i),
+                "traffic": 50,
+                "groups": [
+                    {
+                        "abtest_experiment_group_id": str(g),
+                        "is_control_group": g == 0,
+                        "weight": 1,
+                        "variables": [
+                            {"name": "int_%d" % i, "type": "INTEGER", "value": str(g)}
+                        ],
+                    }
+                    for g in range(3)
+                ],
+            }
+            for i in range(EXPERIMENTS)
+        ],
+    }
+
+
+def bench_loop(evaluator, distinct_ids, param_name):
+    start = time.perf_counter()
+    for distinct_id in distinct_ids:
+        index = evaluator.evaluate(distinct_id, {}, (param_name,))
+        index.find(param_name, 0)
+    return len(distinct_ids) / (time.perf_counter() - start)
+
+
+def bench_batch(ab, distinct_ids, param_name):
+    start = time.perf_counter()
+    ab.batch_assign(distinct_ids, {param_name: 0})
+    return len(distinct_ids) / (time.perf_counter() - start)
+
+
+def main():
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(build_config(), f)
+    ab = SensorsABTest(
+        "http://127.0.0.1:9/api/v2/abtest/online/results",
+        sensorsanalytics.SensorsAnalytics(_NullConsumer()),
+        local_evaluation_config=path,
+    )
+    print("%10s %12s %16s" % ("mode", "users", "users/second"))
+    distinct_ids = ["user%d" % i for i in range(LOOP_USERS)]
+    print("%10s %12d %16.0f" % ("loop", LOOP_USERS, bench_loop(ab._local_evaluator, distinct_ids, "int_0")))
+    for users in BATCH_USERS:
+        distinct_ids = numpy.char.add("user", numpy.arange(users).astype("U"))
+        print("%10s %12d %16.0f" % ("batch", users, bench_batch(ab, distinct_ids, "int_0")))
+    ab.close()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
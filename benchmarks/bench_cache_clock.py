@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+缓存时钟基准测试，比较 datetime.now、time.monotonic 与 CoarseClock 的读取耗时，
+以及试验缓存命中、事件缓存查询使用不同时钟的单次耗时
+
+运行方式::
+
+    python benchmarks/bench_cache_clock.py
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensorsabtesting.cache.clock import CoarseClock
+from sensorsabtesting.cache.hashed import HashedTTLSet
+from sensorsabtesting.cache.sharded import ShardedTTLCache
+
+OPS = 500000
+ENTRIES = 10000
+
+
+def per_op(func, ops=OPS):
+    start = time.perf_counter()
+    for _ in range(ops):
+        func()
+    return (time.perf_counter() - start) / ops * 1e9
+
+
+def bench_cache_hit(timer, ttl):
+    cache = ShardedTTLCache(ENTRIES, ttl=ttl, timer=timer, shardkey=itemgetter(0))
+    keys = [("user_%d" % i, True, ()) for i in range(ENTRIES)]
+    for key in keys:
+        cache[key] = 0
+    keys = keys * (OPS // ENTRIES)
+    get = cache.get
+    start = time.perf_counter()
+    for key in keys:
+        get(key)
+    return (time.perf_counter() - start) / len(keys) * 1e9
+
+
+def bench_event_lookup(timer):
+    cache = HashedTTLSet(ENTRIES, 3600, timer=timer)
+    for i in range(1, ENTRIES + 1):
+        cache.add(i)
+    keys = list(range(1, ENTRIES + 1)) * (OPS // ENTRIES)
+    start = time.perf_counter()
+    for key in keys:
+        key in cache
+    return (time.perf_counter() - start) / len(keys) * 1e9
+
+
+def main():
+    clock = CoarseClock(0.05)
+    try:
+        print("%24s %10s %14s %14s" % ("clock", "read ns", "hit ns/op", "event ns/op"))
+        print(
+            "%24s %10.0f %14.0f %14s"
+            % ("datetime.now", per_op(datetime.now), bench_cache_hit(datetime.now, timedelta(hours=1)), "-")
+        )
+        print(
+            "%24s %10.0f %14.0f %14.0f"
+            % (
+                "time.monotonic",
+                per_op(time.monotonic),
+                bench_cache_hit(time.monotonic, 3600),
+                bench_event_lookup(time.monotonic),
+            )
+        )
+        print(
+            "%24s %10.0f %14.0f %14.0f"
+            % (
+                "CoarseClock(0.05)",
+                per_op(clock.timer),
+                bench_cache_hit(clock.timer, 3600),
+                bench_event_lookup(clock.timer),
+            )
+        )
+    finally:
+        clock.stop()
+
+
+if __name__ == "__main__":
+    main()
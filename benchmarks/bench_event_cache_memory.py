@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+事件去重缓存内存基准测试，比较 TTLCache（完整 key）与 HashedTTLSet（64 位哈希）每条记录占用的内存
+
+运行方式::
+
+    python benchmarks/bench_event_cache_memory.py [条数 ...]
+
+默认测试 1000000 与 10000000 条，TTLCache 超过 1000000 条时跳过。
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensorsabtesting.cache.hashed import HashedTTLSet, key_hash
+from sensorsabtesting.cache.sharded import ShardedTTLCache
+
+SIZES = (1000000, 10000000)
+TTL_CACHE_LIMIT = 1000000
+
+
+def event_keys(size):
+    for i in range(size):
+        yield "user_%d" % i, True, str(1000 + i % 50), "{}"
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    cache = build()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cache, current, elapsed
+
+
+def build_ttl_cache(size):
+    cache = ShardedTTLCache(size, ttl=3600, timer=time.monotonic)
+    for key in event_keys(size):
+        cache[key] = ""
+    return cache
+
+
+def build_hashed_set(size):
+    cache = HashedTTLSet(size, 3600)
+    for key in event_keys(size):
+        cache.add(key_hash(*key))
+    return cache
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print("%10s %14s %14s %10s" % ("entries", "store", "bytes/entry", "build s"))
+    for size in sizes:
+        builders = [("HashedTTLSet", build_hashed_set)]
+        if size <= TTL_CACHE_LIMIT:
+            builders.insert(0, ("TTLCache", build_ttl_cache))
+        for name, build in builders:
+            cache, used, elapsed = measure(lambda: build(size))
+            print("%10d %14s %14.1f %10.1f" % (size, name, used / size, elapsed))
+            del cache
+
+
+if __name__ == "__main__":
+    main()
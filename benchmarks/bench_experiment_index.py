@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+"""
+试验缓存命中基准测试，比较逐个遍历 AB 返回结果与按参数名索引的耗时
+
+运行方式::
+
+    python benchmarks/bench_experiment_index.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensorsabtesting.abtest import ExperimentIndex
+
+EXPERIMENTS = (10, 50, 200)
+LOOKUPS = 20000
+
+
+def build_response(experiments):
+    return {
+        "status": "SUCCESS",
+        "results": [
+            {
+                "abtest_experiment_id": str(i),
+                "abtest_experiment_group_id": "1",
+                "is_control_group": False,
+                "is_white_list": False,
+                "variables": [
+                    {"name": "int_%d" % i, "type": "INTEGER", "value": str(i)},
+                    {"name": "str_%d" % i, "type": "STRING", "value": "v%d" % i},
+                ],
+            }
+            for i in range(experiments)
+        ],
+    }
+
+
+def scan(response, param_name, default_value):
+    """逐个遍历返回结果，与建立索引前的查找方式一致"""
+    found = False
+    for value in response["results"]:
+        for variable in value["variables"]:
+            if variable["name"] == param_name:
+                found = True
+    if not found:
+        return None
+    for value in response["results"]:
+        for variable in value["variables"]:
+            if variable["name"] == param_name and isinstance(default_value, int):
+                return int(variable["value"]), value["abtest_experiment_id"]
+    return None
+
+
+def bench_scan(response, names):
+    start = time.perf_counter()
+    for name in names:
+        scan(response, name, 0)
+    return (time.perf_counter() - start) / len(names) * 1e9
+
+
+def bench_index(response, names):
+    index = ExperimentIndex(response)
+    start = time.perf_counter()
+    for name in names:
+        if index.covers((name,)):
+            variable = index.find(name, 0)
+            variable.result(), variable.ab_experiment_id
+    return (time.perf_counter() - start) / len(names) * 1e9
+
+
+def main():
+    print("%12s %14s %14s" % ("experiments", "scan ns/op", "index ns/op"))
+    for experiments in EXPERIMENTS:
+        response = build_response(experiments)
+        names = ["int_%d" % (i % experiments) for i in range(LOOKUPS)]
+        print(
+            "%12d %14.0f %14.0f"
+            % (experiments, bench_scan(response, names), bench_index(response, names))
+        )
+
+
+if __name__ == "__main__":
+    main()
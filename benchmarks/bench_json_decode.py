@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+"""
+AB 返回结果解析基准测试，50 个试验的返回结果，比较旧的 decode + object_hook + 二次遍历
+与直接解析 bytes（json / orjson / ujson）的耗时
+
+运行方式::
+
+    python benchmarks/bench_json_decode.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensorsabtesting.abtest import _SensorsABTestBase
+
+ROUNDS = 2000
+
+
+def build_payload(experiments=50):
+    return json.dumps(
+        {
+            "status": "SUCCESS",
+            "error_type": None,
+            "results": [
+                {
+                    "abtest_experiment_id": str(1000 + i),
+                    "abtest_experiment_group_id": str(i % 3),
+                    "abtest_experiment_version": "2",
+                    "abtest_unique_id": "uid_%d" % i,
+                    "is_control_group": i % 3 == 0,
+                    "is_white_list": False,
+                    "experiment_type": "CODE",
+                    "stickiness": "NOT_STICKY",
+                    "variables": [
+                        {"name": "int_%d" % i, "type": "INTEGER", "value": str(i)},
+                        {"name": "str_%d" % i, "type": "STRING", "value": "value_%d" % i},
+                        {"name": "json_%d" % i, "type": "JSON",
+                         "value": json.dumps({"color": "red", "size": i})},
+                    ],
+                }
+                for i in range(experiments)
+            ],
+        }
+    ).encode("utf-8")
+
+
+def _byteify(data, ignore_dicts=False):
+    if isinstance(data, str):
+        return data
+    if isinstance(data, list):
+        return [_byteify(item, ignore_dicts=True) for item in data]
+    if isinstance(data, dict) and not ignore_dicts:
+        return {
+            _byteify(key, ignore_dicts=True): _byteify(value, ignore_dicts=True)
+            for key, value in data.items()
+        }
+    return data
+
+
+def legacy_loads(data):
+    """修改前的解析方式"""
+    return _byteify(json.loads(data.decode("utf-8"), object_hook=_byteify), ignore_dicts=True)
+
+
+def bench(loads, data, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        loads(data)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    data = build_payload()
+    decoders = [("legacy", legacy_loads), ("json", json.loads)]
+    for name in ("orjson", "ujson"):
+        try:
+            decoders.append((name, __import__(name).loads))
+        except ImportError:
+            pass
+    print("payload %d bytes" % len(data))
+    print("%10s %14s" % ("decoder", "decode us/op"))
+    for name, loads in decoders:
+        print("%10s %14.1f" % (name, bench(loads, data)))
+    print(
+        "%10s %14.1f"
+        % ("parse", bench(lambda d: _SensorsABTestBase._parse_response(200, d), data))
+    )
+
+
+if __name__ == "__main__":
+    main()
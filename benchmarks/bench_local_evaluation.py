@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+"""
+本地分流基准测试，统计不同试验数量下单个用户分流与 fetch_ab_tests 的耗时，不发起网络请求
+
+运行方式::
+
+    python benchmarks/bench_local_evaluation.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sensorsanalytics
+from sensorsabtesting.abtest import SensorsABTest
+
+EXPERIMENTS = (10, 50, 200)
+USERS = 20000
+
+
+class _NullConsumer:
+    def send(self, msg):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def build_config(experiments):
+    return {
+        "status": "SUCCESS",
+        "experiments": [
+            {
+                "abtest_experiment_id": str(i),
+                "traffic": 50,
+                "groups": [
+                    {
+                        "abtest_experiment_group_id": str(g),
+                        "is_control_group": g == 0,
+                        "weight": 1,
+                        "variables": [
+                            {"name": "int_%d" % i, "type": "INTEGER", "value": str(g)}
+                        ],
+                    }
+                    for g in range(3)
+                ],
+            }
+            for i in range(experiments)
+        ],
+    }
+
+
+def bench_evaluate(evaluator, experiments):
+    start = time.perf_counter()
+    for i in range(USERS):
+        evaluator.evaluate("user%d" % i, {}, ("int_%d" % (i % experiments),))
+    return (time.perf_counter() - start) / USERS * 1e6
+
+
+def bench_fetch(ab, experiments):
+    start = time.perf_counter()
+    for i in range(USERS):
+        ab.fetch_ab_tests(
+            "user%d" % i, True, {"int_%d" % (i % experiments): 0}, False
+        )
+    return (time.perf_counter() - start) / USERS * 1e6
+
+
+def main():
+    print("%12s %16s %16s" % ("experiments", "evaluate us/op", "fetch us/op"))
+    for experiments in EXPERIMENTS:
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(build_config(experiments), f)
+        ab = SensorsABTest(
+            "http://127.0.0.1:9/api/v2/abtest/online/results",
+            sensorsanalytics.SensorsAnalytics(_NullConsumer()),
+            local_evaluation_config=path,
+        )
+        evaluator = ab._local_evaluator
+        print(
+            "%12d %16.2f %16.2f"
+            % (
+                experiments,
+                bench_evaluate(evaluator, experiments),
+                bench_fetch(ab, experiments),
+            )
+        )
+        ab.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
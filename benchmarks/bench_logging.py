@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+"""
+日志开销基准测试，比较关闭与开启日志时解析 AB 返回结果及缓存命中的耗时
+
+运行方式::
+
+    python benchmarks/bench_logging.py
+"""
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensorsabtesting.abtest import ExperimentCacheManager, _SensorsABTestBase, _configure_log
+
+LOOKUPS = 20000
+
+
+def build_response(experiments=50):
+    return {
+        "status": "SUCCESS",
+        "results": [
+            {
+                "abtest_experiment_id": str(i),
+                "abtest_experiment_group_id": "1",
+                "is_control_group": False,
+                "is_white_list": False,
+                "variables": [{"name": "int_%d" % i, "type": "INTEGER", "value": str(i)}],
+            }
+            for i in range(experiments)
+        ],
+    }
+
+
+def bench_parse(data, rounds=LOOKUPS // 10):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        _SensorsABTestBase._parse_response(200, data)
+    return (time.perf_counter() - start) / rounds * 1e9
+
+
+def bench_hit(manager, lookups=LOOKUPS):
+    start = time.perf_counter()
+    for i in range(lookups):
+        manager.lookup_experiment_results("user1", True, {}, ("int_%d" % (i % 50),))
+    return (time.perf_counter() - start) / lookups * 1e9
+
+
+def main():
+    response = build_response()
+    data = json.dumps(response).encode("utf-8")
+    manager = ExperimentCacheManager(1440, 16)
+    manager.load([(["user1", True, "{}"], response, 3600, 3600)])
+
+    print("%10s %14s %14s" % ("log", "parse ns/op", "hit ns/op"))
+    _configure_log(False)
+    print("%10s %14.0f %14.0f" % ("disabled", bench_parse(data), bench_hit(manager)))
+
+    _configure_log(True)
+    # 输出到内存，只衡量格式化与 logging 本身的开销
+    logging.getLogger("sensorsabtesting").handlers[0].setStream(io.StringIO())
+    print("%10s %14.0f %14.0f" % ("enabled", bench_parse(data), bench_hit(manager)))
+    _configure_log(False)
+
+
+if __name__ == "__main__":
+    main()
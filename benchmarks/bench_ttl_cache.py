@@ -0,0 +1,51 @@
+# -*- coding: UTF-8 -*-
+"""
+TTLCache 命中延迟基准测试，验证命中耗时不随缓存条数增长
+
+运行方式::
+
+    python benchmarks/bench_ttl_cache.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensorsabtesting.cache import TTLCache
+
+SIZES = (1000, 10000, 100000, 1000000)
+LOOKUPS = 200000
+
+
+def bench_hit(size, lookups=LOOKUPS):
+    cache = TTLCache(size, ttl=3600, timer=time.monotonic)
+    for i in range(size):
+        cache["user_%d" % i] = i
+    keys = ["user_%d" % random.randrange(size) for _ in range(lookups)]
+    start = time.perf_counter()
+    for key in keys:
+        cache[key]
+    return (time.perf_counter() - start) / lookups * 1e9
+
+
+def bench_set(size, lookups=LOOKUPS):
+    cache = TTLCache(size, ttl=3600, timer=time.monotonic)
+    for i in range(size):
+        cache["user_%d" % i] = i
+    keys = ["new_%d" % i for i in range(lookups)]
+    start = time.perf_counter()
+    for key in keys:
+        cache[key] = 0
+    return (time.perf_counter() - start) / lookups * 1e9
+
+
+def main():
+    print("%10s %14s %14s" % ("entries", "hit ns/op", "evict ns/op"))
+    for size in SIZES:
+        print("%10d %14.0f %14.0f" % (size, bench_hit(size), bench_set(size)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
 # -*- coding: UTF-8 -*-
 from .abtest import *
+from .async_abtest import *
@@ -1,20 +1,105 @@
 # -*- coding: UTF-8 -*-
 import json
+import logging
+import os
+import queue
 import re
-from datetime import datetime, timedelta
+import sys
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+from itertools import chain
+from json.encoder import encode_basestring_ascii
+from operator import itemgetter
 
 import urllib3
 from sensorsanalytics import SensorsAnalytics
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from sensorsabtesting.ab_const import *
-from sensorsabtesting.cache import TTLCache
+from sensorsabtesting.cache.bloom import RotatingBloomFilter
+from sensorsabtesting.cache.clock import CoarseClock
+from sensorsabtesting.cache.hashed import HashedTTLSet, key_hash
+from sensorsabtesting.cache.keys import _HashedTuple
+from sensorsabtesting.cache.sharded import ShardedTTLCache
+from sensorsabtesting.snapshot import load_snapshot, save_snapshot
 
 SDK_VERSION = "0.0.3"
 VERSION_KEY = "abtest_lib_version"
 PLATFORM = "platform"
 PYTHON = "Python"
 
-ab_enablg_log = False
+# 直接解析响应 bytes，安装了 orjson 或 ujson 时优先使用
+if orjson is not None:
+    _json_loads = orjson.loads
+elif ujson is not None:
+    _json_loads = ujson.loads
+else:
+    _json_loads = json.loads
+
+
+def _dumps_str(value):
+    """
+    与 json.dumps(value).encode("utf-8") 结果一致，字符串直接转义，不经过 JSONEncoder
+    """
+    if isinstance(value, str):
+        return encode_basestring_ascii(value).encode("ascii")
+    return json.dumps(value).encode("utf-8")
+
+
+def _custom_ids_key(custom_ids):
+    """
+    custom_ids 的规范形式，与 key 的顺序无关，可以作为缓存 key 并序列化为 JSON
+    """
+    if not custom_ids:
+        return ()
+    return tuple(sorted(custom_ids.items()))
+
+
+def _freeze_key(key):
+    """
+    将从快照或共享缓存读出的 key（JSON 数组）还原为缓存 key
+    """
+    return _HashedTuple(
+        tuple(_freeze_key(part) if isinstance(part, list) else part for part in key)
+    )
+
+
+_logger = logging.getLogger("sensorsabtesting")
+_log_handler = None
+
+
+def _configure_log(enable_log):
+    """
+    enable_log 为 True 时 sensorsabtesting logger 输出 DEBUG 日志到标准输出；
+    未开启时不修改 logger 配置，可通过 logging 自行配置
+    """
+    global _log_handler
+    if enable_log:
+        if _log_handler is None:
+            _log_handler = logging.StreamHandler(sys.stdout)
+            _log_handler.setFormatter(logging.Formatter("SA_AB:%(message)s"))
+            _logger.addHandler(_log_handler)
+        _logger.setLevel(logging.DEBUG)
+    elif _log_handler is not None:
+        _logger.removeHandler(_log_handler)
+        _log_handler = None
+        _logger.setLevel(logging.NOTSET)
 
 
 class SensorsABException(Exception):
@@ -37,7 +122,11 @@ class SensorsABIllegalArgumentsException(SensorsABException):
     pass
 
 
-class SensorsABTest:
+class _SensorsABTestBase:
+    """
+    同步与异步 SDK 共用的参数校验、缓存、结果解析与事件触发逻辑
+    """
+
     NAME_PATTERN = re.compile(
         r"^((?!^distinct_id$|^original_id$|^time$|^properties$|^id$|^first_id$|^second_id$|^users$|^events$|^event$|^user_id$|^date$|^datetime$|^device_id$|^user_group|^user_tag|^[0-9])[a-zA-Z0-9_]{0,99})$",
         re.I,
@@ -58,26 +147,36 @@ class SensorsABTest:
             experiment_cache_time=1440,
             enable_event_cache=True,
             enable_log=False,
+            cache_shards=16,
+            experiment_stale_time=0,
+            cache_snapshot_file=None,
+            cache_backend=None,
+            trigger_queue_size=0,
+            trigger_queue_policy="drop",
+            event_cache_error_rate=0,
+            cache_clock_resolution=0,
+            experiment_failure_cache_time=0,
+            circuit_breaker_threshold=0,
+            circuit_breaker_recovery_time=10,
+            circuit_breaker_callback=None,
     ):
-        """
-        初始化 SDK
-        :param base_url: AB 地址
-        :param sa: SA SDK 对象
-        :param event_cache_time:事件缓存时间，单位为分钟
-        :param event_cache_size: 事件缓存条数
-        :param experiment_cache_size: 试验缓存条数
-        :param experiment_cache_time: 试验缓存时间，单位为分钟
-        :param enable_event_cache: 是否自动触发 $ABTestTrigger 事件
-        :param enable_log: 开启日志
-        """
         if not base_url:
             raise SensorsABIllegalArgumentsException("base_url is Empty, init failed")
+        if isinstance(base_url, str):
+            base_url = [base_url]
+        elif not isinstance(base_url, (list, tuple)) or not all(
+                url and isinstance(url, str) for url in base_url
+        ):
+            raise SensorsABIllegalArgumentsException(
+                "base_url should be str or list of str, init failed"
+            )
         if not isinstance(sa, SensorsAnalytics):
             raise SensorsABIllegalArgumentsException(
                 "sa type is not SensorsAnalytics, init failed"
             )
 
-        self._base_url = base_url
+        self._base_url = base_url[0]
+        self._endpoints = EndpointSelector(base_url)
         self._sa = sa
         self._enable_event_cache = enable_event_cache
         if experiment_cache_size < 0:
@@ -96,103 +195,150 @@ class SensorsABTest:
             self._event_cache_size = 4096
         else:
             self._event_cache_size = int(event_cache_size)
-        global ab_enablg_log
-        ab_enablg_log = enable_log
+        if not isinstance(cache_shards, int) or cache_shards <= 0:
+            self._cache_shards = 16
+        else:
+            self._cache_shards = cache_shards
+        if not isinstance(experiment_stale_time, (int, float)) or experiment_stale_time < 0:
+            self._experiment_stale_time = 0
+        elif experiment_stale_time > 1440:
+            self._experiment_stale_time = 1440
+        else:
+            self._experiment_stale_time = experiment_stale_time
+        if not isinstance(trigger_queue_size, int) or trigger_queue_size < 0:
+            trigger_queue_size = 0
+        if trigger_queue_policy not in (TriggerQueue.DROP, TriggerQueue.BLOCK):
+            trigger_queue_policy = TriggerQueue.DROP
+        if (
+                not isinstance(event_cache_error_rate, (int, float))
+                or not 0 < event_cache_error_rate < 1
+        ):
+            event_cache_error_rate = 0
+        if (
+                not isinstance(experiment_failure_cache_time, (int, float))
+                or experiment_failure_cache_time < 0
+        ):
+            experiment_failure_cache_time = 0
+        elif experiment_failure_cache_time > 3600:
+            experiment_failure_cache_time = 3600
+        _configure_log(enable_log)
 
+        if (
+                isinstance(cache_clock_resolution, (int, float))
+                and 0 < cache_clock_resolution <= 60
+        ):
+            self._cache_clock = CoarseClock(cache_clock_resolution)
+            cache_timer = self._cache_clock.timer
+        else:
+            self._cache_clock = None
+            cache_timer = time.monotonic
         self._experiment_cache_manager = ExperimentCacheManager(
-            self._experiment_cache_time, self._experiment_cache_size
+            self._experiment_cache_time,
+            self._experiment_cache_size,
+            self._cache_shards,
+            self._experiment_stale_time,
+            timer=cache_timer,
+            backend=cache_backend,
+            failure_time=experiment_failure_cache_time,
         )
         self._event_cache = EventCacheManager(
-            self._event_cache_time, self._event_cache_size
+            self._event_cache_time,
+            self._event_cache_size,
+            self._cache_shards,
+            backend=cache_backend,
+            error_rate=event_cache_error_rate,
+            timer=cache_timer,
         )
         self._track_day = None
-        # Proxy Setting: https://urllib3.readthedocs.io/en/stable/reference/urllib3.poolmanager.html#urllib3.ProxyManager
-        self.http_manager = urllib3.PoolManager(retries=False)
+        if trigger_queue_size:
+            self._trigger_queue = TriggerQueue(
+                sa, trigger_queue_size, trigger_queue_policy, on_sent=self._on_trigger_sent
+            )
+        else:
+            self._trigger_queue = None
+        if isinstance(circuit_breaker_threshold, int) and circuit_breaker_threshold > 0:
+            if (
+                    not isinstance(circuit_breaker_recovery_time, (int, float))
+                    or circuit_breaker_recovery_time <= 0
+            ):
+                circuit_breaker_recovery_time = 10
+            self._circuit_breaker = CircuitBreaker(
+                circuit_breaker_threshold,
+                circuit_breaker_recovery_time,
+                circuit_breaker_callback,
+            )
+        else:
+            self._circuit_breaker = None
+        self._cache_snapshot_file = cache_snapshot_file
+        if cache_snapshot_file and os.path.exists(cache_snapshot_file):
+            try:
+                load_snapshot(
+                    cache_snapshot_file, self._experiment_cache_manager, self._event_cache
+                )
+            except Exception as e:
+                _logger.warning("load cache snapshot failed: %s", e)
 
-    def async_fetch_ab_test(
-            self,
-            distinct_id,
-            is_login_id,
-            param_name,
-            default_value,
-            enable_auto_track_event=True,
-            timeout_seconds=3.0,
-            custom_ids={},
-            properties={},
-    ):
+    def stats(self):
         """
-        立即从服务端请求，忽略内存缓存
-        :param distinct_id: 用户 ID
-        :param is_login_id: 是否为登录 ID
-        :param param_name: 试验变量名称
-        :param default_value: 未命中试验，返回默认值（支持数据类型：int｜bool｜str｜dict）
-        :param enable_auto_track_event: 是否 SDK 自动触发事件
-        :param timeout_seconds:网络请求超时等待事件，单位为秒，也可以是 urllib3.Timeout() 对象。
-        :param custom_ids:自定义主体
-        :param properties:自定义属性
-        :return: Experiment
-
-        对于 timeout_seconds 参数，默认是 3 秒。
-        客户若想精确控制 connect 和 read 超时，请使用 urllib3.Timeout()。
-        下面是使用示::
-            >>> urllib3.Timeout(connect=1.0)
-            >>> urllib3.Timeout(connect=1.0, read=2.0)
+        SDK 运行统计
+        :return: dict，singleflight_calls 为缓存未命中时实际发出的请求数，
+            singleflight_coalesced 为与进行中的相同请求合并、未单独发出的请求数；
+            开启事件队列时还包含 trigger_queue_depth 队列中待发送的事件数，
+            trigger_sent、trigger_dropped、trigger_failed 为已发送、队列满或关闭后丢弃、发送失败的事件数；
+            事件缓存使用 Bloom 过滤器时还包含 event_cache_fill_ratio 当前周期过滤器的填充率，
+            event_cache_error_rate 估计的误判率；
+            experiment_cache_hit、experiment_cache_negative_hit、experiment_cache_stale_hit、
+            experiment_cache_miss、experiment_cache_failure_hit 为试验缓存各类查询结果的次数，
+            含义见 ExperimentCacheManager.stats()，使用外部存储后端时还包含 experiment_cache_skipped、
+            event_cache_skipped 条目超过槽位大小未能写入缓存的次数；
+            开启熔断时还包含 circuit_state 熔断器状态，circuit_opened 打开次数，circuit_rejected 打开期间直接返回默认值的请求数；
+            配置多个 AB 服务地址时还包含 endpoints，见 EndpointSelector.stats()
         """
-        return self.__fetch_ab(
-            distinct_id,
-            is_login_id,
-            param_name,
-            default_value,
-            enable_auto_track_event,
-            timeout_seconds,
-            custom_ids,
-            False,
-            properties,
-        )
+        stats = {
+            "singleflight_calls": self._single_flight.calls,
+            "singleflight_coalesced": self._single_flight.coalesced,
+        }
+        if self._trigger_queue is not None:
+            stats["trigger_queue_depth"] = self._trigger_queue.depth()
+            stats["trigger_sent"] = self._trigger_queue.sent
+            stats["trigger_dropped"] = self._trigger_queue.dropped
+            stats["trigger_failed"] = self._trigger_queue.failed
+        filter_stats = self._event_cache.filter_stats()
+        if filter_stats is not None:
+            stats["event_cache_fill_ratio"], stats["event_cache_error_rate"] = filter_stats
+        for outcome, count in self._experiment_cache_manager.stats().items():
+            stats["experiment_cache_" + outcome] = count
+        event_skipped = self._event_cache.skipped()
+        if event_skipped is not None:
+            stats["event_cache_skipped"] = event_skipped
+        if len(self._endpoints) > 1:
+            stats["endpoints"] = self._endpoints.stats()
+        if self._circuit_breaker is not None:
+            stats["circuit_state"] = self._circuit_breaker.state
+            stats["circuit_opened"] = self._circuit_breaker.opened
+            stats["circuit_rejected"] = self._circuit_breaker.rejected
+        return stats
 
-    def fast_fetch_ab_test(
-            self,
-            distinct_id,
-            is_login_id,
-            param_name,
-            default_value,
-            enable_auto_track_event=True,
-            timeout_seconds=3.0,
-            custom_ids={},
-            properties={},
-    ):
-        """
-        优先从内存获取试验
-        :param distinct_id: 用户 ID
-        :param is_login_id: 是否为登录 ID
-        :param param_name: 试验变量名称
-        :param default_value: 未命中试验，返回默认值（支持数据类型：int｜bool｜str｜dict）
-        :param enable_auto_track_event: 是否 SDK 自动触发事件
-        :param timeout_seconds:网络请求超时等待事件，单位为秒。也可以是 urllib3.Timeout() 对象。
-        :param custom_ids:自定义主体
-        :param properties:自定义属性
-        :return: Experiment
+    def _save_cache_snapshot(self):
+        if self._cache_snapshot_file:
+            try:
+                save_snapshot(
+                    self._cache_snapshot_file,
+                    self._experiment_cache_manager,
+                    self._event_cache,
+                )
+            except Exception as e:
+                _logger.warning("save cache snapshot failed: %s", e)
 
-        对于 timeout_seconds 参数，默认是 3 秒。
-        客户若想精确控制 connect 和 read 超时，请使用 urllib3.Timeout()。
-        下面是使用示::
-            >>> urllib3.Timeout(connect=1.0)
-            >>> urllib3.Timeout(connect=1.0, read=2.0)
-        """
-        return self.__fetch_ab(
-            distinct_id,
-            is_login_id,
-            param_name,
-            default_value,
-            enable_auto_track_event,
-            timeout_seconds,
-            custom_ids,
-            True,
-            properties,
-        )
+    def _close_trigger_queue(self):
+        if self._trigger_queue is not None:
+            self._trigger_queue.close()
 
-    def close(self):
-        self.http_manager.clear()
+    def _close_caches(self):
+        self._experiment_cache_manager.close()
+        self._event_cache.close()
+        if self._cache_clock is not None:
+            self._cache_clock.stop()
 
     def track_ab_test_trigger(self, experiment, custom_ids=None, properties={}):
         """
@@ -203,12 +349,12 @@ class SensorsABTest:
         :return:
         """
         if not experiment or (not isinstance(experiment, Experiment)):
-            SensorsABTest.ab_log(
+            _SensorsABTestBase.ab_log(
                 "The track ABTest event experiment result is null or type is not Experiment."
             )
             return
         if experiment.is_white_list or (not experiment.ab_experiment_id):
-            SensorsABTest.ab_log(
+            _SensorsABTestBase.ab_log(
                 "The track ABTest event user not hit experiment or in the whiteList."
             )
             return
@@ -218,270 +364,242 @@ class SensorsABTest:
                 experiment.ab_experiment_id,
                 custom_ids,
         ):
-            SensorsABTest.ab_log("The event has been triggered.")
+            _SensorsABTestBase.ab_log("The event has been triggered.")
             return
         if not properties:
             properties = {}
         properties[EXPERIMENT_ID] = experiment.ab_experiment_id
         properties[EXPERIMENT_GROUP_ID] = experiment.ab_experiment_group_id
-        if self.__is_day_first():
+        if self._is_day_first():
             version = [AB_TEST_EVENT_LIB_VERSION + ":" + SDK_VERSION]
             properties[LIB_PLUGIN_VERSION] = version
-        self._sa.track(
-            experiment.distinct_id, EVENT_TYPE, properties, experiment.is_login_id
-        )
-        if self._enable_event_cache:
-            self._event_cache.set_cache(
-                experiment.distinct_id,
-                experiment.is_login_id,
-                experiment.ab_experiment_id,
-                custom_ids,
-            )
+        self._send_trigger(experiment, custom_ids, properties)
 
-    def __fetch_ab(
-            self,
-            distinct_id,
-            is_login_id,
-            param_name,
-            default_value,
-            enable_auto_track_event=True,
-            timeout_seconds=3.0,
-            custom_ids={},
-            enable_cache=False,
-            properties={},
-    ):
+    def _prepare_fetch(self, distinct_id, is_login_id, param_defaults, custom_ids):
+        """
+        校验请求参数
+        :return: (results, valid_defaults)，results 为直接返回默认值的试验变量，
+            valid_defaults 为需要查询缓存或服务端的试验变量
+        """
         if not distinct_id or not isinstance(distinct_id, str):
             raise SensorsABIllegalArgumentsException("distinct_id is empty or not str")
-        if not param_name or not isinstance(param_name, str):
-            raise SensorsABIllegalArgumentsException("param_name is empty or not str")
+        if not param_defaults or not isinstance(param_defaults, dict):
+            raise SensorsABIllegalArgumentsException(
+                "param_defaults is empty or not dict"
+            )
+        results = {}
+        valid_defaults = {}
+        for param_name, default_value in param_defaults.items():
+            if not param_name or not isinstance(param_name, str):
+                raise SensorsABIllegalArgumentsException(
+                    "param_name is empty or not str"
+                )
+            if _SensorsABTestBase._is_valid_default_value(default_value):
+                valid_defaults[param_name] = default_value
+            else:
+                results[param_name] = Experiment(
+                    distinct_id, is_login_id=is_login_id, result=default_value
+                )
+        if valid_defaults and self._assert_custom_ids(custom_ids):
+            for param_name, default_value in valid_defaults.items():
+                results[param_name] = Experiment(
+                    distinct_id, is_login_id=is_login_id, result=default_value
+                )
+            valid_defaults = {}
+        return results, valid_defaults
+
+    @staticmethod
+    def _split_requests(valid_defaults, properties):
+        """
+        自定义属性请求需要携带 param_name，服务端按单个试验变量分流，
+        因此带自定义属性时每个试验变量各请求一次，否则只请求一次
+        :return: [(param_defaults, experiment_name)]
+        """
+        if len(valid_defaults) > 1 and _SensorsABTestBase._properties_handler(
+                properties
+        ):
+            return [
+                ({param_name: default_value}, param_name)
+                for param_name, default_value in valid_defaults.items()
+            ]
+        return [(valid_defaults, next(iter(valid_defaults)))]
+
+    @staticmethod
+    def _flight_key(distinct_id, is_login_id, custom_ids, properties, experiment_name):
+        """
+        合并并发请求使用的 key，自定义属性请求按试验变量分流，需要区分属性与试验变量
+        """
+        if properties:
+            return (
+                distinct_id,
+                is_login_id,
+                _custom_ids_key(custom_ids),
+                experiment_name,
+                str(sorted(properties.items())),
+            )
+        return distinct_id, is_login_id, _custom_ids_key(custom_ids)
+
+    @staticmethod
+    def _is_valid_default_value(default_value):
         if not (
                 isinstance(default_value, int)
                 or isinstance(default_value, bool)
                 or isinstance(default_value, dict)
                 or isinstance(default_value, str)
         ):
-            SensorsABTest.ab_log(
+            _SensorsABTestBase.ab_log(
                 "the type of defaultValue is not int,str,bool,dict return default value"
             )
-            return Experiment(
-                distinct_id, is_login_id=is_login_id, result=default_value
-            )
-        if self.__assert_custom_ids(custom_ids):
-            return Experiment(
-                distinct_id, is_login_id=is_login_id, result=default_value
-            )
-        r_timeout = timeout_seconds
+            return False
+        return True
+
+    @staticmethod
+    def _request_timeout(timeout_seconds):
         if not timeout_seconds:
-            r_timeout = 3
+            return 3
         elif isinstance(timeout_seconds, (int, float)) and timeout_seconds <= 0:
-            r_timeout = 3
-
-        if enable_cache:
-            experiment = self._experiment_cache_manager.get_cache_experiment_result(
-                distinct_id, is_login_id, custom_ids, param_name
-            )
-            if not experiment:
-                experiment = self.__getABTestByHttp(
-                    distinct_id,
-                    is_login_id,
-                    r_timeout,
-                    custom_ids,
-                    properties,
-                    param_name,
-                )
-                if experiment:
-                    self._experiment_cache_manager.set_cache_experiment_result(
-                        distinct_id, is_login_id, custom_ids, experiment
-                    )
-        else:
-            experiment = self.__getABTestByHttp(
-                distinct_id,
-                is_login_id,
-                r_timeout,
-                custom_ids,
-                properties,
-                param_name,
-            )
-        result = self.__convert_experiment(
-            experiment,
-            distinct_id,
-            is_login_id,
-            param_name,
-            default_value,
-        )
-        if enable_auto_track_event:
-            try:
-                self.__track_ab_trigger(result, custom_ids)
-            except Exception as e:
-                print(e)
-        return result
+            return 3
+        return timeout_seconds
 
-    def __convert_experiment(
+    def _convert_experiments(
             self,
             experiment,
             distinct_id,
             is_login_id,
-            param_name,
-            default_value,
+            param_defaults,
     ):
-        r_experiment = Experiment(
-            distinct_id, is_login_id=is_login_id, result=default_value
-        )
-
-        if not experiment:
-            return r_experiment
+        """
+        :param experiment: ExperimentIndex 对象，请求失败时为 None
+        """
+        r_experiments = {}
+        missing = False
+        for param_name, default_value in param_defaults.items():
+            variable = (
+                experiment.find(param_name, default_value) if experiment else None
+            )
+            if variable is None:
+                missing = True
+                r_experiments[param_name] = Experiment(
+                    distinct_id, is_login_id=is_login_id, result=default_value
+                )
+            else:
+                r_experiments[param_name] = Experiment(
+                    distinct_id,
+                    is_login_id=is_login_id,
+                    result=variable.result(),
+                    ab_experiment_id=variable.ab_experiment_id,
+                    ab_experiment_group_id=variable.ab_experiment_group_id,
+                    is_control_group=variable.is_control_group,
+                    is_white_list=variable.is_white_list,
+                )
+        if experiment and missing:
+            _SensorsABTestBase.ab_log(
+                "return default value,http result not contains experiment"
+            )
+        return r_experiments
 
-        if RESULTS_KEY in experiment and experiment[RESULTS_KEY] is not None:
-            results = experiment[RESULTS_KEY]
-            for value in results:
-                variables = value[VARIABLES_KEY]
-                for variable in variables:
-                    h_value = self._hit_experiment_value(
-                        variable, param_name, default_value
-                    )
-                    if h_value is not None:
-                        r_experiment.ab_experiment_id = value[EXPERIMENT_ID_KEY]
-                        r_experiment.ab_experiment_group_id = value[
-                            EXPERIMENT_GROUP_ID_KEY
-                        ]
-                        r_experiment.is_control_group = value[IS_CONTROL_GROUP_KEY]
-                        r_experiment.is_white_list = value[IS_WHITE_LIST_KEY]
-                        r_experiment.result = h_value
-                        return r_experiment
-        SensorsABTest.ab_log("return default value,http result not contains experiment")
-        return r_experiment
-
-    def _hit_experiment_value(self, variable, param_name, default_value):
-        if "name" in variable and variable["name"] == param_name:
-            v_type = variable["type"]
-            v_value = variable["value"]
-            if v_type:
-                if "STRING" == v_type and isinstance(default_value, str):
-                    return v_value
-                elif "INTEGER" == v_type and isinstance(default_value, int):
-                    return int(v_value)
-                elif "JSON" == v_type and isinstance(default_value, dict):
-                    return eval(v_value)
-                elif "BOOLEAN" == v_type and isinstance(default_value, bool):
-                    if v_value.lower() == 'true':
-                        return True
-                    else:
-                        return False
-                else:
-                    SensorsABTest.ab_log("The default value type should be " + v_type)
-                    return None
+    # 请求体中固定不变的部分预先编码，与 json.dumps 请求参数 dict 的结果逐字节一致
+    _LOGIN_ID_PREFIX = b'{"login_id": '
+    _ANONYMOUS_ID_PREFIX = b'{"anonymous_id": '
+    _STATIC_BODY = json.dumps(
+        {PLATFORM: PYTHON, VERSION_KEY: SDK_VERSION, "properties": {}}
+    ).encode("utf-8")[1:-1]
 
-    def __getABTestByHttp(
-            self,
-            distinct_id,
-            is_login_id,
-            timeout_seconds,
-            custom_ids,
-            properties,
-            experiment_name,
+    @staticmethod
+    def _encode_request_body(
+            distinct_id, is_login_id, custom_ids, properties, experiment_name
     ):
-        request_params = {}
-        if is_login_id:
-            request_params["login_id"] = distinct_id
-        else:
-            request_params["anonymous_id"] = distinct_id
-        request_params[PLATFORM] = PYTHON
-        request_params[VERSION_KEY] = SDK_VERSION
-        request_params["properties"] = {}
+        """
+        编码请求体，只序列化与用户相关的字段
+        """
+        parts = [
+            _SensorsABTestBase._LOGIN_ID_PREFIX
+            if is_login_id
+            else _SensorsABTestBase._ANONYMOUS_ID_PREFIX,
+            _dumps_str(distinct_id),
+            b", ",
+            _SensorsABTestBase._STATIC_BODY,
+        ]
         if custom_ids:
-            request_params["custom_ids"] = custom_ids
-        right_p = SensorsABTest._properties_handler(properties)
+            parts.append(b', "custom_ids": {')
+            parts.append(
+                b", ".join(
+                    _dumps_str(key) + b": " + _dumps_str(value)
+                    for key, value in custom_ids.items()
+                )
+            )
+            parts.append(b"}")
+        right_p = _SensorsABTestBase._properties_handler(properties)
         if right_p:
-            request_params["custom_properties"] = right_p
-            request_params["param_name"] = experiment_name
-        response = self.__do_request(request_params, timeout_seconds)
-        if response:
-            ret_code = response.status
-            SensorsABTest.ab_log("SAABTesting request code = " + str(ret_code))
-            if 200 <= ret_code <= 300:
-                http_res = response.data.decode("utf-8")
-                SensorsABTest.ab_log("SAABTesting request message = " + http_res)
-                http_res_dict = SensorsABTest._json_loads_byteified(http_res)
-                if (
-                        http_res_dict
-                        and STATUS_KEY in http_res_dict
-                        and SUCCESS == http_res_dict[STATUS_KEY]
-                        and RESULTS_KEY in http_res_dict
-                ):
-                    return http_res_dict
-        return None
-
-    @staticmethod
-    def _json_loads_byteified(json_text):
-        return SensorsABTest._byteify(
-            json.loads(json_text, object_hook=SensorsABTest._byteify), ignore_dicts=True
-        )
+            parts.append(b', "custom_properties": ')
+            parts.append(json.dumps(right_p).encode("utf-8"))
+            parts.append(b', "param_name": ')
+            parts.append(json.dumps(experiment_name).encode("utf-8"))
+        parts.append(b"}")
+        return b"".join(parts)
 
     @staticmethod
-    def _byteify(data, ignore_dicts=False):
-        if isinstance(data, str):
-            return data
-
-        # if this is a list of values, return list of byteified values
-        if isinstance(data, list):
-            return [SensorsABTest._byteify(item, ignore_dicts=True) for item in data]
-        # if this is a dictionary, return dictionary of byteified keys and values
-        # but only if we haven't already byteified it
-        if isinstance(data, dict) and not ignore_dicts:
-            return {
-                SensorsABTest._byteify(key, ignore_dicts=True): SensorsABTest._byteify(
-                    value, ignore_dicts=True
-                )
-                for key, value in data.items()  # changed to .items() for python 2.7/3
-            }
+    def _parse_response(ret_code, data):
+        """
+        解析 AB 服务返回结果，请求失败或结果无效时返回 None
+        """
+        _SensorsABTestBase.ab_log("SAABTesting request code = %s", ret_code)
+        if 200 <= ret_code <= 300:
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("SAABTesting request message = %s", data.decode("utf-8"))
+            try:
+                http_res_dict = _json_loads(data)
+            except ValueError as e:
+                _logger.warning("SAABTesting response is not valid json: %s", e)
+                return None
+            if (
+                    http_res_dict
+                    and STATUS_KEY in http_res_dict
+                    and SUCCESS == http_res_dict[STATUS_KEY]
+                    and RESULTS_KEY in http_res_dict
+            ):
+                return ExperimentIndex(http_res_dict)
+        return None
 
-        # python 3 compatible duck-typing
-        # if this is a unicode string, return its string representation
-        if str(type(data)) == "<type 'unicode'>":
-            return data.encode("utf-8")
-
-        # if it's anything else, return it in its original form
-        return data
-
-    def __do_request(self, request_params, timeout_seconds):
-        try:
-            json_data = json.dumps(request_params)
-            encoded_data = json_data.encode("utf-8")
-            response = self.http_manager.request('POST', self._base_url, body=encoded_data,
-                                                 headers={"Content-type": "application/json",
-                                                          "Connection": "keep-alive"},
-                                                 timeout=timeout_seconds)
-        except Exception as e:
-            print(e)
-            return None
-        return response
-
-    def __assert_custom_ids(slef, ids):
+    def _assert_custom_ids(slef, ids):
         if not ids:
-            SensorsABTest.ab_log("request without custom_ids")
+            _SensorsABTestBase.ab_log("request without custom_ids")
             return False
         for (key, value) in ids.items():
             if not key or len(key.strip()) == 0:
-                SensorsABTest.ab_log(
+                _SensorsABTestBase.ab_log(
                     "request with invalid custom_ids,the keys of custom_ids has null or empty"
                 )
                 return True
-            if not SensorsABTest.NAME_PATTERN.match(key):
-                SensorsABTest.ab_log("request with invalid custom_ids,the key mismatch")
+            if not _SensorsABTestBase.NAME_PATTERN.match(key):
+                _SensorsABTestBase.ab_log(
+                    "request with invalid custom_ids,the key mismatch"
+                )
                 return True
             if not value or len(value.strip()) == 0:
-                SensorsABTest.ab_log(
+                _SensorsABTestBase.ab_log(
                     "request with invalid custom_ids,the value of customIds has null or empty"
                 )
                 return True
-            if len(value) > SensorsABTest.MAX_PROPERTY_LENGTH:
-                SensorsABTest.ab_log(
+            if len(value) > _SensorsABTestBase.MAX_PROPERTY_LENGTH:
+                _SensorsABTestBase.ab_log(
                     "request with invalid custom_ids,the value length is too long"
                 )
                 return True
         return False
 
-    def __track_ab_trigger(self, result, custom_ids={}):
+    def _track_ab_triggers(self, results, custom_ids={}):
+        tracked = set()
+        for result in results.values():
+            if result.ab_experiment_id in tracked:
+                continue
+            tracked.add(result.ab_experiment_id)
+            try:
+                self._track_ab_trigger(result, custom_ids)
+            except Exception as e:
+                _logger.warning("track $ABTestTrigger failed: %s", e)
+
+    def _track_ab_trigger(self, result, custom_ids={}):
         if result is None:
             return
         if (
@@ -497,28 +615,57 @@ class SensorsABTest:
         properties = {}
         properties[EXPERIMENT_ID] = result.ab_experiment_id
         properties[EXPERIMENT_GROUP_ID] = result.ab_experiment_group_id
-        if self.__is_day_first():
+        if self._is_day_first():
             version = [AB_TEST_EVENT_LIB_VERSION + ":" + SDK_VERSION]
             properties[LIB_PLUGIN_VERSION] = version
-        self._sa.track(result.distinct_id, EVENT_TYPE, properties, result.is_login_id)
+        self._send_trigger(result, custom_ids, properties)
+
+    def _send_trigger(self, experiment, custom_ids, properties):
+        if self._trigger_queue is not None:
+            # 事件发送成功后才写入事件缓存，发送失败的事件在下次曝光时重新触发
+            self._trigger_queue.put(
+                (
+                    experiment.distinct_id,
+                    experiment.is_login_id,
+                    experiment.ab_experiment_id,
+                    _custom_ids_key(custom_ids),
+                ),
+                experiment.distinct_id,
+                properties,
+                experiment.is_login_id,
+            )
+            return
+        self._sa.track(
+            experiment.distinct_id, EVENT_TYPE, properties, experiment.is_login_id
+        )
         if self._enable_event_cache:
             self._event_cache.set_cache(
-                result.distinct_id,
-                result.is_login_id,
-                result.ab_experiment_id,
+                experiment.distinct_id,
+                experiment.is_login_id,
+                experiment.ab_experiment_id,
                 custom_ids,
             )
 
-    def __is_day_first(self):
+    def _on_trigger_sent(self, key):
+        distinct_id, is_login_id, ab_experiment_id, ids_key = key
+        if self._enable_event_cache:
+            self._event_cache.set_cache(
+                distinct_id, is_login_id, ab_experiment_id, dict(ids_key)
+            )
+
+    def _is_day_first(self):
         if self._track_day and self._track_day == datetime.now().day:
             return False
         self._track_day = datetime.now().day
         return True
 
     @staticmethod
-    def ab_log(msg):
-        if ab_enablg_log:
-            print("SA_AB:" + msg)
+    def ab_log(msg, *args):
+        """
+        输出 DEBUG 日志，args 为 % 格式化参数，日志未开启时不做格式化
+        """
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(msg, *args)
 
     @staticmethod
     def _properties_handler(properties):
@@ -532,7 +679,7 @@ class SensorsABTest:
                 raise SensorsABIllegalDataException(
                     "The property name %s is too long, max length is 100" % str(key)
                 )
-            if not SensorsABTest.NAME_PATTERN.match(key):
+            if not _SensorsABTestBase.NAME_PATTERN.match(key):
                 raise SensorsABIllegalDataException(
                     "The property name %s is invalid format" % str(key)
                 )
@@ -562,101 +709,2115 @@ class SensorsABTest:
         return new_p
 
 
-class Experiment:
+class SensorsABTest(_SensorsABTestBase):
     def __init__(
+            self,
+            base_url,
+            sa,
+            event_cache_time=1440,
+            event_cache_size=4096,
+            experiment_cache_size=4096,
+            experiment_cache_time=1440,
+            enable_event_cache=True,
+            enable_log=False,
+            cache_shards=16,
+            http_pool_size=16,
+            experiment_stale_time=0,
+            cache_snapshot_file=None,
+            cache_backend=None,
+            trigger_queue_size=0,
+            trigger_queue_policy="drop",
+            event_cache_error_rate=0,
+            cache_clock_resolution=0,
+            experiment_failure_cache_time=0,
+            local_evaluation_config=None,
+            local_evaluation_interval=60,
+            circuit_breaker_threshold=0,
+            circuit_breaker_recovery_time=10,
+            circuit_breaker_callback=None,
+            hedge_requests=False,
+    ):
+        """
+        初始化 SDK
+        :param base_url: AB 地址，部署了多个 AB 服务时可传入地址列表，
+            每次请求选择健康地址中平均耗时最短的一个，统计见 stats() 的 endpoints
+        :param sa: SA SDK 对象
+        :param event_cache_time:事件缓存时间，单位为分钟
+        :param event_cache_size: 事件缓存条数
+        :param experiment_cache_size: 试验缓存条数
+        :param experiment_cache_time: 试验缓存时间，单位为分钟
+        :param enable_event_cache: 是否自动触发 $ABTestTrigger 事件
+        :param enable_log: 开启日志
+        :param cache_shards: 试验缓存与事件缓存的分段数，各分段独立加锁，多线程并发时减少锁竞争
+        :param http_pool_size: 与 AB 服务保持的最大连接数，也是 bulk_fetch_ab_tests 的默认并发数
+        :param experiment_stale_time: 试验缓存过期后的宽限时间，单位为分钟，默认 0 表示关闭。
+            宽限期内 fast_fetch_ab_test 直接返回旧结果并在后台刷新，刷新失败时继续使用旧结果
+        :param cache_snapshot_file: 缓存快照文件路径，默认不开启。初始化时从该文件恢复试验缓存与事件缓存，
+            close() 时写入，进程重启后不会重复触发 $ABTestTrigger 事件
+        :param cache_backend: 试验缓存与事件缓存的存储后端，默认为进程内缓存。
+            传入 SharedMemoryCacheBackend(目录) 时缓存存放在共享内存映射文件中，多进程部署时各 worker 共用同一份缓存
+        :param trigger_queue_size: $ABTestTrigger 事件队列长度，默认 0 表示在请求线程中同步发送。
+            大于 0 时事件加入队列，由后台线程批量交给 sa 发送，close() 时发送剩余事件
+        :param trigger_queue_policy: 事件队列已满时的策略，"drop" 丢弃事件（默认），"block" 阻塞直到队列有空位
+        :param event_cache_error_rate: 事件缓存的误判率，默认 0 表示精确去重。取值 (0, 1) 时事件缓存改用两个轮换的 Bloom 过滤器，
+            按 event_cache_size 条/周期分配固定内存，周期为 event_cache_time 并与本地零点对齐，
+            约 event_cache_error_rate 比例的首次曝光会被误判为已触发；该模式不写入缓存快照。event_cache_time 为 0 时忽略该参数
+        :param cache_clock_resolution: 缓存时钟精度，单位为秒，默认 0 表示每次读取 time.monotonic()。
+            大于 0 时由后台线程按该间隔刷新时钟，缓存读写不再调用系统时钟，过期时间误差不超过该值
+        :param experiment_failure_cache_time: 试验请求失败或超时后的负缓存时间，单位为秒，默认 0 表示关闭，最大 3600。
+            负缓存有效期内 fast_fetch_ab_test 对该用户直接返回默认值，不再重复请求
+        :param local_evaluation_config: 本地分流的试验配置地址，http(s) URL 或本地文件路径，默认不开启。
+            开启后按 local_evaluation_interval 定期拉取全量试验配置，在进程内为用户分配试验组，不再逐个用户请求 AB 服务；
+            依赖服务端受众数据的试验仍请求 AB 服务，配置格式见 LocalEvaluator
+        :param local_evaluation_interval: 本地分流配置的刷新间隔，单位为秒
+        :param circuit_breaker_threshold: 打开熔断器的连续请求失败次数，默认 0 表示不熔断。
+            请求异常、超时或 AB 服务返回 5xx 时计为失败，熔断期间请求直接返回默认值
+        :param circuit_breaker_recovery_time: 熔断后放行探测请求的等待时间，单位为秒，探测成功后恢复请求
+        :param circuit_breaker_callback: 熔断器状态变化时调用，参数为 (old_state, new_state)，
+            状态为 CircuitBreaker.CLOSED、OPEN、HALF_OPEN
+        :param hedge_requests: 是否开启对冲请求，需要配置多个 AB 服务地址，默认关闭。
+            开启后请求超过所选地址近期耗时的 p95 仍未成功返回时，向另一个地址再发送一次请求，先成功返回的结果生效
+        """
+        _SensorsABTestBase.__init__(
+            self,
+            base_url,
+            sa,
+            event_cache_time,
+            event_cache_size,
+            experiment_cache_size,
+            experiment_cache_time,
+            enable_event_cache,
+            enable_log,
+            cache_shards,
+            experiment_stale_time,
+            cache_snapshot_file,
+            cache_backend,
+            trigger_queue_size,
+            trigger_queue_policy,
+            event_cache_error_rate,
+            cache_clock_resolution,
+            experiment_failure_cache_time,
+            circuit_breaker_threshold,
+            circuit_breaker_recovery_time,
+            circuit_breaker_callback,
+        )
+        if not isinstance(http_pool_size, int) or http_pool_size <= 0:
+            self._http_pool_size = 16
+        else:
+            self._http_pool_size = http_pool_size
+        # Proxy Setting: https://urllib3.readthedocs.io/en/stable/reference/urllib3.poolmanager.html#urllib3.ProxyManager
+        self.http_manager = urllib3.PoolManager(
+            retries=False, maxsize=self._http_pool_size
+        )
+        self._single_flight = SingleFlight()
+        if self._experiment_stale_time:
+            self._refresh_executor = ThreadPoolExecutor(
+                max_workers=self._http_pool_size,
+                thread_name_prefix="SensorsABTestRefresh",
+            )
+        else:
+            self._refresh_executor = None
+        self._warm_up_tasks = []
+        if hedge_requests and len(self._endpoints) > 1:
+            self._hedge_executor = ThreadPoolExecutor(
+                max_workers=self._http_pool_size * 2,
+                thread_name_prefix="SensorsABTestHedge",
+            )
+        else:
+            self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        self.hedged = 0
+        self.hedge_wins = 0
+        if local_evaluation_config is None:
+            self._local_evaluator = None
+        elif not isinstance(local_evaluation_config, str) or not local_evaluation_config:
+            raise SensorsABIllegalArgumentsException(
+                "local_evaluation_config should be url or file path, init failed"
+            )
+        else:
+            if (
+                    not isinstance(local_evaluation_interval, (int, float))
+                    or local_evaluation_interval <= 0
+            ):
+                local_evaluation_interval = 60
+            self._local_evaluation_config = local_evaluation_config
+            self._local_evaluator = LocalEvaluator(
+                self.__load_local_config, local_evaluation_interval
+            )
+
+    def async_fetch_ab_test(
             self,
             distinct_id,
             is_login_id,
-            result=None,
-            ab_experiment_id=None,
-            ab_experiment_group_id=None,
-            is_control_group=None,
-            is_white_list=None,
+            param_name,
+            default_value,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            properties={},
     ):
-        self.distinct_id = distinct_id
-        self.is_login_id = is_login_id
-        self.ab_experiment_id = ab_experiment_id
-        self.ab_experiment_group_id = ab_experiment_group_id
-        self.is_control_group = is_control_group
-        self.is_white_list = is_white_list
-        self.result = result
+        """
+        立即从服务端请求，忽略内存缓存
+        :param distinct_id: 用户 ID
+        :param is_login_id: 是否为登录 ID
+        :param param_name: 试验变量名称
+        :param default_value: 未命中试验，返回默认值（支持数据类型：int｜bool｜str｜dict）
+        :param enable_auto_track_event: 是否 SDK 自动触发事件
+        :param timeout_seconds:网络请求超时等待事件，单位为秒，也可以是 urllib3.Timeout() 对象。
+        :param custom_ids:自定义主体
+        :param properties:自定义属性
+        :return: Experiment
 
-    def __str__(self):
-        return (
-                "distinct_id = %s,is_login_id = %s,result = %s,ab_experiment_id = %s,ab_experiment_group_id = %s,"
-                "is_control_group = %s,is_white_list = %s"
-                % (
-                    self.distinct_id,
-                    self.is_login_id,
-                    self.result,
-                    self.ab_experiment_id,
-                    self.ab_experiment_group_id,
-                    self.is_control_group,
-                    self.is_white_list,
-                )
+        对于 timeout_seconds 参数，默认是 3 秒。
+        客户若想精确控制 connect 和 read 超时，请使用 urllib3.Timeout()。
+        下面是使用示::
+            >>> urllib3.Timeout(connect=1.0)
+            >>> urllib3.Timeout(connect=1.0, read=2.0)
+        """
+        return self.__fetch_ab(
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            False,
+            properties,
         )
 
+    def fast_fetch_ab_test(
+            self,
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            properties={},
+    ):
+        """
+        优先从内存获取试验
+        :param distinct_id: 用户 ID
+        :param is_login_id: 是否为登录 ID
+        :param param_name: 试验变量名称
+        :param default_value: 未命中试验，返回默认值（支持数据类型：int｜bool｜str｜dict）
+        :param enable_auto_track_event: 是否 SDK 自动触发事件
+        :param timeout_seconds:网络请求超时等待事件，单位为秒。也可以是 urllib3.Timeout() 对象。
+        :param custom_ids:自定义主体
+        :param properties:自定义属性
+        :return: Experiment
 
-class EventCacheManager:
-    def __init__(self, time, size):
-        if size != 0:
-            self._cache = TTLCache(
-                size, ttl=(timedelta(minutes=time)), timer=datetime.now
-            )
+        对于 timeout_seconds 参数，默认是 3 秒。
+        客户若想精确控制 connect 和 read 超时，请使用 urllib3.Timeout()。
+        下面是使用示::
+            >>> urllib3.Timeout(connect=1.0)
+            >>> urllib3.Timeout(connect=1.0, read=2.0)
+        """
+        return self.__fetch_ab(
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            True,
+            properties,
+        )
 
-    def is_event_exist(self, distinct_id, is_login_id, ab_experiment_id, custom_ids):
-        if hasattr(self, "_cache"):
-            return (
-                    self.__generate_key(
-                        distinct_id, is_login_id, ab_experiment_id, custom_ids
-                    )
-                    in self._cache
-            )
-        else:
-            return False
+    def fetch_ab_tests(
+            self,
+            distinct_id,
+            is_login_id,
+            param_defaults,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            properties={},
+            enable_cache=True,
+    ):
+        """
+        一次获取多个试验变量的结果，只查询一次缓存、发起一次网络请求
+        :param distinct_id: 用户 ID
+        :param is_login_id: 是否为登录 ID
+        :param param_defaults: 试验变量名称与默认值的映射，例如 {"num_test": 100, "string_test": "unknown"}
+        :param enable_auto_track_event: 是否 SDK 自动触发事件
+        :param timeout_seconds:网络请求超时等待事件，单位为秒。也可以是 urllib3.Timeout() 对象。
+        :param custom_ids:自定义主体
+        :param properties:自定义属性，服务端按单个试验变量处理自定义属性，因此传入时每个试验变量各请求一次
+        :param enable_cache: 是否优先从内存获取试验
+        :return: dict，key 为试验变量名称，value 为 Experiment
+        """
+        return self.__fetch_abs(
+            distinct_id,
+            is_login_id,
+            param_defaults,
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            enable_cache,
+            properties,
+        )
 
-    def set_cache(self, distinct_id, is_login_id, ab_experiment_id, custom_ids):
-        if hasattr(self, "_cache"):
-            self._cache[
-                self.__generate_key(
-                    distinct_id, is_login_id, ab_experiment_id, custom_ids
+    def bulk_fetch_ab_tests(
+            self,
+            users,
+            param_defaults,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            properties={},
+            enable_cache=False,
+            concurrency=None,
+            max_in_flight=None,
+    ):
+        """
+        批量获取多个用户的试验结果，适用于离线、批处理任务。
+        请求通过连接池并发发送，结果按 users 的顺序逐个产出，不会一次性加载全部用户。
+        :param users: 可迭代对象，元素为 (distinct_id, is_login_id) 或 (distinct_id, is_login_id, custom_ids)
+        :param param_defaults: 试验变量名称与默认值的映射，同 fetch_ab_tests
+        :param enable_auto_track_event: 是否 SDK 自动触发事件
+        :param timeout_seconds:网络请求超时等待事件，单位为秒。也可以是 urllib3.Timeout() 对象。
+        :param properties:自定义属性
+        :param enable_cache: 是否读写内存缓存，批处理场景下用户通常不会重复，默认关闭
+        :param concurrency: 同时进行的请求数，默认为 http_pool_size
+        :param max_in_flight: 已提交但尚未产出的用户数上限，默认为 concurrency 的 4 倍，
+            用于在个别请求较慢时让其余请求继续进行
+        :return: 生成器，依次产出 (user, dict)，dict 同 fetch_ab_tests 的返回值；
+            user 格式有误、distinct_id 为空、custom_ids 不是 str 到 str 的 dict 或请求出错时
+            该用户产出 (user, None)，不影响其余用户
+        """
+        if not param_defaults or not isinstance(param_defaults, dict):
+            raise SensorsABIllegalArgumentsException(
+                "param_defaults is empty or not dict"
+            )
+        if concurrency is None:
+            concurrency = self._http_pool_size
+        if not isinstance(concurrency, int) or concurrency <= 0:
+            raise SensorsABIllegalArgumentsException("concurrency should be positive int")
+        if max_in_flight is None:
+            max_in_flight = concurrency * 4
+        if not isinstance(max_in_flight, int) or max_in_flight < concurrency:
+            raise SensorsABIllegalArgumentsException(
+                "max_in_flight should be int and not less than concurrency"
+            )
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = deque()
+            for user in users:
+                if not isinstance(user, (tuple, list)) or len(user) not in (2, 3):
+                    SensorsABTest.ab_log(
+                        "bulk fetch user should be (distinct_id, is_login_id[, custom_ids])"
+                    )
+                    in_flight.append((user, None))
+                    continue
+                if not user[0] or not isinstance(user[0], str):
+                    SensorsABTest.ab_log("bulk fetch distinct_id is empty or not str")
+                    in_flight.append((user, None))
+                    continue
+                custom_ids = user[2] if len(user) == 3 and user[2] else {}
+                if not isinstance(custom_ids, dict) or not all(
+                        isinstance(key, str) and isinstance(value, str)
+                        for key, value in custom_ids.items()
+                ):
+                    SensorsABTest.ab_log("bulk fetch custom_ids should be dict of str")
+                    in_flight.append((user, None))
+                    continue
+                in_flight.append(
+                    (
+                        user,
+                        executor.submit(
+                            self.__fetch_abs,
+                            user[0],
+                            user[1],
+                            param_defaults,
+                            enable_auto_track_event,
+                            timeout_seconds,
+                            custom_ids,
+                            enable_cache,
+                            properties,
+                        ),
+                    )
                 )
-            ] = ""
-
-    def __generate_key(self, distinct_id, is_login_id, ab_experiment_id, custom_ids):
-        return "%s_%s_%s_%s" % (distinct_id, is_login_id, ab_experiment_id, custom_ids)
+                if len(in_flight) >= max_in_flight:
+                    user, future = in_flight.popleft()
+                    yield user, SensorsABTest.__bulk_result(future)
+            while in_flight:
+                user, future = in_flight.popleft()
+                yield user, SensorsABTest.__bulk_result(future)
 
+    @staticmethod
+    def __bulk_result(future):
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            _logger.warning("bulk fetch failed: %s", e)
+            return None
 
-class ExperimentCacheManager:
-    def __init__(self, cache_time, cache_size):
-        if cache_size != 0:
-            self._experiment_result_cache = TTLCache(
-                cache_size, ttl=(timedelta(minutes=cache_time)), timer=datetime.now
+    def batch_assign(self, distinct_ids, param_defaults, custom_ids=None):
+        """
+        本地分流模式下批量计算用户的试验结果，适用于回溯、离线打分等大批量场景。
+        使用 NumPy 向量化计算哈希与试验组，需要安装 numpy；不发起网络请求，也不触发 $ABTestTrigger 事件。
+        数据量较大时建议分块调用，每块数十万到数百万个用户
+        :param distinct_ids: 用户 ID 数组或序列，numpy 字符串数组无需逐个转换
+        :param param_defaults: 试验变量名称与默认值的映射，同 fetch_ab_tests
+        :param custom_ids: 自定义主体，dict，key 为自定义主体名称，value 为与 distinct_ids 等长的 ID 列
+        :return: dict，key 为试验变量名称，value 为按列存放结果的 dict，见 LocalEvaluator.evaluate_batch
+        """
+        if self._local_evaluator is None:
+            raise SensorsABException("batch_assign requires local_evaluation_config")
+        if not param_defaults or not isinstance(param_defaults, dict):
+            raise SensorsABIllegalArgumentsException(
+                "param_defaults is empty or not dict"
             )
+        return self._local_evaluator.evaluate_batch(
+            distinct_ids, param_defaults, custom_ids
+        )
 
-    def get_cache_experiment_result(
-            self, distinct_id, is_login, custom_ids, experiment_name
-    ):
-        if hasattr(self, "_experiment_result_cache"):
-            key = self.__generate_key(distinct_id, is_login, custom_ids)
-            if key in self._experiment_result_cache:
-                experiment_result = self._experiment_result_cache[key]
-                result = experiment_result[RESULTS_KEY]
-                for value in result:
-                    v_var = value[VARIABLES_KEY]
-                    for v in v_var:
-                        if experiment_name == v["name"]:
-                            SensorsABTest.ab_log("return cache")
-                            return experiment_result
-        return None
-
-    def set_cache_experiment_result(
-            self, distinct_id, is_login_id, custom_ids, experiment
+    def warm_up(
+            self,
+            users,
+            concurrency=4,
+            rate_limit=None,
+            wait=False,
+            timeout_seconds=3.0,
+            progress_callback=None,
     ):
-        if hasattr(self, "_experiment_result_cache"):
-            key = self.__generate_key(distinct_id, is_login_id, custom_ids)
-            self._experiment_result_cache[key] = experiment
+        """
+        在后台批量预取用户的试验结果并写入试验缓存，用于服务启动后预热缓存
+        :param users: 可迭代对象，元素为 (distinct_id, is_login_id) 或 (distinct_id, is_login_id, custom_ids)
+        :param concurrency: 同时进行的请求数
+        :param rate_limit: 每秒最多发出的请求数，默认不限制
+        :param wait: 是否阻塞等待预热完成，默认不阻塞
+        :param timeout_seconds:网络请求超时等待事件，单位为秒。也可以是 urllib3.Timeout() 对象。
+        :param progress_callback: 每处理完一个用户调用一次，参数为 WarmUpTask
+        :return: WarmUpTask
+        """
+        if not isinstance(concurrency, int) or concurrency <= 0:
+            raise SensorsABIllegalArgumentsException("concurrency should be positive int")
+        if rate_limit is not None and (
+                not isinstance(rate_limit, (int, float)) or rate_limit <= 0
+        ):
+            raise SensorsABIllegalArgumentsException("rate_limit should be positive")
+        task = WarmUpTask(
+            users,
+            self.__warm_up_user,
+            concurrency,
+            rate_limit,
+            SensorsABTest._request_timeout(timeout_seconds),
+            progress_callback,
+        )
+        self._warm_up_tasks = [t for t in self._warm_up_tasks if not t.done()]
+        self._warm_up_tasks.append(task)
+        task.start()
+        if wait:
+            task.wait()
+        return task
 
-    def __generate_key(self, distinct_id, is_login, custom_ids):
-        return distinct_id + "_" + str(is_login) + "_" + str(custom_ids)
+    def stats(self):
+        """
+        SDK 运行统计，内容同 _SensorsABTestBase.stats()；
+        开启本地分流时还包含 local_evaluated 本地完成分流的次数，local_fallbacks 回退到远程请求的次数；
+        开启对冲请求时还包含 hedged_requests 发出对冲请求的次数，hedge_wins 对冲请求先返回的次数
+        """
+        stats = _SensorsABTestBase.stats(self)
+        if self._local_evaluator is not None:
+            stats["local_evaluated"] = self._local_evaluator.evaluated
+            stats["local_fallbacks"] = self._local_evaluator.fallbacks
+        if self._hedge_executor is not None:
+            stats["hedged_requests"] = self.hedged
+            stats["hedge_wins"] = self.hedge_wins
+        return stats
 
+    def close(self):
+        for task in self._warm_up_tasks:
+            task.cancel()
+        if self._local_evaluator is not None:
+            self._local_evaluator.close()
+        if self._refresh_executor is not None:
+            self._refresh_executor.shutdown(wait=True)
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=True)
+        self._close_trigger_queue()
+        self._save_cache_snapshot()
+        self._close_caches()
+        self.http_manager.clear()
+
+    def __fetch_ab(
+            self,
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            enable_cache=False,
+            properties={},
+    ):
+        if not param_name or not isinstance(param_name, str):
+            raise SensorsABIllegalArgumentsException("param_name is empty or not str")
+        return self.__fetch_abs(
+            distinct_id,
+            is_login_id,
+            {param_name: default_value},
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            enable_cache,
+            properties,
+        )[param_name]
+
+    def __fetch_abs(
+            self,
+            distinct_id,
+            is_login_id,
+            param_defaults,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            enable_cache=True,
+            properties={},
+    ):
+        results, valid_defaults = self._prepare_fetch(
+            distinct_id, is_login_id, param_defaults, custom_ids
+        )
+        if not valid_defaults:
+            return results
+        r_timeout = SensorsABTest._request_timeout(timeout_seconds)
+        for request_defaults, experiment_name in SensorsABTest._split_requests(
+                valid_defaults, properties
+        ):
+            experiment = self.__load_experiment(
+                distinct_id,
+                is_login_id,
+                list(request_defaults),
+                r_timeout,
+                custom_ids,
+                enable_cache,
+                properties,
+                experiment_name,
+            )
+            results.update(
+                self._convert_experiments(
+                    experiment, distinct_id, is_login_id, request_defaults
+                )
+            )
+        if enable_auto_track_event:
+            self._track_ab_triggers(results, custom_ids)
+        return results
+
+    def __load_experiment(
+            self,
+            distinct_id,
+            is_login_id,
+            param_names,
+            timeout_seconds,
+            custom_ids,
+            enable_cache,
+            properties,
+            experiment_name,
+    ):
+        if self._local_evaluator is not None:
+            experiment = self._local_evaluator.evaluate(
+                distinct_id, custom_ids, param_names
+            )
+            if experiment is not None:
+                return experiment
+        if enable_cache:
+            experiment, stale = self._experiment_cache_manager.lookup_experiment_results(
+                distinct_id, is_login_id, custom_ids, param_names, properties
+            )
+            flight_key = SensorsABTest._flight_key(
+                distinct_id, is_login_id, custom_ids, properties, experiment_name
+            )
+            if experiment and stale:
+                if (
+                        self._refresh_executor is not None
+                        and not self._single_flight.is_running(flight_key)
+                ):
+                    self._refresh_executor.submit(
+                        self._single_flight.do,
+                        flight_key,
+                        self.__fetch_and_cache,
+                        distinct_id,
+                        is_login_id,
+                        timeout_seconds,
+                        custom_ids,
+                        properties,
+                        experiment_name,
+                    )
+            elif not experiment and not self._experiment_cache_manager.is_fetch_failed(
+                    distinct_id, is_login_id, custom_ids
+            ):
+                experiment = self._single_flight.do(
+                    flight_key,
+                    self.__fetch_and_cache,
+                    distinct_id,
+                    is_login_id,
+                    timeout_seconds,
+                    custom_ids,
+                    properties,
+                    experiment_name,
+                )
+        else:
+            experiment = self.__getABTestByHttp(
+                distinct_id,
+                is_login_id,
+                timeout_seconds,
+                custom_ids,
+                properties,
+                experiment_name,
+            )
+        return experiment
+
+    def __warm_up_user(self, user, timeout_seconds):
+        if not isinstance(user, (tuple, list)) or len(user) not in (2, 3):
+            SensorsABTest.ab_log("warm up user should be (distinct_id, is_login_id[, custom_ids])")
+            return False
+        distinct_id, is_login_id = user[0], user[1]
+        custom_ids = user[2] if len(user) == 3 and user[2] else {}
+        if not distinct_id or not isinstance(distinct_id, str):
+            SensorsABTest.ab_log("warm up distinct_id is empty or not str")
+            return False
+        if self._assert_custom_ids(custom_ids):
+            return False
+        experiment = self._single_flight.do(
+            SensorsABTest._flight_key(distinct_id, is_login_id, custom_ids, None, None),
+            self.__fetch_and_cache,
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            None,
+            None,
+        )
+        return experiment is not None
+
+    def __fetch_and_cache(
+            self,
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            properties,
+            experiment_name,
+    ):
+        experiment = self.__getABTestByHttp(
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            properties,
+            experiment_name,
+        )
+        if experiment:
+            self._experiment_cache_manager.set_cache_experiment_result(
+                distinct_id,
+                is_login_id,
+                custom_ids,
+                experiment,
+                complete=not SensorsABTest._properties_handler(properties),
+            )
+        else:
+            self._experiment_cache_manager.set_fetch_failed(
+                distinct_id, is_login_id, custom_ids
+            )
+        return experiment
+
+    def __getABTestByHttp(
+            self,
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            properties,
+            experiment_name,
+    ):
+        request_body = SensorsABTest._encode_request_body(
+            distinct_id, is_login_id, custom_ids, properties, experiment_name
+        )
+        response = self.__do_request(request_body, timeout_seconds)
+        if response:
+            return SensorsABTest._parse_response(response.status, response.data)
+        return None
+
+    def __load_local_config(self):
+        source = self._local_evaluation_config
+        if not source.startswith(("http://", "https://")):
+            with open(source, "rb") as f:
+                return f.read()
+        response = self.http_manager.request(
+            "GET", source, timeout=3.0
+        )
+        if response.status != 200:
+            raise SensorsABException("status %s" % response.status)
+        return response.data
+
+    def __do_request(self, request_body, timeout_seconds):
+        breaker = self._circuit_breaker
+        if breaker is not None and not breaker.allow():
+            return None
+        endpoint = self._endpoints.select()
+        delay = None
+        if self._hedge_executor is not None:
+            delay = self._endpoints.percentile(endpoint, 95)
+        if delay is None:
+            response = self.__request_endpoint(endpoint, request_body, timeout_seconds)
+        else:
+            response = self.__hedged_request(endpoint, delay, request_body, timeout_seconds)
+        if breaker is not None:
+            if response is None or response.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return response
+
+    def __hedged_request(self, endpoint, delay, request_body, timeout_seconds):
+        """
+        先向 endpoint 发送请求，超过 delay 秒仍未成功返回时向另一个地址再发送一次，返回先成功的结果
+        """
+        futures = [
+            self._hedge_executor.submit(
+                self.__request_endpoint, endpoint, request_body, timeout_seconds
+            )
+        ]
+        done, _ = wait(futures, timeout=delay)
+        if not done or not SensorsABTest.__succeeded(futures[0].result()):
+            secondary = self._endpoints.select(exclude=endpoint)
+            if secondary is not None:
+                futures.append(
+                    self._hedge_executor.submit(
+                        self.__request_endpoint, secondary, request_body, timeout_seconds
+                    )
+                )
+                with self._hedge_lock:
+                    self.hedged += 1
+        response = None
+        for future in as_completed(futures):
+            result = future.result()
+            if SensorsABTest.__succeeded(result):
+                if future is not futures[0]:
+                    with self._hedge_lock:
+                        self.hedge_wins += 1
+                return result
+            response = response or result
+        return response
+
+    @staticmethod
+    def __succeeded(response):
+        return response is not None and response.status < 500
+
+    def __request_endpoint(self, endpoint, request_body, timeout_seconds):
+        start = time.monotonic()
+        try:
+            response = self.http_manager.request('POST', endpoint.url, body=request_body,
+                                                 headers={"Content-type": "application/json",
+                                                          "Connection": "keep-alive"},
+                                                 timeout=timeout_seconds)
+        except Exception as e:
+            _logger.warning("SAABTesting request %s failed: %s", endpoint.url, e)
+            self._endpoints.record(endpoint, time.monotonic() - start, False)
+            return None
+        self._endpoints.record(
+            endpoint, time.monotonic() - start, SensorsABTest.__succeeded(response)
+        )
+        return response
+
+
+class Experiment:
+    def __init__(
+            self,
+            distinct_id,
+            is_login_id,
+            result=None,
+            ab_experiment_id=None,
+            ab_experiment_group_id=None,
+            is_control_group=None,
+            is_white_list=None,
+    ):
+        self.distinct_id = distinct_id
+        self.is_login_id = is_login_id
+        self.ab_experiment_id = ab_experiment_id
+        self.ab_experiment_group_id = ab_experiment_group_id
+        self.is_control_group = is_control_group
+        self.is_white_list = is_white_list
+        self.result = result
+
+    def __str__(self):
+        return (
+                "distinct_id = %s,is_login_id = %s,result = %s,ab_experiment_id = %s,ab_experiment_group_id = %s,"
+                "is_control_group = %s,is_white_list = %s"
+                % (
+                    self.distinct_id,
+                    self.is_login_id,
+                    self.result,
+                    self.ab_experiment_id,
+                    self.ab_experiment_group_id,
+                    self.is_control_group,
+                    self.is_white_list,
+                )
+        )
+
+
+class ExperimentVariable:
+    """
+    命中的试验变量，value 为按变量类型转换后的值
+    """
+
+    __slots__ = (
+        "type",
+        "kind",
+        "value",
+        "nested",
+        "ab_experiment_id",
+        "ab_experiment_group_id",
+        "is_control_group",
+        "is_white_list",
+    )
+
+    _KINDS = {"STRING": str, "INTEGER": int, "JSON": dict, "BOOLEAN": bool}
+
+    def __init__(self, variable, experiment):
+        v_type = variable.get("type")
+        v_value = variable.get("value")
+        self.type = v_type
+        self.kind = ExperimentVariable._KINDS.get(v_type)
+        self.nested = False
+        try:
+            if self.kind is int:
+                v_value = int(v_value)
+            elif self.kind is bool:
+                v_value = v_value.lower() == "true"
+            elif self.kind is dict:
+                v_value = _json_loads(v_value)
+                self.nested = not isinstance(v_value, dict) or any(
+                    isinstance(v, (dict, list)) for v in v_value.values()
+                )
+        except Exception as e:
+            _SensorsABTestBase.ab_log(
+                "invalid experiment variable %s: %s", variable.get("name"), e
+            )
+            self.kind = None
+        self.value = v_value
+        self.ab_experiment_id = experiment.get(EXPERIMENT_ID_KEY)
+        self.ab_experiment_group_id = experiment.get(EXPERIMENT_GROUP_ID_KEY)
+        self.is_control_group = experiment.get(IS_CONTROL_GROUP_KEY)
+        self.is_white_list = experiment.get(IS_WHITE_LIST_KEY)
+
+    def result(self):
+        if self.kind is dict:
+            # JSON 变量在缓存时已解析，命中时只复制容器，调用方修改结果不影响缓存
+            if self.nested:
+                return _copy_json(self.value)
+            return dict(self.value)
+        return self.value
+
+
+def _copy_json(value):
+    if isinstance(value, dict):
+        return {k: _copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(v) for v in value]
+    return value
+
+
+class ExperimentIndex:
+    """
+    按试验参数名索引的 AB 服务返回结果，缓存命中时直接查找，无需遍历全部试验
+    """
+
+    __slots__ = ("response", "variables")
+
+    def __init__(self, response, variables=None):
+        """
+        :param response: AB 服务返回结果
+        :param variables: 已按试验参数名索引的试验变量，默认由 response 生成
+        """
+        self.response = response
+        if variables is not None:
+            self.variables = variables
+            return
+        variables = {}
+        for experiment in response.get(RESULTS_KEY) or ():
+            for variable in experiment.get(VARIABLES_KEY) or ():
+                variables.setdefault(variable.get("name"), []).append(
+                    ExperimentVariable(variable, experiment)
+                )
+        self.variables = {name: tuple(v) for name, v in variables.items()}
+
+    def covers(self, param_names):
+        """
+        是否包含全部试验参数
+        """
+        variables = self.variables
+        for param_name in param_names:
+            if param_name not in variables:
+                return False
+        return True
+
+    def find(self, param_name, default_value):
+        """
+        查找与默认值类型一致的试验变量，未命中时返回 None
+        """
+        for variable in self.variables.get(param_name, ()):
+            if variable.kind is not None and isinstance(default_value, variable.kind):
+                return variable
+            if variable.type:
+                _SensorsABTestBase.ab_log(
+                    "The default value type should be %s", variable.type
+                )
+        return None
+
+
+_FNV_OFFSET = 0xCBF29CE484222325
+_FNV_PRIME = 0x100000001B3
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _fnv1a(data, keyhash=_FNV_OFFSET):
+    for byte in data:
+        keyhash = ((keyhash ^ byte) * _FNV_PRIME) & _MASK64
+    return keyhash
+
+
+def _mix64(keyhash):
+    keyhash ^= keyhash >> 33
+    keyhash = (keyhash * 0xFF51AFD7ED558CCD) & _MASK64
+    keyhash ^= keyhash >> 33
+    keyhash = (keyhash * 0xC4CEB9FE1A85EC53) & _MASK64
+    keyhash ^= keyhash >> 33
+    return keyhash
+
+
+def _encode_column(values):
+    """
+    将 ID 列转换为 UTF-8 编码的定长 bytes 数组，None 转换为空串
+    """
+    if isinstance(values, numpy.ndarray) and values.dtype.kind == "S":
+        return values
+    if isinstance(values, numpy.ndarray) and values.dtype.kind == "U":
+        width = values.dtype.itemsize // 4
+        codes = numpy.ascontiguousarray(values).view(numpy.uint32).reshape(len(values), width)
+        if not codes.size or codes.max() < 0x80:
+            # 全部为 ASCII 时按码位直接转换，比逐个编码快一个数量级
+            return codes.astype(numpy.uint8).view("S%d" % width).reshape(len(values))
+        return numpy.char.encode(values, "utf-8")
+    return numpy.array(
+        [b"" if value is None else str(value).encode("utf-8") for value in values],
+        dtype="S",
+    )
+
+
+def _hash_column(seed, encoded):
+    """
+    与 _mix64(_fnv1a(subject_id, seed)) 逐行一致的向量化实现，每次迭代处理所有 ID 的同一个字节
+    """
+    width = encoded.dtype.itemsize
+    data = numpy.ascontiguousarray(encoded).view(numpy.uint8).reshape(len(encoded), width)
+    lengths = numpy.char.str_len(encoded)
+    prime = numpy.uint64(_FNV_PRIME)
+    keyhash = numpy.full(len(encoded), seed, dtype=numpy.uint64)
+    mixed = numpy.empty_like(keyhash)
+    for column in range(width):
+        numpy.bitwise_xor(keyhash, data[:, column], out=mixed)
+        mixed *= prime
+        numpy.copyto(keyhash, mixed, where=lengths > column)
+    keyhash ^= keyhash >> numpy.uint64(33)
+    keyhash *= numpy.uint64(0xFF51AFD7ED558CCD)
+    keyhash ^= keyhash >> numpy.uint64(33)
+    keyhash *= numpy.uint64(0xC4CEB9FE1A85EC53)
+    keyhash ^= keyhash >> numpy.uint64(33)
+    return keyhash, lengths
+
+
+class _LocalExperiment:
+    """
+    编译后的单个试验：分流比例、各试验组的分桶上界与预先生成的 ExperimentIndex
+    """
+
+    __slots__ = (
+        "seed",
+        "subject",
+        "remote",
+        "traffic",
+        "bounds",
+        "groups",
+        "white_list",
+        "white_groups",
+    )
+
+    def __init__(self, experiment):
+        experiment_id = experiment[EXPERIMENT_ID_KEY]
+        salt = str(experiment.get("salt") or experiment_id)
+        # 按 salt 分隔符与用户 ID 的 UTF-8 编码计算 FNV-1a 哈希，salt 部分预先计算
+        self.seed = _fnv1a((salt + "\x1f").encode("utf-8"))
+        self.subject = experiment.get("subject_id_name") or None
+        self.remote = bool(experiment.get("requires_remote"))
+        self.traffic = int(
+            round(float(experiment.get("traffic", 100)) * LocalEvaluator.BUCKETS / 100)
+        )
+        groups = experiment.get("groups") or ()
+        total = sum(float(group.get("weight", 0)) for group in groups)
+        self.bounds = []
+        self.groups = []
+        self.white_list = {}
+        self.white_groups = []
+        by_id = {}
+        weight = 0.0
+        for group in groups:
+            weight += float(group.get("weight", 0))
+            self.bounds.append(
+                int(round(weight / total * LocalEvaluator.BUCKETS)) if total > 0 else 0
+            )
+            self.groups.append(_LocalExperiment.__compile_group(experiment_id, group, False))
+            by_id[group[EXPERIMENT_GROUP_ID_KEY]] = group
+        for entry in experiment.get("white_list") or ():
+            index = _LocalExperiment.__compile_group(
+                experiment_id, by_id[entry[EXPERIMENT_GROUP_ID_KEY]], True
+            )
+            self.white_groups.append(index)
+            for subject_id in entry.get("ids") or ():
+                self.white_list[subject_id] = index
+
+    @staticmethod
+    def __compile_group(experiment_id, group, is_white_list):
+        return ExperimentIndex(
+            {
+                STATUS_KEY: SUCCESS,
+                RESULTS_KEY: [
+                    {
+                        EXPERIMENT_ID_KEY: experiment_id,
+                        EXPERIMENT_GROUP_ID_KEY: group[EXPERIMENT_GROUP_ID_KEY],
+                        IS_CONTROL_GROUP_KEY: bool(group.get(IS_CONTROL_GROUP_KEY)),
+                        IS_WHITE_LIST_KEY: is_white_list,
+                        VARIABLES_KEY: group.get(VARIABLES_KEY) or [],
+                    }
+                ],
+            }
+        )
+
+    def assign(self, distinct_id, custom_ids):
+        """
+        :return: 命中试验组的 ExperimentIndex，未进入试验时返回 None
+        """
+        if self.subject is None:
+            subject_id = distinct_id
+        else:
+            subject_id = custom_ids.get(self.subject) if custom_ids else None
+            if subject_id is None:
+                return None
+        index = self.white_list.get(subject_id)
+        if index is not None:
+            return index
+        keyhash = _mix64(_fnv1a(str(subject_id).encode("utf-8"), self.seed))
+        if keyhash % LocalEvaluator.BUCKETS >= self.traffic:
+            return None
+        position = bisect_right(self.bounds, (keyhash >> 32) % LocalEvaluator.BUCKETS)
+        if position < len(self.groups):
+            return self.groups[position]
+        return None
+
+    def assign_column(self, columns):
+        """
+        批量分流
+        :param columns: dict，key 为自定义主体名称（None 为 distinct_id），value 为 _encode_column 编码后的 ID 列
+        :return: (positions, choices)，positions 为每个用户命中的 choices 下标，未进入试验为 -1
+        """
+        choices = self.groups + self.white_groups
+        encoded = columns.get(self.subject)
+        if encoded is None:
+            return numpy.full(len(columns[None]), -1, dtype=numpy.int64), choices
+        keyhash, lengths = _hash_column(self.seed, encoded)
+        buckets = numpy.uint64(LocalEvaluator.BUCKETS)
+        positions = numpy.searchsorted(
+            numpy.array(self.bounds, dtype=numpy.uint64),
+            (keyhash >> numpy.uint64(32)) % buckets,
+            side="right",
+        ).astype(numpy.int64)
+        positions[positions >= len(self.groups)] = -1
+        positions[(keyhash % buckets >= self.traffic) | (lengths == 0)] = -1
+        if self.white_list:
+            white_ids = _encode_column(list(self.white_list))
+            white_positions = numpy.array(
+                [
+                    len(self.groups) + self.white_groups.index(index)
+                    for index in self.white_list.values()
+                ],
+                dtype=numpy.int64,
+            )
+            order = numpy.argsort(white_ids)
+            found = numpy.searchsorted(white_ids[order], encoded)
+            found[found >= len(white_ids)] = 0
+            matched = white_ids[order][found] == encoded
+            positions[matched] = white_positions[order][found[matched]]
+        return positions, choices
+
+
+class LocalEvaluator:
+    """
+    本地试验分流：定期拉取全量试验配置，编译为按试验参数名索引的分流结构，
+    按用户 ID 的哈希值在进程内分配试验组，无需逐个用户请求 AB 服务。
+    依赖服务端受众数据的试验（requires_remote）以及配置尚未加载成功时返回 None，由调用方回退到远程请求。
+
+    配置为 JSON，格式如下::
+
+        {
+            "status": "SUCCESS",
+            "experiments": [
+                {
+                    "abtest_experiment_id": "100",
+                    "salt": "100",                # 可选，哈希盐，默认为试验 ID
+                    "subject_id_name": null,      # 可选，自定义主体名称，默认按 distinct_id 分流
+                    "requires_remote": false,     # 可选，为 true 时该试验的变量回退到远程请求
+                    "traffic": 100,               # 可选，进入试验的用户比例，单位为百分比
+                    "groups": [
+                        {
+                            "abtest_experiment_group_id": "0",
+                            "is_control_group": true,
+                            "weight": 50,
+                            "variables": [{"name": "num_test", "type": "INTEGER", "value": "1"}]
+                        }
+                    ],
+                    "white_list": [{"abtest_experiment_group_id": "0", "ids": ["user1"]}]
+                }
+            ]
+        }
+
+    试验组的结果与 AB 服务返回结果格式一致，经 ExperimentIndex 解析后生成相同的 Experiment。
+    """
+
+    BUCKETS = 10000
+    _EMPTY = ExperimentIndex({STATUS_KEY: SUCCESS, RESULTS_KEY: []})
+
+    def __init__(self, load_config, interval=60):
+        """
+        :param load_config: 无参数的函数，返回试验配置的 JSON 字符串或 bytes
+        :param interval: 配置刷新间隔，单位为秒
+        """
+        self._load_config = load_config
+        self._interval = interval
+        self._params = None
+        self._lock = threading.Lock()
+        self.evaluated = 0
+        self.fallbacks = 0
+        self._stopped = threading.Event()
+        self.refresh()
+        self._thread = threading.Thread(
+            target=self.__run, name="SensorsABTestLocalConfig", daemon=True
+        )
+        self._thread.start()
+
+    @staticmethod
+    def compile(config):
+        """
+        :return: dict，key 为试验参数名，value 为包含该参数的 _LocalExperiment 元组
+        """
+        if config.get(STATUS_KEY, SUCCESS) != SUCCESS:
+            raise ValueError("config status is %s" % config.get(STATUS_KEY))
+        params = {}
+        for experiment in config.get("experiments") or ():
+            compiled = _LocalExperiment(experiment)
+            names = set()
+            for group in experiment.get("groups") or ():
+                for variable in group.get(VARIABLES_KEY) or ():
+                    names.add(variable.get("name"))
+            for name in names:
+                params[name] = params.get(name, ()) + (compiled,)
+        return params
+
+    def refresh(self):
+        """
+        重新加载试验配置，失败时继续使用上一次的配置
+        :return: 是否加载成功
+        """
+        try:
+            params = LocalEvaluator.compile(_json_loads(self._load_config()))
+        except Exception as e:
+            _logger.warning("load local evaluation config failed: %s", e)
+            return False
+        self._params = params
+        return True
+
+    def ready(self):
+        return self._params is not None
+
+    def evaluate(self, distinct_id, custom_ids, param_names):
+        """
+        :return: ExperimentIndex，需要回退到远程请求时返回 None
+        """
+        params = self._params
+        experiments = []
+        if params is not None:
+            for param_name in param_names:
+                for experiment in params.get(param_name, ()):
+                    if experiment.remote:
+                        experiments = None
+                        break
+                    if experiment not in experiments:
+                        experiments.append(experiment)
+                if experiments is None:
+                    break
+        if params is None or experiments is None:
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        with self._lock:
+            self.evaluated += 1
+        indexes = []
+        for experiment in experiments:
+            index = experiment.assign(distinct_id, custom_ids)
+            if index is not None:
+                indexes.append(index)
+        if not indexes:
+            return LocalEvaluator._EMPTY
+        if len(indexes) == 1:
+            return indexes[0]
+        results = []
+        variables = {}
+        for index in indexes:
+            results.extend(index.response[RESULTS_KEY])
+            for name, found in index.variables.items():
+                variables[name] = variables.get(name, ()) + found
+        return ExperimentIndex({STATUS_KEY: SUCCESS, RESULTS_KEY: results}, variables)
+
+    def evaluate_batch(self, distinct_ids, param_defaults, custom_ids=None):
+        """
+        使用 NumPy 向量化批量分流，结果与逐个用户调用 evaluate 一致
+        :param distinct_ids: 用户 ID 数组或序列
+        :param param_defaults: 试验变量名称与默认值的映射
+        :param custom_ids: dict，key 为自定义主体名称，value 为与 distinct_ids 等长的 ID 列，缺失的值为 None 或空串
+        :return: dict，key 为试验变量名称，value 为 dict，包含与 Experiment 属性同名的列
+            ab_experiment_id、ab_experiment_group_id、is_control_group、is_white_list、result，
+            均为 dtype=object 的 numpy 数组，未进入试验的行 result 为默认值，其余列为 None
+        """
+        if numpy is None:
+            raise SensorsABException("batch evaluation requires numpy")
+        params = self._params
+        if params is None:
+            raise SensorsABException("local evaluation config is not loaded")
+        columns = {None: _encode_column(distinct_ids)}
+        rows = len(columns[None])
+        for subject, values in (custom_ids or {}).items():
+            if len(values) != rows:
+                raise SensorsABIllegalArgumentsException(
+                    "custom_ids %s should have the same length as distinct_ids" % subject
+                )
+            columns[subject] = _encode_column(values)
+        assignments = {}
+        results = {}
+        for param_name, default_value in param_defaults.items():
+            result = {
+                "ab_experiment_id": numpy.full(rows, None, dtype=object),
+                "ab_experiment_group_id": numpy.full(rows, None, dtype=object),
+                "is_control_group": numpy.full(rows, None, dtype=object),
+                "is_white_list": numpy.full(rows, None, dtype=object),
+                "result": LocalEvaluator.__object_column(rows, default_value),
+            }
+            results[param_name] = result
+            if not _SensorsABTestBase._is_valid_default_value(default_value):
+                continue
+            assigned = numpy.zeros(rows, dtype=bool)
+            for experiment in params.get(param_name, ()):
+                if experiment.remote:
+                    raise SensorsABException(
+                        "%s requires remote evaluation" % param_name
+                    )
+                if experiment not in assignments:
+                    assignments[experiment] = experiment.assign_column(columns)
+                positions, choices = assignments[experiment]
+                for position, index in enumerate(choices):
+                    variable = index.find(param_name, default_value)
+                    if variable is None:
+                        continue
+                    selected = (positions == position) & ~assigned
+                    assigned |= selected
+                    for name, value in (
+                            ("ab_experiment_id", variable.ab_experiment_id),
+                            ("ab_experiment_group_id", variable.ab_experiment_group_id),
+                            ("is_control_group", variable.is_control_group),
+                            ("is_white_list", variable.is_white_list),
+                            ("result", variable.result()),
+                    ):
+                        result[name][selected] = LocalEvaluator.__object_column(1, value)
+        return results
+
+    @staticmethod
+    def __object_column(rows, value):
+        # JSON 变量的值可能是 list，直接赋值给数组切片时会被展开，先用 fill 放入 object 数组
+        column = numpy.empty(rows, dtype=object)
+        column.fill(value)
+        return column
+
+    def __run(self):
+        while not self._stopped.wait(self._interval):
+            self.refresh()
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class WarmUpTask:
+    """
+    缓存预热任务，由 SensorsABTest.warm_up 创建，可查询进度、等待完成或取消
+    """
+
+    def __init__(
+            self, users, fetch, concurrency, rate_limit, timeout_seconds, progress_callback
+    ):
+        self._users = users
+        self._fetch = fetch
+        self._concurrency = concurrency
+        self._rate_limit = rate_limit
+        self._timeout_seconds = timeout_seconds
+        self._progress_callback = progress_callback
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._thread = threading.Thread(
+            target=self.__run, name="SensorsABTestWarmUp", daemon=True
+        )
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    @property
+    def completed(self):
+        """已处理完成的用户数"""
+        return self.succeeded + self.failed
+
+    def start(self):
+        self._thread.start()
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        等待预热完成
+        :return: 是否已完成
+        """
+        return self._finished.wait(timeout)
+
+    def cancel(self):
+        """
+        取消预热，已发出的请求仍会完成
+        """
+        self._cancelled.set()
+
+    def __run(self):
+        slots = threading.BoundedSemaphore(self._concurrency)
+        interval = 1.0 / self._rate_limit if self._rate_limit else 0
+        next_time = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+                for user in self._users:
+                    if interval:
+                        delay = next_time - time.monotonic()
+                        if delay > 0 and self._cancelled.wait(delay):
+                            break
+                        next_time = max(next_time, time.monotonic() - interval) + interval
+                    slots.acquire()
+                    if self._cancelled.is_set():
+                        slots.release()
+                        break
+                    self.submitted += 1
+                    executor.submit(self.__fetch_user, user, slots)
+        except Exception as e:
+            _logger.warning("warm up failed: %s", e)
+        finally:
+            self._finished.set()
+
+    def __fetch_user(self, user, slots):
+        try:
+            ok = self._fetch(user, self._timeout_seconds)
+        except Exception as e:
+            _logger.warning("warm up user failed: %s", e)
+            ok = False
+        finally:
+            slots.release()
+        with self._lock:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            if self._progress_callback is not None:
+                try:
+                    self._progress_callback(self)
+                except Exception as e:
+                    _logger.warning("warm up progress callback failed: %s", e)
+
+
+class TriggerQueue:
+    """
+    $ABTestTrigger 事件的有界发送队列，由后台线程批量交给 SensorsAnalytics 发送，
+    请求线程无需等待事件上报
+    """
+
+    DROP = "drop"
+    BLOCK = "block"
+
+    _STOP = object()
+
+    def __init__(self, sa, maxsize=10000, policy=DROP, batch_size=100, on_sent=None):
+        """
+        :param sa: SA SDK 对象
+        :param maxsize: 队列最大长度
+        :param policy: 队列已满时的策略，drop 丢弃事件，block 阻塞直到队列有空位
+        :param batch_size: 后台线程每批发送的最大事件数
+        :param on_sent: 事件发送成功后在后台线程中调用，参数为事件的去重 key
+        """
+        self._sa = sa
+        self._on_sent = on_sent
+        self._queue = queue.Queue(maxsize)
+        self._block = policy == TriggerQueue.BLOCK
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(
+            target=self.__run, name="SensorsABTestTrigger", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, key, distinct_id, properties, is_login_id):
+        """
+        :param key: 去重 key，队列中已有相同 key 的事件时不再加入
+        :return: 是否加入队列
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            if self._closed:
+                self.dropped += 1
+                return False
+            self._pending.add(key)
+        try:
+            self._queue.put((key, distinct_id, properties, is_login_id), self._block)
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+                self.dropped += 1
+            _SensorsABTestBase.ab_log("$ABTestTrigger queue is full, event dropped")
+            return False
+        return True
+
+    def depth(self):
+        """
+        队列中待发送的事件数
+        """
+        return self._queue.qsize()
+
+    def flush(self):
+        """
+        等待已加入队列的事件全部交给 SensorsAnalytics
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        停止接收事件，发送队列中剩余的事件后结束后台线程
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(TriggerQueue._STOP)
+        self._thread.join()
+        # block 策略下关闭时仍在等待的调用可能排在结束标记之后
+        remaining = []
+        while True:
+            try:
+                remaining.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self.__send(remaining)
+
+    def __run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not self.__send(batch):
+                return
+
+    def __send(self, batch):
+        running = True
+        for item in batch:
+            if item is TriggerQueue._STOP:
+                running = False
+            else:
+                key, distinct_id, properties, is_login_id = item
+                try:
+                    self._sa.track(distinct_id, EVENT_TYPE, properties, is_login_id)
+                    sent = True
+                except Exception as e:
+                    _logger.warning("track $ABTestTrigger failed: %s", e)
+                    sent = False
+                if sent and self._on_sent is not None:
+                    try:
+                        self._on_sent(key)
+                    except Exception as e:
+                        _logger.warning("$ABTestTrigger sent callback failed: %s", e)
+                with self._lock:
+                    self._pending.discard(key)
+                    if sent:
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+            self._queue.task_done()
+        return running
+
+
+class Endpoint:
+    """
+    AB 服务地址及其请求统计，latency 与 error_rate 为指数加权移动平均
+    """
+
+    __slots__ = (
+        "url",
+        "latency",
+        "error_rate",
+        "failures",
+        "failed_at",
+        "samples",
+        "selected_at",
+        "recorded_at",
+    )
+
+    def __init__(self, url, samples=100):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.failed_at = 0
+        self.samples = deque(maxlen=samples)
+        self.selected_at = None
+        self.recorded_at = None
+
+
+class EndpointSelector:
+    """
+    多个 AB 服务地址的负载均衡：记录每个地址的请求耗时与失败情况，选择健康地址中预期耗时最短的一个，
+    预期耗时为平均耗时 / (1 - 错误率)，即计入失败重试的代价。
+    连续失败 failure_threshold 次的地址在 retry_time 秒内视为不健康，之后重新参与选择；
+    尚无耗时数据的地址优先选择。
+    未被选中的地址的平均耗时与错误率按 decay_time 秒的半衰期衰减，因此慢过的地址会被定期重新探测，
+    恢复后重新参与分流
+    """
+
+    def __init__(
+            self,
+            urls,
+            alpha=0.2,
+            failure_threshold=3,
+            retry_time=10,
+            decay_time=30,
+            timer=time.monotonic,
+    ):
+        """
+        :param urls: AB 服务地址列表
+        :param alpha: 平均耗时与错误率的平滑系数
+        :param failure_threshold: 视为不健康的连续失败次数
+        :param retry_time: 不健康地址重新参与选择的等待时间，单位为秒
+        :param decay_time: 空闲地址的平均耗时与错误率的半衰期，单位为秒
+        :param timer: 时钟函数
+        """
+        self._endpoints = [Endpoint(url) for url in urls]
+        self._alpha = alpha
+        self._failure_threshold = failure_threshold
+        self._retry_time = retry_time
+        self._decay_time = decay_time
+        self._timer = timer
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def __healthy(self, endpoint, now):
+        return (
+                endpoint.failures < self._failure_threshold
+                or now - endpoint.failed_at >= self._retry_time
+        )
+
+    def __decay(self, since, now):
+        if since is None:
+            return 1.0
+        return 0.5 ** ((now - since) / self._decay_time)
+
+    def __expected_latency(self, endpoint, now):
+        if endpoint.latency is None:
+            return 0
+        last_used = max(endpoint.selected_at or 0, endpoint.recorded_at or 0)
+        decay = self.__decay(last_used, now)
+        return endpoint.latency * decay / max(1 - endpoint.error_rate * decay, 0.01)
+
+    def select(self, exclude=None):
+        """
+        :param exclude: 不参与选择的 Endpoint
+        :return: Endpoint，没有可选地址时返回 None
+        """
+        endpoints = self._endpoints
+        if len(endpoints) == 1 and exclude is None:
+            return endpoints[0]
+        now = self._timer()
+        with self._lock:
+            candidates = [e for e in endpoints if e is not exclude]
+            healthy = [e for e in candidates if self.__healthy(e, now)]
+            endpoint = min(
+                healthy or candidates,
+                key=lambda e: self.__expected_latency(e, now),
+                default=None,
+            )
+            if endpoint is not None:
+                # 选中后不再按空闲时间衰减，一次探测期间其他请求仍选择原来的地址
+                endpoint.selected_at = now
+            return endpoint
+
+    def record(self, endpoint, latency, ok):
+        """
+        记录一次请求结果，上次记录之后的空闲时间先按半衰期衰减平均耗时与错误率
+        :param latency: 请求耗时，单位为秒
+        :param ok: 请求是否成功，失败的请求不计入耗时
+        """
+        alpha = self._alpha
+        now = self._timer()
+        with self._lock:
+            decay = self.__decay(endpoint.recorded_at, now)
+            endpoint.recorded_at = now
+            endpoint.error_rate *= decay
+            endpoint.error_rate += alpha * ((0.0 if ok else 1.0) - endpoint.error_rate)
+            if ok:
+                endpoint.failures = 0
+                endpoint.samples.append(latency)
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency *= decay
+                    endpoint.latency += alpha * (latency - endpoint.latency)
+            else:
+                endpoint.failures += 1
+                endpoint.failed_at = now
+
+    def percentile(self, endpoint, percent, min_samples=20):
+        """
+        :return: 最近成功请求耗时的百分位数，样本不足 min_samples 时返回 None
+        """
+        with self._lock:
+            samples = sorted(endpoint.samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[int(round(percent / 100.0 * (len(samples) - 1)))]
+
+    def stats(self):
+        """
+        :return: list，每个地址的 url、latency_ms、error_rate 与 healthy
+        """
+        now = self._timer()
+        with self._lock:
+            return [
+                {
+                    "url": e.url,
+                    "latency_ms": None if e.latency is None else e.latency * 1000,
+                    "error_rate": e.error_rate,
+                    "healthy": self.__healthy(e, now),
+                }
+                for e in self._endpoints
+            ]
+
+
+class CircuitBreaker:
+    """
+    AB 服务熔断器：连续失败次数达到阈值后打开，打开期间请求直接失败并返回默认值，不再等待超时；
+    打开 recovery_time 秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+            self, failure_threshold=5, recovery_time=10, on_state_change=None, timer=time.monotonic
+    ):
+        """
+        :param failure_threshold: 打开熔断器的连续失败次数
+        :param recovery_time: 打开后进入半开状态的等待时间，单位为秒
+        :param on_state_change: 状态变化时调用，参数为 (old_state, new_state)
+        :param timer: 时钟函数
+        """
+        self._failure_threshold = failure_threshold
+        self._recovery_time = recovery_time
+        self._on_state_change = on_state_change
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if (
+                    self._state == CircuitBreaker.OPEN
+                    and self._timer() - self._opened_at >= self._recovery_time
+            ):
+                return CircuitBreaker.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        是否放行请求，放行后必须调用 record_success 或 record_failure
+        """
+        transition = None
+        with self._lock:
+            if self._state == CircuitBreaker.OPEN:
+                if self._timer() - self._opened_at < self._recovery_time:
+                    self.rejected += 1
+                    return False
+                transition = self.__transition(CircuitBreaker.HALF_OPEN)
+            if self._state == CircuitBreaker.HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+        self.__notify(transition)
+        return True
+
+    def record_success(self):
+        transition = None
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self._state != CircuitBreaker.CLOSED:
+                transition = self.__transition(CircuitBreaker.CLOSED)
+        self.__notify(transition)
+
+    def record_failure(self):
+        transition = None
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == CircuitBreaker.HALF_OPEN or (
+                    self._state == CircuitBreaker.CLOSED
+                    and self._failures >= self._failure_threshold
+            ):
+                self._opened_at = self._timer()
+                self.opened += 1
+                transition = self.__transition(CircuitBreaker.OPEN)
+        self.__notify(transition)
+
+    def cancel(self):
+        """
+        放行的请求被取消、没有结果时调用，半开状态下允许重新探测
+        """
+        with self._lock:
+            self._probing = False
+
+    def __transition(self, state):
+        old_state, self._state = self._state, state
+        return old_state, state
+
+    def __notify(self, transition):
+        if transition is None:
+            return
+        _logger.warning("SAABTesting circuit breaker %s -> %s", *transition)
+        if self._on_state_change is not None:
+            try:
+                self._on_state_change(*transition)
+            except Exception as e:
+                _logger.warning("circuit breaker callback failed: %s", e)
+
+
+class SingleFlight:
+    """
+    合并相同 key 的并发调用：同一时刻每个 key 只执行一次，其余调用等待并共享其结果
+    """
+
+    class _Call:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def is_running(self, key):
+        return key in self._calls
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = SingleFlight._Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class EventCacheManager:
+    def __init__(
+            self,
+            time,
+            size,
+            shards=16,
+            backend=None,
+            error_rate=0,
+            timer=time.monotonic,
+    ):
+        """
+        :param error_rate: 大于 0 时使用按周期轮换的 Bloom 过滤器，内存固定，
+            误判率约为 error_rate（误判时不触发事件），周期为 time 分钟并与本地零点对齐；
+            time 为 0 时不使用 Bloom 过滤器
+        """
+        self._filter = False
+        if size != 0:
+            # 进程内缓存只保存 key 的 64 位哈希值，外部存储后端保存完整 key
+            self._hashed = backend is None
+            if backend is not None:
+                self._cache = backend.create("event", size, time * 60)
+            elif error_rate and time > 0:
+                self._filter = True
+                self._cache = RotatingBloomFilter(size, error_rate, time * 60)
+            else:
+                self._cache = HashedTTLSet(size, time * 60, timer=timer, stripes=shards)
+
+    def dump(self):
+        """
+        :return: [(key, seconds_to_live)]，进程内缓存的 key 为哈希值；Bloom 过滤器不保存快照
+        """
+        if hasattr(self, "_cache") and not self._filter:
+            if self._hashed:
+                return self._cache.dump()
+            return [(list(key), seconds) for key, _, seconds in self._cache.dump()]
+        return []
+
+    def load(self, entries):
+        if hasattr(self, "_cache") and not self._filter:
+            if self._hashed:
+                self._cache.load(
+                    [
+                        (
+                            key
+                            if isinstance(key, int)
+                            else EventCacheManager.__hash_key(*_freeze_key(key)),
+                            seconds,
+                        )
+                        for key, seconds in entries
+                    ]
+                )
+            else:
+                self._cache.load(
+                    [
+                        (_freeze_key(key), "", seconds)
+                        for key, seconds in entries
+                        if not isinstance(key, int)
+                    ]
+                )
+
+    def close(self):
+        cache = getattr(self, "_cache", None)
+        if hasattr(cache, "close"):
+            cache.close()
+
+    def skipped(self):
+        """
+        :return: 外部存储后端因条目超过槽位大小而未保存的次数（本进程），进程内缓存返回 None
+        """
+        return getattr(getattr(self, "_cache", None), "skipped", None)
+
+    def filter_stats(self):
+        """
+        :return: Bloom 过滤器模式下返回 (fill_ratio, error_rate)，否则返回 None
+        """
+        if self._filter:
+            return self._cache.fill_ratio(), self._cache.error_rate()
+        return None
+
+    def is_event_exist(self, distinct_id, is_login_id, ab_experiment_id, custom_ids):
+        if hasattr(self, "_cache"):
+            return (
+                    self.__generate_key(
+                        distinct_id, is_login_id, ab_experiment_id, custom_ids
+                    )
+                    in self._cache
+            )
+        else:
+            return False
+
+    def set_cache(self, distinct_id, is_login_id, ab_experiment_id, custom_ids):
+        if hasattr(self, "_cache"):
+            key = self.__generate_key(
+                distinct_id, is_login_id, ab_experiment_id, custom_ids
+            )
+            if self._hashed:
+                self._cache.add(key)
+            else:
+                self._cache[key] = ""
+
+    def __generate_key(self, distinct_id, is_login_id, ab_experiment_id, custom_ids):
+        ids_key = _custom_ids_key(custom_ids)
+        if self._hashed:
+            return EventCacheManager.__hash_key(
+                distinct_id, is_login_id, ab_experiment_id, ids_key
+            )
+        return _HashedTuple((distinct_id, is_login_id, ab_experiment_id, ids_key))
+
+    @staticmethod
+    def __hash_key(distinct_id, is_login_id, ab_experiment_id, ids_key):
+        return key_hash(
+            distinct_id, is_login_id, ab_experiment_id, *chain.from_iterable(ids_key)
+        )
+
+
+class ExperimentCacheManager:
+    # 缓存查询结果的统计项
+    HIT = "hit"
+    NEGATIVE_HIT = "negative_hit"
+    STALE_HIT = "stale_hit"
+    FAILURE_HIT = "failure_hit"
+    MISS = "miss"
+
+    def __init__(
+            self,
+            cache_time,
+            cache_size,
+            shards=16,
+            stale_time=0,
+            timer=time.monotonic,
+            backend=None,
+            failure_time=0,
+    ):
+        self._counts = dict.fromkeys(
+            (
+                ExperimentCacheManager.HIT,
+                ExperimentCacheManager.NEGATIVE_HIT,
+                ExperimentCacheManager.STALE_HIT,
+                ExperimentCacheManager.FAILURE_HIT,
+                ExperimentCacheManager.MISS,
+            ),
+            0,
+        )
+        self._counts_lock = threading.Lock()
+        if cache_size != 0:
+            # 进程内缓存直接保存 ExperimentIndex，外部存储后端只能保存原始返回结果，
+            # 读取时由后端解码并在本进程内按条目版本缓存解码结果
+            self._compiled = backend is None
+            if backend is not None:
+                self._experiment_result_cache = backend.create(
+                    "experiment",
+                    cache_size,
+                    (cache_time + stale_time) * 60,
+                    decoder=ExperimentCacheManager.__decode,
+                )
+            else:
+                self._experiment_result_cache = ShardedTTLCache(
+                    cache_size,
+                    ttl=(cache_time + stale_time) * 60,
+                    timer=timer,
+                    shards=shards,
+                    shardkey=itemgetter(0),
+                )
+            self._timer = self._experiment_result_cache.timer
+            self._fresh_time = cache_time * 60
+            self._stale_time = stale_time * 60
+            if failure_time > 0:
+                # 请求失败的负缓存只保存在进程内，有效期很短
+                self._failure_cache = ShardedTTLCache(
+                    cache_size,
+                    ttl=failure_time,
+                    timer=timer,
+                    shards=shards,
+                    shardkey=itemgetter(0),
+                )
+
+    def dump(self):
+        """
+        :return: [(key, experiment, seconds_to_live, seconds_to_stale, complete)]
+        """
+        if hasattr(self, "_experiment_result_cache"):
+            now = self._timer()
+            return [
+                (
+                    list(key),
+                    experiment.response if self._compiled else experiment,
+                    seconds,
+                    fresh_until - now,
+                    complete,
+                )
+                for key, (experiment, fresh_until, complete), seconds
+                in self._experiment_result_cache.dump()
+            ]
+        return []
+
+    def load(self, entries):
+        """
+        :param entries: dump 返回的条目，缺少 complete 的旧格式条目按不完整结果处理
+        """
+        if hasattr(self, "_experiment_result_cache"):
+            now = self._timer()
+            self._experiment_result_cache.load(
+                [
+                    (
+                        _freeze_key(key),
+                        (
+                            ExperimentIndex(experiment) if self._compiled else experiment,
+                            now + fresh_seconds,
+                            bool(complete and complete[0]),
+                        ),
+                        seconds,
+                    )
+                    for key, experiment, seconds, fresh_seconds, *complete in entries
+                ]
+            )
+
+    def close(self):
+        cache = getattr(self, "_experiment_result_cache", None)
+        if hasattr(cache, "close"):
+            cache.close()
+
+    def stats(self):
+        """
+        :return: dict，各类查询结果的次数，hit 为缓存结果包含全部试验变量，
+            negative_hit 为缓存结果是完整结果但不包含部分试验变量（用户未进入试验），
+            stale_hit 为命中宽限期内的缓存结果，miss 为未命中，
+            failure_hit 为未命中后因近期请求失败直接返回默认值；
+            使用外部存储后端时还包含 skipped，结果超过槽位大小未能写入缓存的次数（本进程）
+        """
+        with self._counts_lock:
+            stats = dict(self._counts)
+        skipped = getattr(getattr(self, "_experiment_result_cache", None), "skipped", None)
+        if skipped is not None:
+            stats["skipped"] = skipped
+        return stats
+
+    @staticmethod
+    def __decode(entry):
+        experiment_result, fresh_until, complete = entry
+        return ExperimentIndex(experiment_result), fresh_until, complete
+
+    def __count(self, outcome):
+        with self._counts_lock:
+            self._counts[outcome] += 1
+
+    def get_cache_experiment_result(
+            self, distinct_id, is_login, custom_ids, experiment_name
+    ):
+        return self.get_cache_experiment_results(
+            distinct_id, is_login, custom_ids, [experiment_name]
+        )
+
+    def get_cache_experiment_results(
+            self, distinct_id, is_login, custom_ids, experiment_names, properties=None
+    ):
+        """
+        未过期的缓存结果可以确定全部试验变量的结果时返回缓存结果，否则返回 None
+        """
+        experiment_result, stale = self.lookup_experiment_results(
+            distinct_id, is_login, custom_ids, experiment_names, properties
+        )
+        if stale:
+            return None
+        return experiment_result
+
+    def lookup_experiment_results(
+            self, distinct_id, is_login, custom_ids, experiment_names, properties=None
+    ):
+        """
+        查询可以确定全部试验变量结果的缓存结果：缓存结果包含全部试验变量，
+        或缓存结果是未指定试验的完整结果，不包含的试验变量说明用户未进入该试验
+        :param properties: 本次请求的自定义属性，带自定义属性时完整结果不能说明用户未进入按属性定向的试验
+        :return: (experiment_result, stale)，未命中时 experiment_result 为 None；
+            stale 为 True 表示结果已超过试验缓存时间，处于宽限期内
+        """
+        if hasattr(self, "_experiment_result_cache"):
+            key = self.__generate_key(distinct_id, is_login, custom_ids)
+            entry = self._experiment_result_cache.get(key)
+            if entry is not None:
+                experiment_result, fresh_until, complete = entry
+                covered = experiment_result.covers(experiment_names)
+                if covered or (
+                        complete and not _SensorsABTestBase._properties_handler(properties)
+                ):
+                    # 未开启宽限期时缓存时间与 TTL 相同，存活的结果都按未过期处理
+                    stale = self._stale_time > 0 and not (self._timer() < fresh_until)
+                    if stale:
+                        self.__count(ExperimentCacheManager.STALE_HIT)
+                    elif covered:
+                        self.__count(ExperimentCacheManager.HIT)
+                    else:
+                        self.__count(ExperimentCacheManager.NEGATIVE_HIT)
+                    if _logger.isEnabledFor(logging.DEBUG):
+                        _logger.debug("return cache")
+                    return experiment_result, stale
+        self.__count(ExperimentCacheManager.MISS)
+        return None, False
+
+    def set_cache_experiment_result(
+            self, distinct_id, is_login_id, custom_ids, experiment, complete=False
+    ):
+        """
+        :param complete: 是否为未指定试验的完整结果，完整结果中不包含的试验变量按用户未进入试验处理
+        """
+        if hasattr(self, "_experiment_result_cache"):
+            key = self.__generate_key(distinct_id, is_login_id, custom_ids)
+            self._experiment_result_cache[key] = (
+                experiment if self._compiled else experiment.response,
+                self._timer() + self._fresh_time,
+                complete,
+            )
+            if hasattr(self, "_failure_cache"):
+                self._failure_cache.pop(key)
+
+    def is_fetch_failed(self, distinct_id, is_login_id, custom_ids):
+        """
+        用户近期的试验请求是否失败，失败负缓存有效期内不再重复请求
+        """
+        if hasattr(self, "_failure_cache"):
+            key = self.__generate_key(distinct_id, is_login_id, custom_ids)
+            if key in self._failure_cache:
+                self.__count(ExperimentCacheManager.FAILURE_HIT)
+                return True
+        return False
+
+    def set_fetch_failed(self, distinct_id, is_login_id, custom_ids):
+        if hasattr(self, "_failure_cache"):
+            key = self.__generate_key(distinct_id, is_login_id, custom_ids)
+            self._failure_cache[key] = True
+
+    def __generate_key(self, distinct_id, is_login, custom_ids):
+        return _HashedTuple((distinct_id, is_login, _custom_ids_key(custom_ids)))
@@ -0,0 +1,579 @@
+# -*- coding: UTF-8 -*-
+"""
+基于 asyncio 的 SDK，适用于 aiohttp、FastAPI 等异步服务，网络请求不会阻塞事件循环
+"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from sensorsabtesting.abtest import (
+    SensorsABException,
+    SensorsABIllegalArgumentsException,
+    _SensorsABTestBase,
+    _logger,
+)
+
+__all__ = (
+    "AsyncSensorsABTest",
+    "AsyncSingleFlight",
+    "AsyncTransport",
+    "StreamTransport",
+    "AiohttpTransport",
+)
+
+
+class AsyncTransport:
+    """
+    异步传输层接口，自定义传输层需继承此类并实现 post 与 close
+    """
+
+    async def post(self, url, body, headers, timeout):
+        """
+        发送 POST 请求
+        :param url: 请求地址
+        :param body: 请求体，bytes
+        :param headers: 请求头，dict
+        :param timeout: 超时时间，单位为秒
+        :return: (status, data)，data 为响应体 bytes
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class StreamTransport(AsyncTransport):
+    """
+    基于 asyncio streams 的 HTTP/1.1 传输层，无第三方依赖，复用 keep-alive 连接
+    """
+
+    def __init__(self, pool_size=16, ssl_context=None, max_connections=None):
+        """
+        :param pool_size: 每个地址保留的最大空闲连接数
+        :param ssl_context: https 请求使用的 ssl.SSLContext，默认使用系统配置
+        :param max_connections: 每个地址同时进行的最大请求数，默认同 pool_size，
+            超出的请求排队等待，等待时间计入请求超时
+        """
+        self._pool_size = pool_size
+        self._ssl_context = ssl_context
+        self._max_connections = max_connections or pool_size
+        self._idle = {}
+        self._limits = {}
+
+    async def post(self, url, body, headers, timeout):
+        return await asyncio.wait_for(self.__post(url, body, headers), timeout)
+
+    async def close(self):
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+
+    async def __post(self, url, body, headers):
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        address = (parts.hostname, parts.port or (443 if https else 80), https)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        lines = ["POST %s HTTP/1.1" % path, "Host: %s" % parts.netloc]
+        for name, value in headers.items():
+            if name.lower() not in ("host", "content-length", "connection"):
+                lines.append("%s: %s" % (name, value))
+        lines.append("Content-Length: %d" % len(body))
+        lines.append("Connection: keep-alive")
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+        limit = self._limits.get(address)
+        if limit is None:
+            limit = self._limits[address] = asyncio.Semaphore(self._max_connections)
+        async with limit:
+            return await self.__send(address, request)
+
+    async def __send(self, address, request):
+        idle = self._idle.get(address)
+        if idle:
+            try:
+                return await self.__exchange(address, idle.pop(), request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # 空闲连接已被服务端关闭，新建连接重试一次
+                pass
+        if address[2]:
+            connection = await asyncio.open_connection(
+                address[0], address[1], ssl=self._ssl_context or True
+            )
+        else:
+            connection = await asyncio.open_connection(address[0], address[1])
+        return await self.__exchange(address, connection, request)
+
+    async def __exchange(self, address, connection, request):
+        reader, writer = connection
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readuntil(b"\r\n")
+            status = int(status_line.split(None, 2)[1])
+            response_headers = {}
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                if line == b"\r\n":
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            keep_alive = response_headers.get("connection", "").lower() != "close"
+            if "chunked" in response_headers.get("transfer-encoding", "").lower():
+                data = await StreamTransport.__read_chunked(reader)
+            elif "content-length" in response_headers:
+                data = await reader.readexactly(
+                    int(response_headers["content-length"])
+                )
+            else:
+                data = await reader.read()
+                keep_alive = False
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and len(self._idle.setdefault(address, [])) < self._pool_size:
+            self._idle[address].append(connection)
+        else:
+            writer.close()
+        return status, data
+
+    @staticmethod
+    async def __read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+
+class AiohttpTransport(AsyncTransport):
+    """
+    基于 aiohttp 的传输层，需要安装 aiohttp
+    """
+
+    def __init__(self, session=None):
+        """
+        :param session: aiohttp.ClientSession，不传时在首次请求时创建，并在 close 时关闭
+        """
+        if aiohttp is None:
+            raise SensorsABException("aiohttp is not installed")
+        self._session = session
+        self._own_session = session is None
+
+    async def post(self, url, body, headers, timeout):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        async with self._session.post(
+                url,
+                data=body,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            return response.status, await response.read()
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight 的 asyncio 版本，同一事件循环中相同 key 的并发协程只执行一次
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def is_running(self, key):
+        return key in self._calls
+
+    async def do(self, key, func, *args):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield 避免某个等待方被取消时连带取消共享的请求
+            return await asyncio.shield(future)
+        self.calls += 1
+        future = self._calls[key] = asyncio.ensure_future(func(*args))
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                del self._calls[key]
+            else:
+                future.add_done_callback(lambda _: self._calls.pop(key, None))
+
+
+class AsyncSensorsABTest(_SensorsABTestBase):
+    def __init__(
+            self,
+            base_url,
+            sa,
+            event_cache_time=1440,
+            event_cache_size=4096,
+            experiment_cache_size=4096,
+            experiment_cache_time=1440,
+            enable_event_cache=True,
+            enable_log=False,
+            cache_shards=16,
+            transport=None,
+            experiment_stale_time=0,
+            cache_snapshot_file=None,
+            cache_backend=None,
+            trigger_queue_size=0,
+            trigger_queue_policy="drop",
+            event_cache_error_rate=0,
+            cache_clock_resolution=0,
+            experiment_failure_cache_time=0,
+            circuit_breaker_threshold=0,
+            circuit_breaker_recovery_time=10,
+            circuit_breaker_callback=None,
+    ):
+        """
+        初始化 SDK，参数含义同 SensorsABTest，base_url 同样可以传入多个地址，暂不支持对冲请求
+        :param transport: AsyncTransport 对象，默认为 StreamTransport()
+
+        $ABTestTrigger 事件默认通过 sa 同步发送，异步服务中建议设置 trigger_queue_size 由后台线程发送，
+        或 sa 使用 AsyncBatchConsumer。事件队列的 block 策略会阻塞事件循环，建议使用 drop 策略。
+        """
+        _SensorsABTestBase.__init__(
+            self,
+            base_url,
+            sa,
+            event_cache_time,
+            event_cache_size,
+            experiment_cache_size,
+            experiment_cache_time,
+            enable_event_cache,
+            enable_log,
+            cache_shards,
+            experiment_stale_time,
+            cache_snapshot_file,
+            cache_backend,
+            trigger_queue_size,
+            trigger_queue_policy,
+            event_cache_error_rate,
+            cache_clock_resolution,
+            experiment_failure_cache_time,
+            circuit_breaker_threshold,
+            circuit_breaker_recovery_time,
+            circuit_breaker_callback,
+        )
+        if transport is None:
+            transport = StreamTransport()
+        elif not isinstance(transport, AsyncTransport):
+            raise SensorsABIllegalArgumentsException(
+                "transport type is not AsyncTransport, init failed"
+            )
+        self._transport = transport
+        self._single_flight = AsyncSingleFlight()
+        self._refresh_tasks = set()
+
+    async def async_fetch_ab_test(
+            self,
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            properties={},
+    ):
+        """
+        立即从服务端请求，忽略内存缓存，参数含义同 SensorsABTest.async_fetch_ab_test
+        :param timeout_seconds: 网络请求超时等待时间，单位为秒
+        :return: Experiment
+        """
+        return await self.__fetch_ab(
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            False,
+            properties,
+        )
+
+    async def fast_fetch_ab_test(
+            self,
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            properties={},
+    ):
+        """
+        优先从内存获取试验，参数含义同 SensorsABTest.fast_fetch_ab_test
+        :param timeout_seconds: 网络请求超时等待时间，单位为秒
+        :return: Experiment
+        """
+        return await self.__fetch_ab(
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            True,
+            properties,
+        )
+
+    async def fetch_ab_tests(
+            self,
+            distinct_id,
+            is_login_id,
+            param_defaults,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            properties={},
+            enable_cache=True,
+    ):
+        """
+        一次获取多个试验变量的结果，参数含义同 SensorsABTest.fetch_ab_tests
+        :return: dict，key 为试验变量名称，value 为 Experiment
+        """
+        return await self.__fetch_abs(
+            distinct_id,
+            is_login_id,
+            param_defaults,
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            enable_cache,
+            properties,
+        )
+
+    async def close(self):
+        if self._refresh_tasks:
+            await asyncio.gather(*self._refresh_tasks, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, self._close_trigger_queue)
+        self._save_cache_snapshot()
+        self._close_caches()
+        await self._transport.close()
+
+    async def __fetch_ab(
+            self,
+            distinct_id,
+            is_login_id,
+            param_name,
+            default_value,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            enable_cache=False,
+            properties={},
+    ):
+        if not param_name or not isinstance(param_name, str):
+            raise SensorsABIllegalArgumentsException("param_name is empty or not str")
+        results = await self.__fetch_abs(
+            distinct_id,
+            is_login_id,
+            {param_name: default_value},
+            enable_auto_track_event,
+            timeout_seconds,
+            custom_ids,
+            enable_cache,
+            properties,
+        )
+        return results[param_name]
+
+    async def __fetch_abs(
+            self,
+            distinct_id,
+            is_login_id,
+            param_defaults,
+            enable_auto_track_event=True,
+            timeout_seconds=3.0,
+            custom_ids={},
+            enable_cache=True,
+            properties={},
+    ):
+        results, valid_defaults = self._prepare_fetch(
+            distinct_id, is_login_id, param_defaults, custom_ids
+        )
+        if not valid_defaults:
+            return results
+        r_timeout = AsyncSensorsABTest._request_timeout(timeout_seconds)
+        if not isinstance(r_timeout, (int, float)):
+            AsyncSensorsABTest.ab_log("timeout_seconds should be seconds, use 3")
+            r_timeout = 3
+        for request_defaults, experiment_name in AsyncSensorsABTest._split_requests(
+                valid_defaults, properties
+        ):
+            experiment = await self.__load_experiment(
+                distinct_id,
+                is_login_id,
+                list(request_defaults),
+                r_timeout,
+                custom_ids,
+                enable_cache,
+                properties,
+                experiment_name,
+            )
+            results.update(
+                self._convert_experiments(
+                    experiment, distinct_id, is_login_id, request_defaults
+                )
+            )
+        if enable_auto_track_event:
+            self._track_ab_triggers(results, custom_ids)
+        return results
+
+    async def __load_experiment(
+            self,
+            distinct_id,
+            is_login_id,
+            param_names,
+            timeout_seconds,
+            custom_ids,
+            enable_cache,
+            properties,
+            experiment_name,
+    ):
+        if enable_cache:
+            experiment, stale = self._experiment_cache_manager.lookup_experiment_results(
+                distinct_id, is_login_id, custom_ids, param_names, properties
+            )
+            flight_key = AsyncSensorsABTest._flight_key(
+                distinct_id, is_login_id, custom_ids, properties, experiment_name
+            )
+            if experiment and stale:
+                if not self._single_flight.is_running(flight_key):
+                    task = asyncio.ensure_future(
+                        self._single_flight.do(
+                            flight_key,
+                            self.__fetch_and_cache,
+                            distinct_id,
+                            is_login_id,
+                            timeout_seconds,
+                            custom_ids,
+                            properties,
+                            experiment_name,
+                        )
+                    )
+                    self._refresh_tasks.add(task)
+                    task.add_done_callback(self._refresh_tasks.discard)
+            elif not experiment and not self._experiment_cache_manager.is_fetch_failed(
+                    distinct_id, is_login_id, custom_ids
+            ):
+                experiment = await self._single_flight.do(
+                    flight_key,
+                    self.__fetch_and_cache,
+                    distinct_id,
+                    is_login_id,
+                    timeout_seconds,
+                    custom_ids,
+                    properties,
+                    experiment_name,
+                )
+        else:
+            experiment = await self.__getABTestByHttp(
+                distinct_id,
+                is_login_id,
+                timeout_seconds,
+                custom_ids,
+                properties,
+                experiment_name,
+            )
+        return experiment
+
+    async def __fetch_and_cache(
+            self,
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            properties,
+            experiment_name,
+    ):
+        experiment = await self.__getABTestByHttp(
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            properties,
+            experiment_name,
+        )
+        if experiment:
+            self._experiment_cache_manager.set_cache_experiment_result(
+                distinct_id,
+                is_login_id,
+                custom_ids,
+                experiment,
+                complete=not AsyncSensorsABTest._properties_handler(properties),
+            )
+        else:
+            self._experiment_cache_manager.set_fetch_failed(
+                distinct_id, is_login_id, custom_ids
+            )
+        return experiment
+
+    async def __getABTestByHttp(
+            self,
+            distinct_id,
+            is_login_id,
+            timeout_seconds,
+            custom_ids,
+            properties,
+            experiment_name,
+    ):
+        request_body = AsyncSensorsABTest._encode_request_body(
+            distinct_id, is_login_id, custom_ids, properties, experiment_name
+        )
+        response = await self.__do_request(request_body, timeout_seconds)
+        if response:
+            return AsyncSensorsABTest._parse_response(*response)
+        return None
+
+    async def __do_request(self, request_body, timeout_seconds):
+        breaker = self._circuit_breaker
+        if breaker is not None and not breaker.allow():
+            return None
+        endpoint = self._endpoints.select()
+        start = time.monotonic()
+        try:
+            response = await self._transport.post(
+                endpoint.url,
+                request_body,
+                {"Content-type": "application/json"},
+                timeout_seconds,
+            )
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.cancel()
+            raise
+        except Exception as e:
+            _logger.warning("SAABTesting request %s failed: %s", endpoint.url, e)
+            self._endpoints.record(endpoint, time.monotonic() - start, False)
+            if breaker is not None:
+                breaker.record_failure()
+            return None
+        self._endpoints.record(endpoint, time.monotonic() - start, response[0] < 500)
+        if breaker is not None:
+            if response[0] >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return response
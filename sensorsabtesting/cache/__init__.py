@@ -481,6 +481,33 @@ class TTLCache(_TimedCache):
         """The time-to-live value of the cache's items."""
         return self.__ttl
 
+    def timed_items(self):
+        """Return a list of `(key, value, expires)` for items that have not
+        expired, earliest expiration first, without updating LRU order.
+        """
+        with self.timer as time:
+            self.expire(time)
+            root = self.__root
+            curr = root.next
+            items = []
+            while curr is not root:
+                items.append((curr.key, Cache.__getitem__(self, curr.key), curr.expires))
+                curr = curr.next
+            return items
+
+    def restore(self, key, value, expires):
+        """Insert an item with an explicit expiration time.
+
+        The expiration list is kept in insertion order, so items must be
+        restored earliest expiration first and before any later-expiring
+        item is stored, e.g. when loading a snapshot into an empty cache.
+        """
+        with self.timer as time:
+            if not (time < expires):
+                return
+        self[key] = value
+        self.__links[key].expires = expires
+
     def expire(self, time=None):
         """Remove expired items from the cache."""
         if time is None:
@@ -513,11 +540,7 @@ class TTLCache(_TimedCache):
 
     def __getlink(self, key):
         value = self.__links[key]
-        tmp = collections.OrderedDict(
-            [i for i in self.__links.items()] + [(key, value)]
-        )
-        # self.__links.move_to_end(key)
-        self.__links = tmp
+        self.__links.move_to_end(key)
         return value
 
 
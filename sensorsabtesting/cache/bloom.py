@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+"""Pair of time-rotating Bloom filters for fixed-memory deduplication."""
+
+__all__ = ("RotatingBloomFilter",)
+
+import math
+import threading
+from datetime import datetime
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _local_seconds():
+    """Seconds since 1970-01-01 00:00 local time, so periods of a day start at midnight."""
+    return (datetime.now() - _EPOCH).total_seconds()
+
+
+class _BloomFilter:
+    __slots__ = ("bits", "size", "hashes", "set_bits")
+
+    def __init__(self, size, hashes):
+        self.bits = bytearray((size + 7) // 8)
+        self.size = size
+        self.hashes = hashes
+        self.set_bits = 0
+
+    def positions(self, keyhash):
+        # double hashing over the two halves of the 64-bit key hash
+        h1 = keyhash & 0xFFFFFFFF
+        h2 = (keyhash >> 32) | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def contains(self, positions):
+        bits = self.bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, positions):
+        bits = self.bits
+        for position in positions:
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                self.set_bits += 1
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.set_bits = 0
+
+    def fill_ratio(self):
+        return self.set_bits / self.size
+
+    def error_rate(self):
+        return self.fill_ratio() ** self.hashes
+
+
+class RotatingBloomFilter:
+    """Set of 64-bit key hashes that remembers members for one to two periods.
+
+    Members are added to the filter of the current period; membership is
+    checked against the current and the previous period's filter.  At each
+    period boundary the older filter is cleared and becomes the current one,
+    so memory stays fixed at two filters sized for `capacity` members per
+    period at a false-positive rate of `error_rate`.  Period boundaries are
+    aligned to local midnight, e.g. a period of 86400 seconds rotates at the
+    start of every day.
+
+    A false positive means a member is reported as present although it was
+    never added.
+    """
+
+    def __init__(self, capacity, error_rate, period, timer=_local_seconds):
+        if period <= 0:
+            raise ValueError("period must be positive, got %r" % (period,))
+        capacity = max(1, int(capacity))
+        size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        self.__filters = [_BloomFilter(size, hashes), _BloomFilter(size, hashes)]
+        self.__capacity = capacity
+        self.__period = period
+        self.__timer = timer
+        self.__generation = None
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s(capacity=%r, bits=%r, hashes=%r)" % (
+            self.__class__.__name__,
+            self.__capacity,
+            self.__filters[0].size,
+            self.__filters[0].hashes,
+        )
+
+    def __rotate(self):
+        generation = int(self.__timer() // self.__period)
+        if generation != self.__generation:
+            current, previous = self.__filters
+            if self.__generation is not None and generation == self.__generation + 1:
+                previous.clear()
+                self.__filters = [previous, current]
+            else:
+                current.clear()
+                previous.clear()
+            self.__generation = generation
+
+    def __contains__(self, keyhash):
+        with self.__lock:
+            self.__rotate()
+            current, previous = self.__filters
+            positions = current.positions(keyhash)
+            return current.contains(positions) or previous.contains(positions)
+
+    def add(self, keyhash):
+        with self.__lock:
+            self.__rotate()
+            current = self.__filters[0]
+            current.add(current.positions(keyhash))
+
+    def clear(self):
+        with self.__lock:
+            for bloom in self.__filters:
+                bloom.clear()
+
+    def fill_ratio(self):
+        """Fraction of set bits in the current period's filter."""
+        with self.__lock:
+            self.__rotate()
+            return self.__filters[0].fill_ratio()
+
+    def error_rate(self):
+        """Estimated false-positive rate of a membership check right now."""
+        with self.__lock:
+            self.__rotate()
+            current, previous = self.__filters
+            return 1 - (1 - current.error_rate()) * (1 - previous.error_rate())
+
+    @property
+    def capacity(self):
+        """The number of members per period the filters are sized for."""
+        return self.__capacity
+
+    @property
+    def nbytes(self):
+        """Memory used by the bit arrays."""
+        return sum(len(bloom.bits) for bloom in self.__filters)
@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+"""Coarse monotonic clock refreshed by a background thread."""
+
+__all__ = ("CoarseClock",)
+
+import functools
+import threading
+import time
+
+
+class CoarseClock:
+    """Monotonic clock that trades precision for a cheaper read.
+
+    A daemon thread stores `time.monotonic()` every `resolution` seconds;
+    `timer` returns the stored value without a system call, so readings
+    lag behind the real clock by up to `resolution` seconds.  Like
+    `time.monotonic`, the clock does not follow wall-clock adjustments.
+    """
+
+    def __init__(self, resolution=0.05):
+        self.__now = [time.monotonic()]
+        self.__resolution = resolution
+        self.__stopped = threading.Event()
+        # a C-level callable, cheaper than a Python method call
+        self.timer = functools.partial(self.__now.__getitem__, 0)
+        self.__thread = threading.Thread(
+            target=self.__run, name="SensorsABTestClock", daemon=True
+        )
+        self.__thread.start()
+
+    def __call__(self):
+        return self.__now[0]
+
+    def __run(self):
+        now = self.__now
+        while not self.__stopped.wait(self.__resolution):
+            now[0] = time.monotonic()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    @property
+    def resolution(self):
+        """The refresh interval, in seconds."""
+        return self.__resolution
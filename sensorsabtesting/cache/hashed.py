@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+"""Compact TTL set of 64-bit key hashes stored in flat arrays."""
+
+__all__ = ("HashedTTLSet", "key_hash")
+
+import hashlib
+import math
+import threading
+import time
+from array import array
+
+
+def key_hash(*parts):
+    """Return a stable 64-bit hash of `parts`, never 0.
+
+    Unlike `hash()`, the result does not change between processes, so it
+    can be persisted and shared.  Each part is fed to the hash with its
+    length in front, so no choice of part values makes two different
+    tuples of parts encode the same.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        data = str(part).encode("utf-8")
+        h.update(len(data).to_bytes(4, "little"))
+        h.update(data)
+    return int.from_bytes(h.digest(), "little") or 1
+
+
+class HashedTTLSet:
+    """Set of 64-bit key hashes whose members expire after `ttl` seconds.
+
+    Members live in `bucket_size`-way buckets of two flat arrays, one of
+    hashes and one of expiration times in whole seconds, i.e. 12 bytes per
+    slot instead of a dict entry, a key tuple and a linked-list node per
+    item.  When all slots of a bucket are live, the member expiring first
+    is replaced, so the set holds at least `maxsize` members only as long
+    as they spread evenly over the buckets.  Buckets are guarded by
+    `stripes` locks.
+
+    Expiration times are rounded down, so a member never lives longer
+    than `ttl`; with `ttl <= 0` members are not stored at all.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic, bucket_size=4, stripes=16):
+        buckets = 1
+        while buckets * bucket_size < maxsize:
+            buckets <<= 1
+        self.__mask = buckets - 1
+        self.__bucket_size = bucket_size
+        self.__keys = array("Q", bytes(8 * buckets * bucket_size))
+        self.__expires = array("I", bytes(4 * buckets * bucket_size))
+        self.__locks = tuple(threading.Lock() for _ in range(max(1, min(stripes, buckets))))
+        self.__ttl = ttl
+        self.__timer = timer
+        # expiration times are stored as whole seconds after the epoch, 0
+        # marks an empty slot
+        self.__epoch = timer() - 1
+
+    def __repr__(self):
+        return "%s(slots=%r, currsize=%r)" % (
+            self.__class__.__name__,
+            len(self.__keys),
+            len(self),
+        )
+
+    def __now(self):
+        return self.__timer() - self.__epoch
+
+    def __bucket(self, keyhash):
+        bucket = keyhash & self.__mask
+        return bucket * self.__bucket_size, self.__locks[bucket % len(self.__locks)]
+
+    def __contains__(self, keyhash):
+        start, lock = self.__bucket(keyhash)
+        keys = self.__keys
+        with lock:
+            now = self.__now()
+            for slot in range(start, start + self.__bucket_size):
+                if keys[slot] == keyhash:
+                    return now < self.__expires[slot]
+        return False
+
+    def add(self, keyhash):
+        if self.__ttl > 0:
+            self.__store(keyhash, self.__now() + self.__ttl)
+
+    def __store(self, keyhash, expires):
+        start, lock = self.__bucket(keyhash)
+        keys = self.__keys
+        slot_expires = self.__expires
+        expires = min(int(math.floor(expires)), 0xFFFFFFFF)
+        with lock:
+            target = start
+            for slot in range(start, start + self.__bucket_size):
+                if keys[slot] == keyhash:
+                    target = slot
+                    break
+                if slot_expires[slot] < slot_expires[target]:
+                    target = slot
+            keys[target] = keyhash
+            slot_expires[target] = expires
+
+    def discard(self, keyhash):
+        start, lock = self.__bucket(keyhash)
+        keys = self.__keys
+        with lock:
+            for slot in range(start, start + self.__bucket_size):
+                if keys[slot] == keyhash:
+                    keys[slot] = 0
+                    self.__expires[slot] = 0
+
+    def __len__(self):
+        return sum(1 for _ in self.__live())
+
+    def __live(self):
+        now = self.__now()
+        keys = self.__keys
+        for slot, expires in enumerate(self.__expires):
+            if now < expires:
+                yield keys[slot], expires - now
+
+    def clear(self):
+        for lock in self.__locks:
+            lock.acquire()
+        try:
+            for slot in range(len(self.__keys)):
+                self.__keys[slot] = 0
+                self.__expires[slot] = 0
+        finally:
+            for lock in self.__locks:
+                lock.release()
+
+    def dump(self):
+        """Return `(keyhash, seconds_to_live)` for every unexpired member."""
+        return list(self.__live())
+
+    def load(self, items):
+        """Add members produced by `dump`, keeping their remaining lifetime."""
+        now = self.__now()
+        for keyhash, seconds in sorted(items, key=lambda item: item[1]):
+            if seconds > 0:
+                self.__store(keyhash, now + seconds)
+
+    @property
+    def maxsize(self):
+        """The number of slots of the set."""
+        return len(self.__keys)
+
+    @property
+    def ttl(self):
+        """The time-to-live value of the set's members, in seconds."""
+        return self.__ttl
+
+    @property
+    def timer(self):
+        """The timer function used by the set."""
+        return self.__timer
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+"""Thread-safe TTL cache split into independently locked segments."""
+
+__all__ = ("ShardedTTLCache", "seconds_of")
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from . import TTLCache
+
+
+def seconds_of(delta):
+    """Return a timer difference, `timedelta` or number, in seconds."""
+    if isinstance(delta, timedelta):
+        return delta.total_seconds()
+    return delta
+
+
+def _delta(seconds, now):
+    if isinstance(now, datetime):
+        return timedelta(seconds=seconds)
+    return seconds
+
+
+class ShardedTTLCache:
+    """TTL cache made of `shards` independent `TTLCache` segments.
+
+    Every segment has its own lock, so threads working on keys that live in
+    different segments never wait for each other.  `shardkey` maps a cache
+    key to the value used to pick its segment, e.g. the distinct_id part of
+    a composite key, which keeps all entries of one user in one segment.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic, shards=16, shardkey=None):
+        shards = max(1, min(int(shards), int(maxsize)))
+        base, extra = divmod(int(maxsize), shards)
+        self.__shards = tuple(
+            TTLCache(base + (1 if i < extra else 0), ttl, timer) for i in range(shards)
+        )
+        self.__locks = tuple(threading.Lock() for _ in range(shards))
+        self.__shardkey = shardkey
+        self.__timer = timer
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+
+    def __repr__(self):
+        return "%s(maxsize=%r, shards=%r, currsize=%r)" % (
+            self.__class__.__name__,
+            self.__maxsize,
+            len(self.__shards),
+            len(self),
+        )
+
+    def __index(self, key):
+        if self.__shardkey is not None:
+            key = self.__shardkey(key)
+        return hash(key) % len(self.__shards)
+
+    def __getitem__(self, key):
+        index = self.__index(key)
+        with self.__locks[index]:
+            return self.__shards[index][key]
+
+    def __setitem__(self, key, value):
+        index = self.__index(key)
+        with self.__locks[index]:
+            self.__shards[index][key] = value
+
+    def __delitem__(self, key):
+        index = self.__index(key)
+        with self.__locks[index]:
+            del self.__shards[index][key]
+
+    def __contains__(self, key):
+        index = self.__index(key)
+        with self.__locks[index]:
+            return key in self.__shards[index]
+
+    def __len__(self):
+        size = 0
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                size += len(shard)
+        return size
+
+    def get(self, key, default=None):
+        index = self.__index(key)
+        with self.__locks[index]:
+            return self.__shards[index].get(key, default)
+
+    def pop(self, key, default=None):
+        index = self.__index(key)
+        with self.__locks[index]:
+            return self.__shards[index].pop(key, default)
+
+    def expire(self):
+        """Remove expired items from every segment."""
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                shard.expire()
+
+    def clear(self):
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                # TTLCache.popitem() does not raise on an empty cache, which
+                # MutableMapping.clear() relies on, so delete keys explicitly
+                shard.expire()
+                for key in list(shard):
+                    del shard[key]
+
+    def dump(self):
+        """Return `(key, value, seconds_to_live)` for every unexpired item."""
+        items = []
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                now = shard.timer()
+                for key, value, expires in shard.timed_items():
+                    items.append((key, value, seconds_of(expires - now)))
+        return items
+
+    def load(self, items):
+        """Restore items produced by `dump`, keeping their remaining lifetime.
+
+        Must be called before the cache is used, see `TTLCache.restore`.
+        """
+        for key, value, seconds in sorted(items, key=lambda item: item[2]):
+            if seconds <= 0:
+                continue
+            index = self.__index(key)
+            with self.__locks[index]:
+                shard = self.__shards[index]
+                now = shard.timer()
+                shard.restore(key, value, now + _delta(seconds, now))
+
+    @property
+    def maxsize(self):
+        """The maximum size of the cache."""
+        return self.__maxsize
+
+    @property
+    def ttl(self):
+        """The time-to-live value of the cache's items."""
+        return self.__ttl
+
+    @property
+    def timer(self):
+        """The timer function used by the cache."""
+        return self.__timer
+
+    @property
+    def shards(self):
+        """The underlying `TTLCache` segments."""
+        return self.__shards
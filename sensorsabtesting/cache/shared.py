@@ -0,0 +1,356 @@
+# -*- coding: UTF-8 -*-
+"""TTL cache stored in a memory-mapped file and shared between processes."""
+
+__all__ = ("SharedMemoryCacheBackend", "SharedMemoryTTLCache")
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class SharedMemoryTTLCache:
+    """Fixed-size hash table in a memory-mapped file.
+
+    Every process that opens the same `path` sees the same items, e.g. all
+    workers of a pre-fork server.  The table is split into `stripes`
+    regions; a key lives in the region selected by its hash and is stored
+    in one of `probe` consecutive slots of that region.  Each region is
+    guarded by a thread lock plus an `fcntl` byte-range lock, so processes
+    and threads only contend when they touch the same region.  When all
+    probed slots are taken, the item expiring first is replaced.
+
+    Keys and values must be JSON serializable; tuples come back as lists
+    for values and as tuples for keys.  Values that do not fit in a slot
+    are not stored.  Expiration uses the wall clock (`time.time`) because
+    it is the only clock shared by all processes and across restarts.
+
+    If `decoder` is given, `get` returns `decoder(value)` and each process
+    keeps the decoded value of every slot it has read, keyed by the slot's
+    expiration time, so a slot is decoded again only after it is
+    rewritten.  Decoded values are shared between callers and must not be
+    modified.
+    """
+
+    _MAGIC = b"SAABSHM1"
+    _HEADER = struct.Struct("<8sIII")
+    _SLOT = struct.Struct("<BHIQd")
+
+    def __init__(
+        self, path, maxsize, ttl, slot_size=4096, stripes=64, probe=8, decoder=None
+    ):
+        if fcntl is None:
+            raise OSError("SharedMemoryTTLCache requires fcntl")
+        stripes = max(1, min(int(stripes), int(maxsize)))
+        self.__per_stripe = -(-int(maxsize) // stripes)
+        self.__stripes = stripes
+        self.__slots = self.__per_stripe * stripes
+        self.__slot_size = int(slot_size)
+        self.__probe = max(1, min(int(probe), self.__per_stripe))
+        self.__ttl = ttl
+        self.__locks = tuple(threading.Lock() for _ in range(stripes))
+        self.__decoder = decoder
+        self.__decoded = {}
+        self.skipped = 0
+        size = self._HEADER.size + self.__slots * self.__slot_size
+        header = self._HEADER.pack(
+            self._MAGIC, self.__slots, self.__slot_size, self.__stripes
+        )
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.__fd).st_size == 0:
+                    os.ftruncate(self.__fd, size)
+                    os.pwrite(self.__fd, header, 0)
+                elif os.pread(self.__fd, self._HEADER.size, 0) != header:
+                    raise ValueError(
+                        "%s was created with a different layout" % path
+                    )
+            finally:
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+            self.__mm = mmap.mmap(self.__fd, size)
+        except BaseException:
+            os.close(self.__fd)
+            raise
+
+    def __repr__(self):
+        return "%s(maxsize=%r, slot_size=%r, stripes=%r)" % (
+            self.__class__.__name__,
+            self.__slots,
+            self.__slot_size,
+            self.__stripes,
+        )
+
+    def __locate(self, keybytes):
+        digest = hashlib.blake2b(keybytes, digest_size=8).digest()
+        keyhash = int.from_bytes(digest, "little")
+        stripe = keyhash % self.__stripes
+        base = stripe * self.__per_stripe
+        start = (keyhash // self.__stripes) % self.__per_stripe
+        slots = [
+            base + (start + i) % self.__per_stripe for i in range(self.__probe)
+        ]
+        return keyhash, stripe, slots
+
+    def __offset(self, slot):
+        return self._HEADER.size + slot * self.__slot_size
+
+    def __lock(self, stripe):
+        return _StripeLock(self.__locks[stripe], self.__fd, stripe)
+
+    def __find(self, keybytes, keyhash, slots, now):
+        mm = self.__mm
+        for slot in slots:
+            offset = self.__offset(slot)
+            used, keylen, valuelen, slothash, expires = self._SLOT.unpack_from(
+                mm, offset
+            )
+            if used and slothash == keyhash and now < expires:
+                start = offset + self._SLOT.size
+                if mm[start:start + keylen] == keybytes:
+                    return offset, start + keylen, valuelen, expires
+        return None
+
+    def get(self, key, default=None):
+        keybytes = _dumps(key)
+        keyhash, stripe, slots = self.__locate(keybytes)
+        with self.__lock(stripe):
+            found = self.__find(keybytes, keyhash, slots, time.time())
+            if found is None:
+                return default
+            offset, start, valuelen, expires = found
+            if self.__decoder is not None:
+                decoded = self.__decoded.get(offset)
+                if decoded is not None and decoded[0] == expires:
+                    return decoded[1]
+            data = self.__mm[start:start + valuelen]
+        if self.__decoder is None:
+            return json.loads(data)
+        value = self.__decoder(json.loads(data))
+        self.__decoded[offset] = (expires, value)
+        return value
+
+    def __getitem__(self, key):
+        marker = _MISSING
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        keybytes = _dumps(key)
+        keyhash, stripe, slots = self.__locate(keybytes)
+        with self.__lock(stripe):
+            return self.__find(keybytes, keyhash, slots, time.time()) is not None
+
+    def __setitem__(self, key, value):
+        self.__store(key, value, time.time() + self.__ttl)
+
+    def __store(self, key, value, expires):
+        keybytes = _dumps(key)
+        valuebytes = _dumps(value)
+        if self._SLOT.size + len(keybytes) + len(valuebytes) > self.__slot_size:
+            self.skipped += 1
+            return
+        keyhash, stripe, slots = self.__locate(keybytes)
+        mm = self.__mm
+        with self.__lock(stripe):
+            now = time.time()
+            target = None
+            target_expires = None
+            for slot in slots:
+                offset = self.__offset(slot)
+                used, keylen, _, slothash, slot_expires = self._SLOT.unpack_from(
+                    mm, offset
+                )
+                if used and slothash == keyhash:
+                    start = offset + self._SLOT.size
+                    if mm[start:start + keylen] == keybytes:
+                        target = offset
+                        break
+                if not used or not (now < slot_expires):
+                    slot_expires = float("-inf")
+                if target_expires is None or slot_expires < target_expires:
+                    target, target_expires = offset, slot_expires
+            start = target + self._SLOT.size
+            mm[start:start + len(keybytes)] = keybytes
+            start += len(keybytes)
+            mm[start:start + len(valuebytes)] = valuebytes
+            self._SLOT.pack_into(
+                mm, target, 1, len(keybytes), len(valuebytes), keyhash, expires
+            )
+
+    def __delitem__(self, key):
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+
+    def pop(self, key, default=None):
+        keybytes = _dumps(key)
+        keyhash, stripe, slots = self.__locate(keybytes)
+        with self.__lock(stripe):
+            found = self.__find(keybytes, keyhash, slots, time.time())
+            if found is None:
+                return default
+            offset, start, valuelen, _ = found
+            data = self.__mm[start:start + valuelen]
+            self.__mm[offset] = 0
+        return json.loads(data)
+
+    def __len__(self):
+        return sum(1 for _ in self.__scan(time.time()))
+
+    def __scan(self, now):
+        mm = self.__mm
+        for stripe in range(self.__stripes):
+            with self.__lock(stripe):
+                items = []
+                first = stripe * self.__per_stripe
+                for slot in range(first, first + self.__per_stripe):
+                    offset = self.__offset(slot)
+                    used, keylen, valuelen, _, expires = self._SLOT.unpack_from(
+                        mm, offset
+                    )
+                    if used and now < expires:
+                        start = offset + self._SLOT.size
+                        items.append(
+                            (
+                                offset,
+                                mm[start:start + keylen],
+                                mm[start + keylen:start + keylen + valuelen],
+                                expires,
+                            )
+                        )
+            for item in items:
+                yield item
+
+    def expire(self):
+        """Release the slots of expired items."""
+        now = time.time()
+        mm = self.__mm
+        for stripe in range(self.__stripes):
+            with self.__lock(stripe):
+                first = stripe * self.__per_stripe
+                for slot in range(first, first + self.__per_stripe):
+                    offset = self.__offset(slot)
+                    used, _, _, _, expires = self._SLOT.unpack_from(mm, offset)
+                    if used and not (now < expires):
+                        mm[offset] = 0
+
+    def clear(self):
+        mm = self.__mm
+        for stripe in range(self.__stripes):
+            with self.__lock(stripe):
+                first = stripe * self.__per_stripe
+                for slot in range(first, first + self.__per_stripe):
+                    mm[self.__offset(slot)] = 0
+
+    def dump(self):
+        """Return `(key, value, seconds_to_live)` for every unexpired item."""
+        now = time.time()
+        return [
+            (tuple(json.loads(key)), json.loads(value), expires - now)
+            for _, key, value, expires in self.__scan(now)
+        ]
+
+    def load(self, items):
+        """Store items produced by `dump`, keeping their remaining lifetime."""
+        now = time.time()
+        for key, value, seconds in items:
+            if seconds > 0:
+                self.__store(key, value, now + seconds)
+
+    def close(self):
+        self.__mm.close()
+        os.close(self.__fd)
+
+    @property
+    def maxsize(self):
+        """The number of slots of the cache."""
+        return self.__slots
+
+    @property
+    def ttl(self):
+        """The time-to-live value of the cache's items, in seconds."""
+        return self.__ttl
+
+    @property
+    def timer(self):
+        """The clock used for expiration."""
+        return time.time
+
+
+class SharedMemoryCacheBackend:
+    """Create `SharedMemoryTTLCache` files in `directory`, one per cache name.
+
+    `slot_sizes` maps a cache name to its slot size in bytes; names that
+    are not listed use `DEFAULT_SLOT_SIZES`, then `default_slot_size`.
+    Items larger than their slot are not stored and only counted in the
+    cache's `skipped`.  The "experiment" cache holds whole AB responses,
+    about 450 bytes per experiment a user is in, so its default of 32 KB
+    fits users in up to roughly 70 experiments.  Files are sparse: a cache
+    of 4096 such slots maps 128 MB but only pages holding items use memory.
+    """
+
+    DEFAULT_SLOT_SIZES = {"experiment": 32768}
+
+    def __init__(self, directory, slot_sizes=None, default_slot_size=4096, stripes=64):
+        self.directory = directory
+        self.slot_sizes = dict(self.DEFAULT_SLOT_SIZES)
+        self.slot_sizes.update(slot_sizes or {})
+        self.default_slot_size = default_slot_size
+        self.stripes = stripes
+
+    def create(self, name, maxsize, ttl, decoder=None):
+        """
+        :param name: cache name, also the file name without extension
+        :param maxsize: number of slots
+        :param ttl: time-to-live of items, in seconds
+        :param decoder: see `SharedMemoryTTLCache`
+        """
+        return SharedMemoryTTLCache(
+            os.path.join(self.directory, "%s.cache" % name),
+            maxsize,
+            ttl,
+            slot_size=self.slot_sizes.get(name, self.default_slot_size),
+            stripes=self.stripes,
+            decoder=decoder,
+        )
+
+
+class _StripeLock:
+    __slots__ = ("lock", "fd", "stripe")
+
+    def __init__(self, lock, fd, stripe):
+        self.lock = lock
+        self.fd = fd
+        self.stripe = stripe
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.stripe)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.stripe)
+        finally:
+            self.lock.release()
+
+
+_MISSING = object()
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
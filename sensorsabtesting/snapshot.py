@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+"""
+试验缓存与事件缓存的本地快照，进程重启后恢复缓存，避免重复触发 $ABTestTrigger 事件和冷启动请求
+
+文件格式为 MAGIC 加 zlib 压缩的 JSON，过期时间保存为 Unix 时间戳，
+加载时按当前墙上时钟计算剩余有效期，已过期的条目直接丢弃。
+"""
+import json
+import os
+import tempfile
+import time
+import zlib
+
+MAGIC = b"SAABSNAP1"
+
+
+def save_snapshot(path, experiment_cache_manager, event_cache_manager):
+    """
+    将缓存写入快照文件，先写临时文件再原子替换，写入过程中进程退出不会损坏已有快照
+    """
+    now = time.time()
+    data = {
+        "experiments": [
+            [key, experiment, now + seconds, now + fresh_seconds, complete]
+            for key, experiment, seconds, fresh_seconds, complete
+            in experiment_cache_manager.dump()
+        ],
+        "events": [[key, now + seconds] for key, seconds in event_cache_manager.dump()],
+    }
+    payload = MAGIC + zlib.compress(
+        json.dumps(data, separators=(",", ":")).encode("utf-8")
+    )
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".sa_ab_snapshot_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_snapshot(path, experiment_cache_manager, event_cache_manager):
+    """
+    从快照文件恢复缓存，需在缓存使用前调用
+    """
+    with open(path, "rb") as f:
+        payload = f.read()
+    if not payload.startswith(MAGIC):
+        raise ValueError("%s is not a cache snapshot file" % path)
+    data = json.loads(zlib.decompress(payload[len(MAGIC):]).decode("utf-8"))
+    now = time.time()
+    experiment_cache_manager.load(
+        [
+            (key, experiment, expires - now, fresh_until - now, *complete)
+            for key, experiment, expires, fresh_until, *complete in data["experiments"]
+        ]
+    )
+    event_cache_manager.load([(key, expires - now) for key, expires in data["events"]])
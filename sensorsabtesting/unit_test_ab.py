@@ -1,9 +1,20 @@
 # -*- coding: UTF-8 -*-
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
 import time
 import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from datetime import datetime
 from sensorsabtesting.abtest import *
+from sensorsabtesting.async_abtest import *
+from sensorsabtesting.cache.shared import SharedMemoryCacheBackend
+from sensorsabtesting.snapshot import load_snapshot, save_snapshot
 import sensorsanalytics
 
 SA_SERVER_URL = "https://sdkdebugtest.datasink.sensorsdata.cn/sa?project=default&token=cfb8b60e42e0ae9b"
@@ -11,6 +22,104 @@ SA_SERVER_URL = "https://sdkdebugtest.datasink.sensorsdata.cn/sa?project=default
 AB_URL = "http://10.129.128.84:8202/api/v2/abtest/online/results?project-key=F58146ECC1B9CD7524DCF3157E9480AB97CBC632"
 ERROR_AB_URL = "http://10.1291.128.84:8202/api/v2/abtest/online/results?project-key=F58146ECC1B9CD7524DCF3157E9480AB97CBC632"
 
+STUB_RESPONSE = {
+    "status": "SUCCESS",
+    "results": [
+        {
+            "abtest_experiment_id": "100",
+            "abtest_experiment_group_id": "1",
+            "is_control_group": False,
+            "is_white_list": False,
+            "variables": [
+                {"name": "num_test", "type": "INTEGER", "value": "111"},
+                {"name": "string_test", "type": "STRING", "value": "hello"},
+            ],
+        },
+        {
+            "abtest_experiment_id": "200",
+            "abtest_experiment_group_id": "0",
+            "is_control_group": True,
+            "is_white_list": False,
+            "variables": [
+                {"name": "bool_test", "type": "BOOLEAN", "value": "true"},
+                {"name": "json_test", "type": "JSON", "value": "{\"color\": \"red\"}"},
+            ],
+        },
+    ],
+}
+
+
+class _StubABHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(json.loads(body.decode("utf-8")))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_stub_response()
+
+    def do_GET(self):
+        self.send_stub_response()
+
+    def send_stub_response(self):
+        data = json.dumps(self.server.response).encode("utf-8")
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubABServer(ThreadingHTTPServer):
+    """
+    本地 AB 服务桩，记录收到的请求并返回固定结果
+    """
+
+    daemon_threads = True
+
+    def __init__(self, response=None, delay=0, status=200):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), _StubABHandler)
+        self.response = STUB_RESPONSE if response is None else response
+        self.delay = delay
+        self.status = status
+        self.requests = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api/v2/abtest/online/results" % self.server_port
+
+    def handle_error(self, request, client_address):
+        # 客户端超时后断开连接，写入响应失败，不打印异常
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RecordConsumer:
+    """
+    记录上报事件的 Consumer
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def send(self, msg):
+        self.events.append(json.loads(msg))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
 class NormalTest(unittest.TestCase):
     def setUp(self):
         # 发送数据的超时时间，单位毫秒
@@ -162,6 +271,1545 @@ class NormalTest(unittest.TestCase):
         ab.close()
 
 
+class StubServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        self.consumer = RecordConsumer()
+        self.sa = sensorsanalytics.SensorsAnalytics(self.consumer)
+        self.ab = SensorsABTest(self.server.url, self.sa)
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+
+    def trigger_events(self):
+        return [e for e in self.consumer.events if e["event"] == "$ABTestTrigger"]
+
+    def test_fetch_ab_tests(self):
+        results = self.ab.fetch_ab_tests(
+            "user1",
+            True,
+            {
+                "num_test": 0,
+                "string_test": "unknown",
+                "bool_test": False,
+                "json_test": {},
+                "missing_test": "default",
+            },
+        )
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(results["num_test"].result, 111)
+        self.assertEqual(results["string_test"].result, "hello")
+        self.assertIs(results["bool_test"].result, True)
+        self.assertEqual(results["json_test"].result, {"color": "red"})
+        self.assertEqual(results["missing_test"].result, "default")
+        self.assertIsNone(results["missing_test"].ab_experiment_id)
+        self.assertEqual(results["json_test"].ab_experiment_id, "200")
+        self.assertTrue(results["json_test"].is_control_group)
+        events = self.trigger_events()
+        self.assertEqual(
+            sorted(e["properties"]["$abtest_experiment_id"] for e in events),
+            ["100", "200"],
+        )
+
+    def test_fetch_ab_tests_cache(self):
+        params = {"num_test": 0, "string_test": "unknown"}
+        self.ab.fetch_ab_tests("user1", True, params)
+        results = self.ab.fetch_ab_tests("user1", True, params)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(results["num_test"].result, 111)
+        self.ab.fetch_ab_tests("user1", True, params, enable_cache=False)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.trigger_events()), 1)
+
+    def test_fetch_ab_tests_type_mismatch(self):
+        results = self.ab.fetch_ab_tests(
+            "user1", False, {"num_test": "unknown", "string_test": 1.5}
+        )
+        self.assertEqual(results["num_test"].result, "unknown")
+        self.assertEqual(results["string_test"].result, 1.5)
+        self.assertEqual(self.server.requests[0]["anonymous_id"], "user1")
+
+    def test_log(self):
+        ab = SensorsABTest(
+            self.server.url, self.sa, enable_log=True
+        )
+        try:
+            with self.assertLogs("sensorsabtesting", "DEBUG") as logs:
+                ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            self.assertIn("DEBUG:sensorsabtesting:SAABTesting request code = 200", logs.output)
+        finally:
+            ab.close()
+        ab = SensorsABTest(
+            self.server.url, self.sa, enable_log=False
+        )
+        ab.close()
+        self.assertFalse(logging.getLogger("sensorsabtesting").isEnabledFor(logging.DEBUG))
+
+    def test_bloom_event_cache(self):
+        consumer = RecordConsumer()
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            event_cache_error_rate=0.001,
+        )
+        try:
+            for _ in range(3):
+                ab.fetch_ab_tests("user1", True, {"num_test": 0}, enable_cache=False)
+            stats = ab.stats()
+        finally:
+            ab.close()
+        self.assertEqual(len(consumer.events), 1)
+        self.assertGreater(stats["event_cache_fill_ratio"], 0)
+        self.assertLess(stats["event_cache_error_rate"], 0.001)
+
+    def test_bloom_event_cache_zero_ttl(self):
+        consumer = RecordConsumer()
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            event_cache_time=0,
+            event_cache_error_rate=0.001,
+        )
+        try:
+            for _ in range(3):
+                ab.fetch_ab_tests("user1", True, {"num_test": 0}, enable_cache=False)
+            stats = ab.stats()
+        finally:
+            ab.close()
+        # 缓存时间为 0 时不使用 Bloom 过滤器，与不去重时一样每次曝光都触发事件
+        self.assertEqual(len(consumer.events), 3)
+        self.assertNotIn("event_cache_fill_ratio", stats)
+
+    def test_custom_ids_order_independent(self):
+        ids1 = {"custom_a": "1", "custom_b": "2"}
+        ids2 = {"custom_b": "2", "custom_a": "1"}
+        self.ab.fast_fetch_ab_test("user1", True, "num_test", 0, custom_ids=ids1)
+        self.ab.fast_fetch_ab_test("user1", True, "num_test", 0, custom_ids=ids2)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(self.trigger_events()), 1)
+
+    def test_custom_ids_snapshot_and_shared_cache_keys(self):
+        manager = ExperimentCacheManager(10, 16)
+        manager.set_cache_experiment_result(
+            "user1", True, {"custom_b": "2", "custom_a": "1"}, ExperimentIndex(STUB_RESPONSE)
+        )
+        dumped = json.loads(json.dumps(manager.dump()))
+        restored = ExperimentCacheManager(10, 16)
+        restored.load(dumped)
+        self.assertIsNotNone(
+            restored.get_cache_experiment_result(
+                "user1", True, {"custom_a": "1", "custom_b": "2"}, "num_test"
+            )
+        )
+        events = EventCacheManager(10, 16)
+        events.set_cache("user1", True, "100", {"custom_b": "2", "custom_a": "1"})
+        self.assertTrue(events.is_event_exist("user1", True, "100", {"custom_a": "1", "custom_b": "2"}))
+        self.assertFalse(events.is_event_exist("user1", True, "100", {"custom_a": "1"}))
+
+    def test_concurrent_cache_miss_coalesced(self):
+        self.server.delay = 0.2
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+                )
+            )
+            for _ in range(20)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(all(r.result == 111 for r in results))
+        stats = self.ab.stats()
+        self.assertEqual(stats["singleflight_calls"], 1)
+        self.assertEqual(stats["singleflight_coalesced"], 19)
+        self.ab.fast_fetch_ab_test("user2", True, "num_test", 0)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_fetch_ab_tests_illegal_arguments(self):
+        with self.assertRaises(SensorsABIllegalArgumentsException):
+            self.ab.fetch_ab_tests("user1", True, {})
+        with self.assertRaises(SensorsABIllegalArgumentsException):
+            self.ab.fetch_ab_tests("user1", True, {"": 1})
+
+
+class ExperimentIndexTest(unittest.TestCase):
+    def test_find(self):
+        index = ExperimentIndex(STUB_RESPONSE)
+        self.assertTrue(index.covers(["num_test", "json_test"]))
+        self.assertFalse(index.covers(["num_test", "missing"]))
+        variable = index.find("num_test", 0)
+        self.assertEqual(variable.result(), 111)
+        self.assertEqual(variable.ab_experiment_id, "100")
+        self.assertEqual(variable.ab_experiment_group_id, "1")
+        self.assertIsNone(index.find("num_test", "0"))
+        self.assertIs(index.find("bool_test", False).result(), True)
+        self.assertTrue(index.find("bool_test", False).is_control_group)
+        json_variable = index.find("json_test", {})
+        json_variable.result()["color"] = "blue"
+        self.assertEqual(json_variable.result(), {"color": "red"})
+
+    def test_first_variable_with_matching_type(self):
+        index = ExperimentIndex(
+            {
+                "status": "SUCCESS",
+                "results": [
+                    {
+                        "abtest_experiment_id": "1",
+                        "variables": [
+                            {"name": "v", "type": "STRING", "value": "s"},
+                            {"name": "bad", "type": "INTEGER", "value": "x"},
+                        ],
+                    },
+                    {
+                        "abtest_experiment_id": "2",
+                        "variables": [{"name": "v", "type": "INTEGER", "value": "7"}],
+                    },
+                ],
+            }
+        )
+        self.assertEqual(index.find("v", "").ab_experiment_id, "1")
+        self.assertEqual(index.find("v", 0).ab_experiment_id, "2")
+        self.assertTrue(index.covers(["bad"]))
+        self.assertIsNone(index.find("bad", 0))
+
+
+    def test_json_decoded_once(self):
+        index = ExperimentIndex(
+            {
+                "status": "SUCCESS",
+                "results": [
+                    {
+                        "abtest_experiment_id": "1",
+                        "variables": [
+                            {"name": "nested", "type": "JSON",
+                             "value": "{\"a\": [1, {\"b\": true}], \"c\": null}"},
+                            {"name": "code", "type": "JSON", "value": "__import__('os')"},
+                        ],
+                    },
+                ],
+            }
+        )
+        variable = index.find("nested", {})
+        self.assertEqual(variable.value, {"a": [1, {"b": True}], "c": None})
+        first = variable.result()
+        first["a"][1]["b"] = False
+        first["a"].append(2)
+        self.assertEqual(variable.result(), {"a": [1, {"b": True}], "c": None})
+        self.assertIsNone(index.find("code", {}))
+
+
+class ParseResponseTest(unittest.TestCase):
+    def test_parse_response(self):
+        data = json.dumps(STUB_RESPONSE).encode("utf-8")
+        index = SensorsABTest._parse_response(200, data)
+        self.assertEqual(index.response, STUB_RESPONSE)
+        self.assertEqual(index.find("num_test", 0).result(), 111)
+        self.assertIsNone(SensorsABTest._parse_response(500, data))
+        self.assertIsNone(SensorsABTest._parse_response(200, b"not json"))
+        self.assertIsNone(SensorsABTest._parse_response(200, b'{"status": "FAILED"}'))
+
+    def test_parse_response_stdlib_json(self):
+        import sensorsabtesting.abtest as abtest_module
+
+        json_loads = abtest_module._json_loads
+        abtest_module._json_loads = json.loads
+        try:
+            self.test_parse_response()
+        finally:
+            abtest_module._json_loads = json_loads
+
+
+def _build_request_params(distinct_id, is_login_id, custom_ids, properties, experiment_name):
+    """
+    按 AB 服务接口逐字段构造请求参数，作为 _encode_request_body 的对照
+    """
+    request_params = {}
+    if is_login_id:
+        request_params["login_id"] = distinct_id
+    else:
+        request_params["anonymous_id"] = distinct_id
+    request_params[PLATFORM] = PYTHON
+    request_params[VERSION_KEY] = SDK_VERSION
+    request_params["properties"] = {}
+    if custom_ids:
+        request_params["custom_ids"] = custom_ids
+    right_p = SensorsABTest._properties_handler(properties)
+    if right_p:
+        request_params["custom_properties"] = right_p
+        request_params["param_name"] = experiment_name
+    return request_params
+
+
+class RequestBodyTest(unittest.TestCase):
+    def test_same_bytes_as_json_dumps(self):
+        cases = [
+            ("user1", True, {}, {}, None),
+            ("user1", False, None, None, None),
+            ("用户\"\\", True, {"custom_a": "1", "custom_b": "值"}, {}, None),
+            ("user1", False, {"custom_a": "1"}, {"city": "北京", "vip": True, "tags": ["a", "b"], "age": 1.5}, "num_test"),
+            ("user1", True, {}, {"level": 3}, "string_test"),
+        ]
+        for distinct_id, is_login_id, custom_ids, properties, experiment_name in cases:
+            expected = json.dumps(
+                _build_request_params(
+                    distinct_id, is_login_id, custom_ids, properties, experiment_name
+                )
+            ).encode("utf-8")
+            self.assertEqual(
+                SensorsABTest._encode_request_body(
+                    distinct_id, is_login_id, custom_ids, properties, experiment_name
+                ),
+                expected,
+            )
+
+
+class _SlowConsumer(RecordConsumer):
+    def __init__(self, delay=0, fail=False):
+        RecordConsumer.__init__(self)
+        self.delay = delay
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+
+    def send(self, msg):
+        self.release.wait()
+        time.sleep(self.delay)
+        if self.fail:
+            raise IOError("send failed")
+        RecordConsumer.send(self, msg)
+
+
+class TriggerQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_triggers_sent_in_background(self):
+        consumer = _SlowConsumer(delay=0.2)
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            trigger_queue_size=100,
+        )
+        start = time.monotonic()
+        results = ab.fetch_ab_tests("user1", True, {"num_test": 0, "bool_test": False})
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(results["num_test"].result, 111)
+        # 相同事件在队列中只保留一个
+        ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        ab.close()
+        self.assertEqual(
+            sorted(e["properties"]["$abtest_experiment_id"] for e in consumer.events),
+            ["100", "200"],
+        )
+        stats = ab.stats()
+        self.assertEqual(stats["trigger_queue_depth"], 0)
+        self.assertEqual(stats["trigger_sent"], 2)
+        self.assertEqual(stats["trigger_dropped"], 0)
+
+    def test_drop_when_full(self):
+        consumer = _SlowConsumer()
+        consumer.release.clear()
+        queue = TriggerQueue(sensorsanalytics.SensorsAnalytics(consumer), maxsize=2)
+        self.assertTrue(queue.put("a", "user_a", {}, True))
+        # 等待后台线程取出第一个事件并阻塞在发送上
+        while queue.depth():
+            time.sleep(0.01)
+        self.assertTrue(queue.put("b", "user_b", {}, True))
+        self.assertTrue(queue.put("c", "user_c", {}, True))
+        self.assertFalse(queue.put("c", "user_c", {}, True))
+        self.assertFalse(queue.put("d", "user_d", {}, True))
+        self.assertEqual(queue.depth(), 2)
+        self.assertEqual(queue.dropped, 1)
+        consumer.release.set()
+        queue.close()
+        self.assertEqual([e["distinct_id"] for e in consumer.events], ["user_a", "user_b", "user_c"])
+        self.assertFalse(queue.put("e", "user_e", {}, True))
+        self.assertEqual(queue.dropped, 2)
+
+    def test_block_when_full(self):
+        consumer = _SlowConsumer(delay=0.01)
+        queue = TriggerQueue(
+            sensorsanalytics.SensorsAnalytics(consumer), maxsize=1, policy=TriggerQueue.BLOCK
+        )
+        for i in range(20):
+            self.assertTrue(queue.put(i, "user_%d" % i, {}, False))
+        queue.close()
+        self.assertEqual(len(consumer.events), 20)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_failed_send_not_cached(self):
+        consumer = _SlowConsumer(fail=True)
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            trigger_queue_size=100,
+        )
+        try:
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            ab._trigger_queue.flush()
+            self.assertEqual(ab.stats()["trigger_failed"], 1)
+            # 发送失败的事件没有写入事件缓存，下次曝光时重新发送
+            consumer.fail = False
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            ab._trigger_queue.flush()
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            ab._trigger_queue.flush()
+        finally:
+            ab.close()
+        self.assertEqual(len(consumer.events), 1)
+        self.assertEqual(ab.stats()["trigger_sent"], 1)
+
+    def test_failed_send_counted(self):
+        queue = TriggerQueue(sensorsanalytics.SensorsAnalytics(_SlowConsumer(fail=True)))
+        queue.put("a", "user_a", {}, True)
+        queue.flush()
+        self.assertEqual(queue.failed, 1)
+        queue.close()
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer(response=json.loads(json.dumps(STUB_RESPONSE)))
+        self.ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            experiment_cache_time=0,
+            experiment_stale_time=0.05,
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+
+    def wait_requests(self, count):
+        deadline = time.time() + 2
+        while len(self.server.requests) < count and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+
+    def test_stale_value_returned_while_refreshing(self):
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+        self.server.response["results"][0]["variables"][0]["value"] = "222"
+        self.server.delay = 0.3
+        start = time.time()
+        result = self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(result.result, 111)
+        self.wait_requests(2)
+        time.sleep(0.3)
+        self.server.delay = 0
+        # 刷新完成后新结果立即进入宽限期，仍然直接返回
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 222)
+
+    def test_stale_value_kept_when_refresh_fails(self):
+        self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        self.server.status = 500
+        self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        self.wait_requests(2)
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+
+    def test_expired_after_grace(self):
+        self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        self.wait_requests(1)
+        time.sleep(3.1)
+        self.server.status = 500
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 0)
+
+
+class StaleDisabledTest(unittest.TestCase):
+    def test_advancing_timer_never_stale(self):
+        now = [0.0]
+
+        def timer():
+            # 每次读取都前进，缓存写入时 TTLCache 读到的时间晚于 fresh_until 的计算时间
+            now[0] += 30
+            return now[0]
+
+        server = StubABServer(response=json.loads(json.dumps(STUB_RESPONSE)))
+        ab = SensorsABTest(server.url, sensorsanalytics.SensorsAnalytics(RecordConsumer()))
+        ab._experiment_cache_manager = ExperimentCacheManager(1, 16, timer=timer)
+        try:
+            for _ in range(2):
+                self.assertEqual(ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+            self.assertEqual(len(server.requests), 1)
+            stats = ab.stats()
+            self.assertEqual(stats["experiment_cache_hit"], 1)
+            self.assertEqual(stats["experiment_cache_stale_hit"], 0)
+        finally:
+            ab.close()
+            server.stop()
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        self.consumer = RecordConsumer()
+        self.ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(self.consumer),
+            experiment_failure_cache_time=60,
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+
+    def test_not_enrolled_param_served_from_cache(self):
+        self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        result = self.ab.fast_fetch_ab_test("user1", True, "missing_test", "default")
+        self.assertEqual(result.result, "default")
+        self.assertIsNone(result.ab_experiment_id)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(self.consumer.events), 1)
+        stats = self.ab.stats()
+        self.assertEqual(stats["experiment_cache_miss"], 1)
+        self.assertEqual(stats["experiment_cache_negative_hit"], 1)
+        self.ab.fast_fetch_ab_test("user1", True, "string_test", "")
+        self.assertEqual(self.ab.stats()["experiment_cache_hit"], 1)
+
+    def test_properties_result_not_authoritative(self):
+        self.ab.fast_fetch_ab_test(
+            "user1", True, "num_test", 0, properties={"city": "beijing"}
+        )
+        self.ab.fast_fetch_ab_test("user1", True, "missing_test", "default")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.ab.stats()["experiment_cache_negative_hit"], 0)
+        # 完整结果也不能回答带自定义属性的查询，按属性定向的试验需要重新请求
+        self.ab.fast_fetch_ab_test("user2", True, "num_test", 0)
+        self.ab.fast_fetch_ab_test(
+            "user2", True, "prop_targeted", 0, properties={"city": "bj"}
+        )
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.ab.stats()["experiment_cache_negative_hit"], 0)
+
+    def test_failed_fetch_cached(self):
+        self.server.status = 500
+        for _ in range(3):
+            result = self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            self.assertEqual(result.result, 0)
+        self.assertEqual(len(self.server.requests), 1)
+        stats = self.ab.stats()
+        self.assertEqual(stats["experiment_cache_miss"], 3)
+        self.assertEqual(stats["experiment_cache_failure_hit"], 2)
+        # 其他用户不受影响，主动请求也不经过负缓存
+        self.server.status = 200
+        self.assertEqual(self.ab.fast_fetch_ab_test("user2", True, "num_test", 0).result, 111)
+        self.assertEqual(self.ab.async_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+
+    def test_failure_entry_expires(self):
+        now = [0.0]
+        manager = ExperimentCacheManager(
+            10, 16, failure_time=60, timer=lambda: now[0]
+        )
+        manager.set_fetch_failed("user1", True, {})
+        self.assertTrue(manager.is_fetch_failed("user1", True, {}))
+        now[0] += 61
+        self.assertFalse(manager.is_fetch_failed("user1", True, {}))
+        manager.set_fetch_failed("user1", True, {})
+        manager.set_cache_experiment_result(
+            "user1", True, {}, ExperimentIndex(STUB_RESPONSE), complete=True
+        )
+        self.assertFalse(manager.is_fetch_failed("user1", True, {}))
+
+    def test_complete_flag_in_snapshot(self):
+        manager = ExperimentCacheManager(10, 16)
+        manager.set_cache_experiment_result(
+            "user1", True, {}, ExperimentIndex(STUB_RESPONSE), complete=True
+        )
+        manager.set_cache_experiment_result(
+            "user2", True, {}, ExperimentIndex(STUB_RESPONSE)
+        )
+        restored = ExperimentCacheManager(10, 16)
+        restored.load(json.loads(json.dumps(manager.dump())))
+        self.assertIsNotNone(restored.get_cache_experiment_result("user1", True, {}, "missing_test"))
+        self.assertIsNone(restored.get_cache_experiment_result("user2", True, {}, "missing_test"))
+
+
+LOCAL_CONFIG = {
+    "status": "SUCCESS",
+    "experiments": [
+        {
+            "abtest_experiment_id": "100",
+            "groups": [
+                {
+                    "abtest_experiment_group_id": "1",
+                    "is_control_group": False,
+                    "weight": 100,
+                    "variables": STUB_RESPONSE["results"][0]["variables"],
+                }
+            ],
+        },
+        {
+            "abtest_experiment_id": "200",
+            "groups": [
+                {
+                    "abtest_experiment_group_id": "0",
+                    "is_control_group": True,
+                    "weight": 100,
+                    "variables": STUB_RESPONSE["results"][1]["variables"],
+                }
+            ],
+        },
+        {
+            "abtest_experiment_id": "300",
+            "traffic": 50,
+            "white_list": [{"abtest_experiment_group_id": "1", "ids": ["vip"]}],
+            "groups": [
+                {
+                    "abtest_experiment_group_id": "0",
+                    "is_control_group": True,
+                    "weight": 1,
+                    "variables": [{"name": "split_test", "type": "STRING", "value": "a"}],
+                },
+                {
+                    "abtest_experiment_group_id": "1",
+                    "is_control_group": False,
+                    "weight": 1,
+                    "variables": [{"name": "split_test", "type": "STRING", "value": "b"}],
+                },
+            ],
+        },
+        {
+            "abtest_experiment_id": "400",
+            "subject_id_name": "device",
+            "groups": [
+                {
+                    "abtest_experiment_group_id": "0",
+                    "weight": 1,
+                    "variables": [{"name": "device_test", "type": "INTEGER", "value": "7"}],
+                }
+            ],
+        },
+        {
+            "abtest_experiment_id": "500",
+            "requires_remote": True,
+            "groups": [
+                {
+                    "abtest_experiment_group_id": "0",
+                    "weight": 1,
+                    "variables": [{"name": "audience_test", "type": "INTEGER", "value": "1"}],
+                }
+            ],
+        },
+    ],
+}
+
+
+class LocalEvaluationTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        fd, self.config_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(LOCAL_CONFIG, f)
+        self.consumer = RecordConsumer()
+        self.ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(self.consumer),
+            local_evaluation_config=self.config_file,
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+        os.remove(self.config_file)
+
+    def test_same_experiments_as_remote(self):
+        defaults = {
+            "num_test": 0,
+            "string_test": "unknown",
+            "bool_test": False,
+            "json_test": {},
+            "missing_test": "default",
+        }
+        remote_consumer = RecordConsumer()
+        remote = SensorsABTest(
+            self.server.url, sensorsanalytics.SensorsAnalytics(remote_consumer)
+        )
+        expected = remote.fetch_ab_tests("user1", True, defaults)
+        remote.close()
+        results = self.ab.fetch_ab_tests("user1", True, defaults)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(
+            {name: vars(r) for name, r in results.items()},
+            {name: vars(r) for name, r in expected.items()},
+        )
+        self.assertEqual(
+            [e["properties"][EXPERIMENT_ID] for e in self.consumer.events],
+            [e["properties"][EXPERIMENT_ID] for e in remote_consumer.events],
+        )
+        self.assertEqual(self.ab.stats()["local_evaluated"], 1)
+
+    def test_traffic_split(self):
+        values = [
+            self.ab.fast_fetch_ab_test("user%d" % i, True, "split_test", "", False).result
+            for i in range(4000)
+        ]
+        for value, share in (("", 0.5), ("a", 0.25), ("b", 0.25)):
+            self.assertAlmostEqual(values.count(value) / 4000, share, delta=0.03)
+        again = [
+            self.ab.fast_fetch_ab_test("user%d" % i, True, "split_test", "", False).result
+            for i in range(100)
+        ]
+        self.assertEqual(again, values[:100])
+        self.assertEqual(self.server.requests, [])
+
+    def test_white_list_and_custom_subject(self):
+        result = self.ab.fast_fetch_ab_test("vip", True, "split_test", "")
+        self.assertEqual(result.result, "b")
+        self.assertTrue(result.is_white_list)
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "device_test", 0).result, 0)
+        result = self.ab.fast_fetch_ab_test(
+            "user1", True, "device_test", 0, custom_ids={"device": "d1"}
+        )
+        self.assertEqual(result.result, 7)
+        self.assertEqual(self.server.requests, [])
+
+    def test_remote_fallback(self):
+        self.ab.fast_fetch_ab_test("user1", True, "audience_test", 0)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.ab.stats()["local_fallbacks"], 1)
+
+    def test_config_refresh(self):
+        config = json.loads(json.dumps(LOCAL_CONFIG))
+        config["experiments"][0]["groups"][0]["variables"][0]["value"] = "222"
+        with open(self.config_file, "w") as f:
+            json.dump(config, f)
+        self.assertTrue(self.ab._local_evaluator.refresh())
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 222)
+        with open(self.config_file, "w") as f:
+            f.write("{")
+        self.assertFalse(self.ab._local_evaluator.refresh())
+        self.assertEqual(self.ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 222)
+
+    def test_missing_config_uses_remote(self):
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            local_evaluation_config=self.config_file + ".missing",
+        )
+        self.assertEqual(ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+        ab.close()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_config_from_url(self):
+        server = StubABServer(response=LOCAL_CONFIG)
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            local_evaluation_config=server.url,
+        )
+        self.assertEqual(ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+        ab.close()
+        server.stop()
+        self.assertEqual(self.server.requests, [])
+
+
+class BatchAssignTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.config_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(LOCAL_CONFIG, f)
+        self.ab = SensorsABTest(
+            "http://127.0.0.1:9/api/v2/abtest/online/results",
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            local_evaluation_config=self.config_file,
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        os.remove(self.config_file)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_same_as_single_user(self):
+        distinct_ids = ["vip", "用户"] + ["user%d" % i for i in range(2000)]
+        devices = [None if i % 3 == 0 else "device%d" % i for i in range(len(distinct_ids))]
+        defaults = {"split_test": "", "num_test": 0, "json_test": {}, "device_test": 0}
+        columns = self.ab.batch_assign(
+            numpy.array(distinct_ids), defaults, custom_ids={"device": devices}
+        )
+        for row, distinct_id in enumerate(distinct_ids):
+            custom_ids = {"device": devices[row]} if devices[row] else {}
+            expected = self.ab.fetch_ab_tests(
+                distinct_id, True, defaults, False, custom_ids=custom_ids
+            )
+            for param_name, experiment in expected.items():
+                self.assertEqual(
+                    {name: column[row] for name, column in columns[param_name].items()},
+                    {
+                        "ab_experiment_id": experiment.ab_experiment_id,
+                        "ab_experiment_group_id": experiment.ab_experiment_group_id,
+                        "is_control_group": experiment.is_control_group,
+                        "is_white_list": experiment.is_white_list,
+                        "result": experiment.result,
+                    },
+                )
+        self.assertTrue(columns["split_test"]["is_white_list"][0])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_column_types(self):
+        distinct_ids = ["user%d" % i for i in range(300)] + ["用户"]
+        expected = self.ab.batch_assign(distinct_ids, {"split_test": ""})["split_test"]
+        for column in (numpy.array(distinct_ids[:-1]), numpy.array(distinct_ids[:-1], dtype="S")):
+            result = self.ab.batch_assign(column, {"split_test": ""})["split_test"]
+            self.assertEqual(list(result["result"]), list(expected["result"][:-1]))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_remote_experiment_rejected(self):
+        with self.assertRaises(SensorsABException):
+            self.ab.batch_assign(["user1"], {"audience_test": 0})
+
+    def test_requires_numpy(self):
+        with mock.patch("sensorsabtesting.abtest.numpy", None):
+            with self.assertRaises(SensorsABException):
+                self.ab.batch_assign(["user1"], {"num_test": 0})
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        self.transitions = []
+        self.ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            circuit_breaker_threshold=2,
+            circuit_breaker_recovery_time=0.2,
+            circuit_breaker_callback=lambda old, new: self.transitions.append((old, new)),
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+
+    def fetch(self, timeout_seconds=3.0):
+        return self.ab.async_fetch_ab_test(
+            "user1", True, "num_test", 0, timeout_seconds=timeout_seconds
+        ).result
+
+    def test_open_and_recover(self):
+        self.server.status = 500
+        self.assertEqual(self.fetch(), 0)
+        self.assertEqual(self.fetch(), 0)
+        self.assertEqual(self.ab.stats()["circuit_state"], CircuitBreaker.OPEN)
+        self.assertEqual(self.fetch(), 0)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.ab.stats()["circuit_rejected"], 1)
+        self.server.status = 200
+        self.assertEqual(self.fetch(), 0)
+        time.sleep(0.25)
+        self.assertEqual(self.fetch(), 111)
+        self.assertEqual(self.fetch(), 111)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(
+            self.transitions,
+            [
+                (CircuitBreaker.CLOSED, CircuitBreaker.OPEN),
+                (CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN),
+                (CircuitBreaker.HALF_OPEN, CircuitBreaker.CLOSED),
+            ],
+        )
+
+    def test_failed_probe_reopens(self):
+        self.server.status = 500
+        self.fetch()
+        self.fetch()
+        time.sleep(0.25)
+        self.fetch()
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.ab.stats()["circuit_opened"], 2)
+        self.fetch()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_timeouts_fail_fast(self):
+        self.server.delay = 0.5
+        self.fetch(0.05)
+        self.fetch(0.05)
+        start = time.time()
+        self.assertEqual(self.fetch(0.05), 0)
+        self.assertLess(time.time() - start, 0.04)
+
+    def test_success_resets_failures(self):
+        self.server.status = 500
+        self.fetch()
+        self.server.status = 200
+        self.fetch()
+        self.server.status = 500
+        self.fetch()
+        self.assertEqual(self.ab.stats()["circuit_state"], CircuitBreaker.CLOSED)
+
+    def test_single_probe_in_half_open(self):
+        now = [0.0]
+        breaker = CircuitBreaker(1, 10, timer=lambda: now[0])
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.cancel()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.rejected, 2)
+
+
+class MultiEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [StubABServer(), StubABServer()]
+        self.abs = []
+
+    def tearDown(self):
+        for ab in self.abs:
+            ab.close()
+        for server in self.servers:
+            server.stop()
+
+    def new_ab(self, **kwargs):
+        ab = SensorsABTest(
+            [server.url for server in self.servers],
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            **kwargs
+        )
+        self.abs.append(ab)
+        return ab
+
+    def fetch(self, ab, user="user1"):
+        return ab.async_fetch_ab_test(user, True, "num_test", 0).result
+
+    def test_invalid_base_url(self):
+        with self.assertRaises(SensorsABIllegalArgumentsException):
+            SensorsABTest(
+                [self.servers[0].url, None],
+                sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            )
+
+    def test_route_to_fastest(self):
+        slow, fast = self.servers
+        slow.delay = 0.05
+        ab = self.new_ab()
+        for _ in range(5):
+            self.assertEqual(self.fetch(ab), 111)
+        before = len(slow.requests)
+        for _ in range(10):
+            self.assertEqual(self.fetch(ab), 111)
+        self.assertEqual(len(slow.requests), before)
+        endpoints = ab.stats()["endpoints"]
+        self.assertGreater(endpoints[0]["latency_ms"], endpoints[1]["latency_ms"])
+
+    def test_skip_unhealthy(self):
+        down, up = self.servers
+        down.status = 500
+        ab = self.new_ab()
+        for _ in range(10):
+            self.fetch(ab)
+        self.assertEqual(len(down.requests), 3)
+        self.assertEqual(self.fetch(ab), 111)
+        endpoints = ab.stats()["endpoints"]
+        self.assertFalse(endpoints[0]["healthy"])
+        self.assertTrue(endpoints[1]["healthy"])
+        self.assertGreater(endpoints[0]["error_rate"], 0.4)
+
+    def test_slow_endpoint_probed_again(self):
+        now = [0.0]
+        selector = EndpointSelector(["a", "b"], decay_time=10, timer=lambda: now[0])
+        slow, fast = selector._endpoints
+        for _ in range(5):
+            selector.record(slow, 0.05, True)
+            selector.record(fast, 0.001, True)
+        probes = 0
+        for _ in range(600):
+            now[0] += 0.1
+            endpoint = selector.select()
+            if endpoint is slow:
+                probes += 1
+                # 恢复后耗时与另一个地址相同
+                selector.record(slow, 0.001, True)
+            else:
+                selector.record(fast, 0.001, True)
+        self.assertGreaterEqual(probes, 1)
+        self.assertLess(slow.latency, 0.002)
+
+    def test_error_rate_in_selection(self):
+        now = [0.0]
+        selector = EndpointSelector(["a", "b"], timer=lambda: now[0])
+        flaky, stable = selector._endpoints
+        for _ in range(10):
+            selector.record(flaky, 0.01, True)
+            selector.record(flaky, 0.01, False)
+            selector.record(stable, 0.015, True)
+        # 平均耗时更短但一半请求失败的地址预期耗时更长
+        self.assertIs(selector.select(), stable)
+
+    def test_hedged_request(self):
+        slow, fast = self.servers
+        ab = self.new_ab(hedge_requests=True)
+        primary, secondary = ab._endpoints._endpoints
+        for _ in range(20):
+            ab._endpoints.record(primary, 0.01, True)
+            ab._endpoints.record(secondary, 0.02, True)
+        slow.delay = 0.5
+        start = time.time()
+        self.assertEqual(self.fetch(ab), 111)
+        self.assertLess(time.time() - start, 0.3)
+        self.assertEqual(len(slow.requests), 1)
+        self.assertEqual(len(fast.requests), 1)
+        stats = ab.stats()
+        self.assertEqual(stats["hedged_requests"], 1)
+        self.assertEqual(stats["hedge_wins"], 1)
+
+    def test_hedge_after_fast_failure(self):
+        down, up = self.servers
+        ab = self.new_ab(hedge_requests=True)
+        primary, secondary = ab._endpoints._endpoints
+        for _ in range(20):
+            ab._endpoints.record(primary, 0.5, True)
+            ab._endpoints.record(secondary, 1, True)
+        down.status = 500
+        self.assertEqual(self.fetch(ab), 111)
+        self.assertEqual(len(down.requests), 1)
+        self.assertEqual(len(up.requests), 1)
+
+    def test_no_hedge_without_samples(self):
+        ab = self.new_ab(hedge_requests=True)
+        self.assertEqual(self.fetch(ab), 111)
+        self.assertEqual(ab.stats()["hedged_requests"], 0)
+        self.assertEqual(sum(len(server.requests) for server in self.servers), 1)
+
+
+class WarmUpTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        self.ab = SensorsABTest(
+            self.server.url, sensorsanalytics.SensorsAnalytics(RecordConsumer())
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+
+    def test_warm_up_fills_cache(self):
+        progress = []
+        users = [("user%d" % i, True) for i in range(30)] + [("", True), "bad"]
+        task = self.ab.warm_up(
+            users,
+            concurrency=4,
+            wait=True,
+            progress_callback=lambda t: progress.append(t.completed),
+        )
+        self.assertTrue(task.done())
+        self.assertEqual(task.succeeded, 30)
+        self.assertEqual(task.failed, 2)
+        self.assertEqual(sorted(progress), list(range(1, 33)))
+        self.assertEqual(len(self.server.requests), 30)
+        self.ab.fast_fetch_ab_test("user7", True, "num_test", 0)
+        self.assertEqual(len(self.server.requests), 30)
+
+    def test_warm_up_in_background_with_rate_limit(self):
+        start = time.time()
+        task = self.ab.warm_up([("user%d" % i, False) for i in range(10)], rate_limit=50)
+        self.assertFalse(task.done())
+        self.assertTrue(task.wait(5))
+        self.assertGreaterEqual(time.time() - start, 9 / 50.0)
+        self.assertEqual(task.succeeded, 10)
+
+    def test_warm_up_cancel(self):
+        task = self.ab.warm_up((("user%d" % i, False) for i in range(1000)), rate_limit=20)
+        task.cancel()
+        self.assertTrue(task.wait(5))
+        self.assertLess(task.submitted, 1000)
+
+
+class CacheSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_file = os.path.join(self.tmp_dir.name, "ab_cache.snapshot")
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp_dir.cleanup()
+
+    def new_ab(self, consumer):
+        return SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            cache_snapshot_file=self.snapshot_file,
+        )
+
+    def test_restore_after_restart(self):
+        consumer = RecordConsumer()
+        ab = self.new_ab(consumer)
+        ab.fast_fetch_ab_test("user1", True, "num_test", 0, custom_ids={"custom_a": "1"})
+        ab.close()
+        self.assertEqual(len(consumer.events), 1)
+        self.assertTrue(os.path.exists(self.snapshot_file))
+        self.assertEqual(os.listdir(self.tmp_dir.name), ["ab_cache.snapshot"])
+
+        consumer = RecordConsumer()
+        ab = self.new_ab(consumer)
+        result = ab.fast_fetch_ab_test(
+            "user1", True, "num_test", 0, custom_ids={"custom_a": "1"}
+        )
+        ab.close()
+        self.assertEqual(result.result, 111)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(consumer.events, [])
+
+    def test_expired_entries_dropped(self):
+        manager = ExperimentCacheManager(10, 16)
+        manager.load(
+            [
+                (["user1", True, []], STUB_RESPONSE, -1, -1),
+                (["user2", True, []], STUB_RESPONSE, 60, 30),
+            ]
+        )
+        self.assertIsNone(manager.get_cache_experiment_result("user1", True, {}, "num_test"))
+        self.assertIsNotNone(manager.get_cache_experiment_result("user2", True, {}, "num_test"))
+        dumped = manager.dump()
+        self.assertEqual(len(dumped), 1)
+        self.assertTrue(55 < dumped[0][2] <= 60)
+        self.assertTrue(25 < dumped[0][3] <= 30)
+
+    def test_wall_clock_jump(self):
+        monotonic = [1000.0]
+
+        def timer():
+            return monotonic[0]
+
+        experiments = ExperimentCacheManager(1, 16, timer=timer)
+        events = EventCacheManager(1, 16, timer=timer)
+        experiments.set_cache_experiment_result("user1", True, {}, ExperimentIndex(STUB_RESPONSE))
+        events.set_cache("user1", True, "100", {})
+        real_time = time.time()
+        # 墙上时钟跳变既不会使缓存提前过期，也不会延长缓存
+        for jump in (365 * 86400, -365 * 86400):
+            with mock.patch("time.time", return_value=real_time + jump):
+                experiment, stale = experiments.lookup_experiment_results(
+                    "user1", True, {}, ["num_test"]
+                )
+                self.assertIsNotNone(experiment)
+                self.assertFalse(stale)
+                self.assertTrue(events.is_event_exist("user1", True, "100", {}))
+        # 只有单调时钟前进才使缓存过期
+        monotonic[0] += 59
+        experiment, _ = experiments.lookup_experiment_results("user1", True, {}, ["num_test"])
+        self.assertIsNotNone(experiment)
+        self.assertTrue(events.is_event_exist("user1", True, "100", {}))
+        monotonic[0] += 2
+        experiment, _ = experiments.lookup_experiment_results("user1", True, {}, ["num_test"])
+        self.assertIsNone(experiment)
+        self.assertFalse(events.is_event_exist("user1", True, "100", {}))
+        experiments = ExperimentCacheManager(1, 16)
+        events = EventCacheManager(1, 16)
+        experiments.set_cache_experiment_result("user1", True, {}, ExperimentIndex(STUB_RESPONSE))
+        events.set_cache("user1", True, "100", {})
+        # 快照仍按墙上时钟保存剩余有效期
+        save_snapshot(self.snapshot_file, experiments, events)
+        restored_experiments = ExperimentCacheManager(1, 16)
+        restored_events = EventCacheManager(1, 16)
+        load_snapshot(self.snapshot_file, restored_experiments, restored_events)
+        self.assertTrue(55 < restored_experiments.dump()[0][2] <= 60)
+        self.assertTrue(restored_events.is_event_exist("user1", True, "100", {}))
+
+    def test_coarse_clock(self):
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            cache_clock_resolution=0.01,
+        )
+        try:
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        finally:
+            ab.close()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_invalid_snapshot_ignored(self):
+        with open(self.snapshot_file, "wb") as f:
+            f.write(b"not a snapshot")
+        ab = self.new_ab(RecordConsumer())
+        self.assertEqual(ab.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111)
+        ab.close()
+
+
+class SharedCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp_dir.cleanup()
+
+    def new_ab(self, consumer):
+        return SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            experiment_stale_time=1,
+            cache_backend=SharedMemoryCacheBackend(self.tmp_dir.name),
+        )
+
+    def test_cache_shared_between_clients(self):
+        consumer = RecordConsumer()
+        first = self.new_ab(consumer)
+        second = self.new_ab(consumer)
+        try:
+            result = first.fast_fetch_ab_test(
+                "user1", True, "json_test", {}, custom_ids={"custom_a": "1"}
+            )
+            self.assertEqual(result.result, {"color": "red"})
+            result = second.fast_fetch_ab_test(
+                "user1", True, "json_test", {}, custom_ids={"custom_a": "1"}
+            )
+            self.assertEqual(result.result, {"color": "red"})
+            self.assertEqual(
+                second.fast_fetch_ab_test("user1", True, "num_test", 0).result, 111
+            )
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(consumer.events), 2)
+        self.assertEqual(
+            sorted(os.listdir(self.tmp_dir.name)), ["event.cache", "experiment.cache"]
+        )
+
+    def test_decoded_index_reused(self):
+        backend = SharedMemoryCacheBackend(self.tmp_dir.name)
+        writer = ExperimentCacheManager(10, 16, backend=backend)
+        reader = ExperimentCacheManager(10, 16, backend=backend)
+        writer.set_cache_experiment_result("user1", True, {}, ExperimentIndex(STUB_RESPONSE))
+        first, _ = reader.lookup_experiment_results("user1", True, {}, ["num_test"])
+        second, _ = reader.lookup_experiment_results("user1", True, {}, ["bool_test"])
+        self.assertIsInstance(first, ExperimentIndex)
+        self.assertIs(first, second)
+
+    def test_large_response_stored(self):
+        response = {
+            "status": "SUCCESS",
+            "results": [
+                {
+                    "abtest_experiment_id": str(i),
+                    "abtest_experiment_group_id": "1",
+                    "is_control_group": False,
+                    "is_white_list": False,
+                    "variables": [
+                        {"name": "param_%d" % i, "type": "STRING", "value": "v" * 300}
+                    ],
+                }
+                for i in range(50)
+            ],
+        }
+        self.server.response = response
+        self.assertGreater(len(json.dumps(response)), 16384)
+        ab = self.new_ab(RecordConsumer())
+        try:
+            ab.fast_fetch_ab_test("user1", True, "param_0", "")
+            ab.fast_fetch_ab_test("user1", True, "param_1", "")
+            stats = ab.stats()
+        finally:
+            ab.close()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(stats["experiment_cache_skipped"], 0)
+        self.assertEqual(stats["event_cache_skipped"], 0)
+
+    def test_skipped_in_stats(self):
+        ab = SensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            cache_backend=SharedMemoryCacheBackend(
+                self.tmp_dir.name, slot_sizes={"experiment": 256}
+            ),
+        )
+        try:
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+            stats = ab.stats()
+        finally:
+            ab.close()
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(stats["experiment_cache_skipped"], 2)
+
+
+class BulkFetchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubABServer(delay=0.05)
+        self.consumer = RecordConsumer()
+        self.ab = SensorsABTest(
+            self.server.url, sensorsanalytics.SensorsAnalytics(self.consumer)
+        )
+
+    def tearDown(self):
+        self.ab.close()
+        self.server.stop()
+
+    def test_bulk_fetch_ab_tests(self):
+        users = [("user%d" % i, i % 2 == 0) for i in range(40)]
+        users.append(("user_c", True, {"custom_a": "1"}))
+        start = time.time()
+        results = list(
+            self.ab.bulk_fetch_ab_tests(
+                iter(users), {"num_test": 0}, concurrency=8, max_in_flight=16
+            )
+        )
+        elapsed = time.time() - start
+        self.assertEqual([user for user, _ in results], users)
+        self.assertTrue(all(r["num_test"].result == 111 for _, r in results))
+        self.assertEqual(len(self.server.requests), len(users))
+        self.assertEqual(self.server.requests[-1]["custom_ids"], {"custom_a": "1"})
+        self.assertLess(elapsed, len(users) * 0.05 / 2)
+
+    def test_bulk_fetch_ab_tests_illegal_arguments(self):
+        with self.assertRaises(SensorsABIllegalArgumentsException):
+            list(self.ab.bulk_fetch_ab_tests([("user1", True)], {"num_test": 0}, concurrency=0))
+        with self.assertRaises(SensorsABIllegalArgumentsException):
+            list(self.ab.bulk_fetch_ab_tests([("user1", True)], {}))
+
+    def test_bulk_fetch_ab_tests_invalid_users(self):
+        users = [("user%d" % i, True) for i in range(5)]
+        users += [("", True), "user_x", (None, True, {})]
+        users += [("user_y", True, ["custom_a", "1"]), ("user_z", True, {"custom_a": 1})]
+        users += [("user%d" % i, True) for i in range(5, 55)]
+        results = list(
+            self.ab.bulk_fetch_ab_tests(users, {"num_test": 0}, concurrency=8)
+        )
+        self.assertEqual([user for user, _ in results], users)
+        self.assertEqual([r for _, r in results[5:10]], [None] * 5)
+        valid = results[:5] + results[10:]
+        self.assertTrue(all(r["num_test"].result == 111 for _, r in valid))
+        self.assertEqual(len(self.server.requests), 55)
+
+    def test_bulk_fetch_ab_tests_request_error(self):
+        fetch_abs = self.ab._SensorsABTest__fetch_abs
+
+        def failing_fetch_abs(distinct_id, *args):
+            if distinct_id == "user2":
+                raise ValueError("boom")
+            return fetch_abs(distinct_id, *args)
+
+        users = [("user%d" % i, True) for i in range(5)]
+        with mock.patch.object(self.ab, "_SensorsABTest__fetch_abs", failing_fetch_abs):
+            results = list(self.ab.bulk_fetch_ab_tests(users, {"num_test": 0}))
+        self.assertEqual([user for user, _ in results], users)
+        self.assertIsNone(results[2][1])
+        self.assertEqual(sum(1 for _, r in results if r is not None), 4)
+
+
+class AsyncStubABServer:
+    """
+    运行在测试事件循环上的 AB 服务桩，支持 keep-alive，记录最大并发请求数
+    """
+
+    def __init__(self, response=None, delay=0):
+        self.response = STUB_RESPONSE if response is None else response
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d/api/v2/abtest/online/results?project-key=K" % (
+            self._server.sockets[0].getsockname()[1]
+        )
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                self.requests.append(json.loads(await reader.readexactly(length)))
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                await asyncio.sleep(self.delay)
+                self.active -= 1
+                data = json.dumps(self.response).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(data) + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class _RecordTransport(AsyncTransport):
+    def __init__(self):
+        self.bodies = []
+
+    async def post(self, url, body, headers, timeout):
+        self.bodies.append(json.loads(body))
+        return 200, json.dumps(STUB_RESPONSE).encode("utf-8")
+
+
+class AsyncClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = AsyncStubABServer(delay=0.2)
+        await self.server.start()
+        self.consumer = RecordConsumer()
+        self.ab = AsyncSensorsABTest(
+            self.server.url, sensorsanalytics.SensorsAnalytics(self.consumer)
+        )
+
+    async def asyncTearDown(self):
+        await self.ab.close()
+        await self.server.stop()
+
+    async def test_concurrent_fetches_on_one_loop(self):
+        consumer = RecordConsumer()
+        ab = AsyncSensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            transport=StreamTransport(max_connections=50),
+        )
+        start = time.time()
+        results = await asyncio.gather(
+            *[
+                ab.async_fetch_ab_test("user%d" % i, True, "num_test", 0)
+                for i in range(300)
+            ]
+        )
+        elapsed = time.time() - start
+        await ab.close()
+        self.assertTrue(all(r.result == 111 for r in results))
+        self.assertEqual(len(self.server.requests), 300)
+        self.assertEqual(self.server.max_active, 50)
+        self.assertLess(elapsed, 300 / 50 * 0.2 * 2)
+        self.assertEqual(len(consumer.events), 300)
+
+    async def test_trigger_queue_flushed_on_close(self):
+        consumer = RecordConsumer()
+        ab = AsyncSensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(consumer),
+            trigger_queue_size=10,
+        )
+        result = await ab.async_fetch_ab_test("user1", True, "num_test", 0)
+        await ab.close()
+        self.assertEqual(result.result, 111)
+        self.assertEqual(len(consumer.events), 1)
+        self.assertEqual(ab.stats()["trigger_sent"], 1)
+
+    async def test_fast_fetch_uses_cache(self):
+        r1 = await self.ab.fast_fetch_ab_test("user1", False, "string_test", "unknown")
+        r2 = await self.ab.fast_fetch_ab_test("user1", False, "num_test", 0)
+        self.assertEqual(r1.result, "hello")
+        self.assertEqual(r2.result, 111)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]["anonymous_id"], "user1")
+        self.assertEqual(len(self.consumer.events), 1)
+
+    async def test_fast_fetch_not_enrolled_uses_cache(self):
+        await self.ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        result = await self.ab.fast_fetch_ab_test("user1", True, "missing_test", "default")
+        self.assertEqual(result.result, "default")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.ab.stats()["experiment_cache_negative_hit"], 1)
+
+    async def test_circuit_breaker(self):
+        ab = AsyncSensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            circuit_breaker_threshold=1,
+            circuit_breaker_recovery_time=60,
+        )
+        result = await ab.async_fetch_ab_test("user1", True, "num_test", 0, timeout_seconds=0.05)
+        self.assertEqual(result.result, 0)
+        start = time.time()
+        result = await ab.async_fetch_ab_test("user1", True, "num_test", 0)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(result.result, 0)
+        self.assertEqual(ab.stats()["circuit_state"], CircuitBreaker.OPEN)
+        await ab.close()
+
+    async def test_multiple_endpoints(self):
+        down = StubABServer(status=500)
+        ab = AsyncSensorsABTest(
+            [down.url, self.server.url], sensorsanalytics.SensorsAnalytics(RecordConsumer())
+        )
+        for _ in range(5):
+            await ab.async_fetch_ab_test("user1", True, "num_test", 0)
+        result = await ab.async_fetch_ab_test("user1", True, "num_test", 0)
+        await ab.close()
+        down.stop()
+        self.assertEqual(result.result, 111)
+        self.assertEqual(len(down.requests), 3)
+        self.assertFalse(ab.stats()["endpoints"][0]["healthy"])
+
+    async def test_concurrent_cache_miss_coalesced(self):
+        results = await asyncio.gather(
+            *[self.ab.fast_fetch_ab_test("user1", True, "num_test", 0) for _ in range(50)]
+        )
+        self.assertTrue(all(r.result == 111 for r in results))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.ab.stats()["singleflight_coalesced"], 49)
+
+    async def test_stale_while_revalidate(self):
+        ab = AsyncSensorsABTest(
+            self.server.url,
+            sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            experiment_cache_time=0,
+            experiment_stale_time=1,
+        )
+        await ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        start = time.time()
+        result = await ab.fast_fetch_ab_test("user1", True, "num_test", 0)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(result.result, 111)
+        await ab.close()
+        self.assertEqual(len(self.server.requests), 2)
+
+    async def test_fetch_ab_tests(self):
+        results = await self.ab.fetch_ab_tests(
+            "user1", True, {"bool_test": False, "json_test": {}}
+        )
+        self.assertIs(results["bool_test"].result, True)
+        self.assertEqual(results["json_test"].result, {"color": "red"})
+
+    async def test_timeout_returns_default(self):
+        result = await self.ab.async_fetch_ab_test(
+            "user1", True, "num_test", -1, timeout_seconds=0.05
+        )
+        self.assertEqual(result.result, -1)
+
+    async def test_custom_transport(self):
+        transport = _RecordTransport()
+        ab = AsyncSensorsABTest(
+            "http://stub", sensorsanalytics.SensorsAnalytics(RecordConsumer()),
+            transport=transport,
+        )
+        result = await ab.async_fetch_ab_test(
+            "user1", True, "num_test", 0, custom_ids={"custom_a": "1"}
+        )
+        self.assertEqual(result.result, 111)
+        self.assertEqual(transport.bodies[0]["login_id"], "user1")
+        self.assertEqual(transport.bodies[0]["custom_ids"], {"custom_a": "1"})
+        with self.assertRaises(SensorsABIllegalArgumentsException):
+            AsyncSensorsABTest("http://stub", ab._sa, transport=object())
 
 
 if __name__ == "__main__":
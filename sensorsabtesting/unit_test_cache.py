@@ -0,0 +1,420 @@
+# -*- coding: UTF-8 -*-
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from operator import itemgetter
+
+from sensorsabtesting.cache import TTLCache
+from sensorsabtesting.cache.bloom import RotatingBloomFilter
+from sensorsabtesting.cache.clock import CoarseClock
+from sensorsabtesting.cache.hashed import HashedTTLSet, key_hash
+from sensorsabtesting.cache.shared import SharedMemoryTTLCache
+from sensorsabtesting.cache.sharded import ShardedTTLCache
+
+
+class _ManualTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.timer = _ManualTimer()
+
+    def test_hit_promotes_to_most_recently_used(self):
+        cache = TTLCache(3, ttl=10, timer=self.timer)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["c"] = 3
+        self.assertEqual(cache["a"], 1)
+        cache["d"] = 4
+        self.assertNotIn("b", cache)
+        self.assertEqual(sorted(cache), ["a", "c", "d"])
+
+    def test_expire(self):
+        cache = TTLCache(8, ttl=10, timer=self.timer)
+        cache["a"] = 1
+        self.timer.now = 5
+        cache["b"] = 2
+        self.timer.now = 10
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache["b"], 2)
+        self.timer.now = 15
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_reset_refreshes_ttl(self):
+        cache = TTLCache(8, ttl=10, timer=self.timer)
+        cache["a"] = 1
+        self.timer.now = 8
+        cache["a"] = 2
+        self.timer.now = 12
+        self.assertEqual(cache["a"], 2)
+
+    def test_hit_does_not_copy_links(self):
+        cache = TTLCache(1000, ttl=10, timer=self.timer)
+        for i in range(1000):
+            cache[i] = i
+        links = cache._TTLCache__links
+        for i in range(1000):
+            self.assertEqual(cache[i], i)
+        self.assertIs(links, cache._TTLCache__links)
+        self.assertEqual(next(iter(links)), 0)
+
+
+def _check_ttl_cache(testcase, cache):
+    data = cache._Cache__data
+    links = cache._TTLCache__links
+    testcase.assertEqual(set(data), set(links))
+    testcase.assertLessEqual(len(data), cache.maxsize)
+    testcase.assertEqual(cache._Cache__currsize, len(data))
+    root = cache._TTLCache__root
+    curr, count = root.next, 0
+    while curr is not root:
+        testcase.assertIs(curr.next.prev, curr)
+        testcase.assertIs(links[curr.key], curr)
+        curr = curr.next
+        count += 1
+    testcase.assertEqual(count, len(links))
+
+
+class ShardedTTLCacheTest(unittest.TestCase):
+    def test_size_split_across_shards(self):
+        cache = ShardedTTLCache(10, ttl=10, shards=4)
+        self.assertEqual(sum(shard.maxsize for shard in cache.shards), 10)
+        self.assertEqual(len(ShardedTTLCache(3, ttl=10, shards=16).shards), 3)
+
+    def test_shardkey_groups_user_entries(self):
+        cache = ShardedTTLCache(64, ttl=10, shards=8, shardkey=itemgetter(0))
+        for i in range(8):
+            cache[("user", i)] = i
+        self.assertEqual(sorted(len(shard) for shard in cache.shards)[-1], 8)
+        self.assertEqual(cache.get(("user", 3)), 3)
+        self.assertIsNone(cache.get(("user", 9)))
+
+    def test_clear(self):
+        cache = ShardedTTLCache(64, ttl=10, shards=4)
+        for i in range(32):
+            cache[i] = i
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_concurrent_access(self):
+        cache = ShardedTTLCache(
+            512, ttl=0.005, timer=time.monotonic, shards=8, shardkey=itemgetter(0)
+        )
+        errors = []
+        start = threading.Event()
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            start.wait()
+            try:
+                for _ in range(3000):
+                    key = ("user_%d" % rnd.randrange(2000), rnd.random() < 0.5)
+                    op = rnd.random()
+                    if op < 0.5:
+                        cache[key] = key[0]
+                    elif op < 0.9:
+                        value = cache.get(key)
+                        if value is not None and value != key[0]:
+                            errors.append((key, value))
+                    elif op < 0.95:
+                        cache.pop(key)
+                    else:
+                        key in cache
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(64)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache), 512)
+        for shard in cache.shards:
+            _check_ttl_cache(self, shard)
+
+
+class HashedTTLSetTest(unittest.TestCase):
+    def test_key_hash(self):
+        self.assertEqual(key_hash("user1", True, "100", {}), key_hash("user1", True, "100", {}))
+        self.assertNotEqual(key_hash("user1", True, "100", {}), key_hash("user1", False, "100", {}))
+        self.assertLess(key_hash("user1"), 1 << 64)
+        # 各部分按长度分隔，部分内容中的分隔字符不会造成冲突
+        self.assertNotEqual(key_hash("a\x1fb"), key_hash("a", "b"))
+        self.assertNotEqual(key_hash("a", "b\x1fc"), key_hash("a\x1fb", "c"))
+        self.assertNotEqual(key_hash("ab", ""), key_hash("a", "b"))
+
+    def test_add_and_expire(self):
+        timer = _ManualTimer()
+        cache = HashedTTLSet(100, 10, timer=timer)
+        a, b = key_hash("a"), key_hash("b")
+        cache.add(a)
+        self.assertIn(a, cache)
+        self.assertNotIn(b, cache)
+        timer.now += 5
+        cache.add(b)
+        self.assertEqual(len(cache), 2)
+        timer.now += 6
+        self.assertNotIn(a, cache)
+        self.assertIn(b, cache)
+        cache.discard(b)
+        self.assertNotIn(b, cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_never_outlives_ttl(self):
+        timer = _ManualTimer()
+        cache = HashedTTLSet(100, 10, timer=timer)
+        timer.now += 0.5
+        cache.add(key_hash("a"))
+        timer.now += 9
+        self.assertIn(key_hash("a"), cache)
+        timer.now += 1
+        self.assertNotIn(key_hash("a"), cache)
+        cache = HashedTTLSet(100, 0, timer=timer)
+        cache.add(key_hash("a"))
+        self.assertNotIn(key_hash("a"), cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_bucket_replaces_earliest_expiry(self):
+        timer = _ManualTimer()
+        cache = HashedTTLSet(4, 100, timer=timer, bucket_size=4)
+        self.assertEqual(cache.maxsize, 4)
+        for i in range(1, 5):
+            cache.add(i)
+            timer.now += 1
+        cache.add(1)
+        cache.add(5)
+        self.assertEqual(sorted(key for key, _ in cache.dump()), [1, 3, 4, 5])
+
+    def test_capacity(self):
+        cache = HashedTTLSet(10000, 60)
+        keys = [key_hash("user_%d" % i) for i in range(10000)]
+        for key in keys:
+            cache.add(key)
+        self.assertGreater(sum(1 for key in keys if key in cache), 9000)
+        self.assertLessEqual(len(cache), cache.maxsize)
+
+    def test_dump_load(self):
+        timer = _ManualTimer()
+        cache = HashedTTLSet(100, 60, timer=timer)
+        cache.add(key_hash("a"))
+        timer.now += 20
+        items = cache.dump()
+        self.assertEqual(items, [(key_hash("a"), 40)])
+        restored = HashedTTLSet(100, 60, timer=timer)
+        restored.load(items + [(key_hash("b"), -1)])
+        self.assertIn(key_hash("a"), restored)
+        self.assertNotIn(key_hash("b"), restored)
+        timer.now += 41
+        self.assertNotIn(key_hash("a"), restored)
+
+
+class RotatingBloomFilterTest(unittest.TestCase):
+    def test_rotation(self):
+        timer = _ManualTimer()
+        bloom = RotatingBloomFilter(1000, 0.01, 100, timer=timer)
+        bloom.add(key_hash("a"))
+        self.assertIn(key_hash("a"), bloom)
+        timer.now = 150
+        bloom.add(key_hash("b"))
+        self.assertIn(key_hash("a"), bloom)
+        self.assertIn(key_hash("b"), bloom)
+        timer.now = 250
+        self.assertNotIn(key_hash("a"), bloom)
+        self.assertIn(key_hash("b"), bloom)
+        timer.now = 1000
+        self.assertNotIn(key_hash("b"), bloom)
+        self.assertEqual(bloom.fill_ratio(), 0)
+
+    def test_invalid_period(self):
+        for period in (0, -1):
+            with self.assertRaises(ValueError):
+                RotatingBloomFilter(1000, 0.01, period)
+
+    def test_accuracy_against_exact_cache(self):
+        timer = _ManualTimer()
+        capacity, error_rate = 20000, 0.01
+        bloom = RotatingBloomFilter(capacity, error_rate, 3600, timer=timer)
+        exact = HashedTTLSet(capacity * 2, 3600, timer=timer)
+        rnd = random.Random(7)
+        false_positives = false_negatives = firsts = 0
+        for i in range(capacity * 2):
+            # 一半为新曝光，一半为重复曝光
+            n = i // 2 if i % 2 == 0 else rnd.randrange(i // 2 + 1)
+            key = key_hash("user_%d" % n, True, "100", "{}")
+            seen, maybe_seen = key in exact, key in bloom
+            if not seen:
+                firsts += 1
+                false_positives += maybe_seen
+                exact.add(key)
+                bloom.add(key)
+            elif not maybe_seen:
+                false_negatives += 1
+        self.assertEqual(false_negatives, 0)
+        self.assertLess(false_positives / firsts, error_rate * 2)
+        self.assertTrue(0.3 < bloom.fill_ratio() < 0.7)
+        self.assertTrue(error_rate / 4 < bloom.error_rate() < error_rate * 2)
+
+
+class CoarseClockTest(unittest.TestCase):
+    def test_follows_monotonic(self):
+        clock = CoarseClock(0.01)
+        self.addCleanup(clock.stop)
+        first = clock.timer()
+        self.assertLessEqual(first, time.monotonic())
+        time.sleep(0.1)
+        second = clock.timer()
+        self.assertGreater(second, first + 0.05)
+        self.assertLessEqual(time.monotonic() - clock(), 0.1)
+
+    def test_ttl_cache_with_coarse_clock(self):
+        clock = CoarseClock(0.01)
+        self.addCleanup(clock.stop)
+        cache = ShardedTTLCache(16, ttl=0.05, timer=clock.timer)
+        cache["a"] = 1
+        self.assertEqual(cache["a"], 1)
+        time.sleep(0.15)
+        self.assertNotIn("a", cache)
+
+
+def _shared_cache_worker(path, worker, count):
+    cache = SharedMemoryTTLCache(path, 1024, 60, slot_size=256, stripes=16)
+    try:
+        for i in range(count):
+            key = ("user_%d_%d" % (worker, i), True)
+            cache[key] = {"worker": worker, "i": i, "pad": "x" * (i % 50)}
+            value = cache.get(key)
+            if value is not None and value["i"] != i:
+                raise AssertionError((key, value))
+            cache.get(("user_%d_%d" % ((worker + 1) % 4, i), True))
+    finally:
+        cache.close()
+
+
+class SharedMemoryTTLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_basic(self):
+        cache = SharedMemoryTTLCache(self.path, 64, 60, slot_size=128, stripes=4)
+        self.addCleanup(cache.close)
+        cache[("a", True)] = {"v": 1}
+        cache[("b", False)] = [1, "x"]
+        self.assertEqual(cache[("a", True)], {"v": 1})
+        self.assertEqual(cache.get(("b", False)), [1, "x"])
+        self.assertIn(("a", True), cache)
+        self.assertEqual(len(cache), 2)
+        cache[("a", True)] = {"v": 2}
+        self.assertEqual(cache[("a", True)], {"v": 2})
+        self.assertEqual(len(cache), 2)
+        del cache[("b", False)]
+        self.assertNotIn(("b", False), cache)
+        with self.assertRaises(KeyError):
+            cache[("b", False)]
+        cache[("big", True)] = "x" * 1000
+        self.assertEqual(cache.skipped, 1)
+        self.assertIsNone(cache.get(("big", True)))
+
+    def test_visible_across_instances(self):
+        writer = SharedMemoryTTLCache(self.path, 64, 60, slot_size=128, stripes=4)
+        self.addCleanup(writer.close)
+        reader = SharedMemoryTTLCache(self.path, 64, 60, slot_size=128, stripes=4)
+        self.addCleanup(reader.close)
+        writer[("a", True)] = 1
+        self.assertEqual(reader[("a", True)], 1)
+        reader.clear()
+        self.assertNotIn(("a", True), writer)
+        with self.assertRaises(ValueError):
+            SharedMemoryTTLCache(self.path, 64, 60, slot_size=256, stripes=4)
+
+    def test_decoded_once_per_write(self):
+        decoded = []
+
+        def decoder(value):
+            decoded.append(value)
+            return tuple(value)
+
+        writer = SharedMemoryTTLCache(self.path, 64, 60, slot_size=128, stripes=4)
+        self.addCleanup(writer.close)
+        reader = SharedMemoryTTLCache(
+            self.path, 64, 60, slot_size=128, stripes=4, decoder=decoder
+        )
+        self.addCleanup(reader.close)
+        writer[("a", True)] = [1, "x"]
+        first = reader[("a", True)]
+        self.assertEqual(first, (1, "x"))
+        self.assertIs(reader[("a", True)], first)
+        self.assertEqual(len(decoded), 1)
+        # 其他进程改写条目后重新解码
+        writer[("a", True)] = [2, "y"]
+        self.assertEqual(reader[("a", True)], (2, "y"))
+        self.assertEqual(len(decoded), 2)
+        del writer[("a", True)]
+        self.assertIsNone(reader.get(("a", True)))
+
+    def test_expire_and_evict(self):
+        cache = SharedMemoryTTLCache(self.path, 8, 0.05, slot_size=128, stripes=1)
+        self.addCleanup(cache.close)
+        for i in range(20):
+            cache[("k", i)] = i
+        self.assertEqual(len(cache), 8)
+        self.assertEqual(cache[("k", 19)], 19)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(("k", 19)))
+        self.assertEqual(len(cache), 0)
+
+    def test_dump_load(self):
+        cache = SharedMemoryTTLCache(self.path, 64, 60, slot_size=128, stripes=4)
+        self.addCleanup(cache.close)
+        cache[("a", True, "{}")] = ["v", 1]
+        items = cache.dump()
+        self.assertEqual(len(items), 1)
+        key, value, seconds = items[0]
+        self.assertEqual(key, ("a", True, "{}"))
+        self.assertEqual(value, ["v", 1])
+        self.assertTrue(59 < seconds <= 60)
+        cache.clear()
+        cache.load(items)
+        self.assertEqual(cache[("a", True, "{}")], ["v", 1])
+
+    def test_processes(self):
+        SharedMemoryTTLCache(self.path, 1024, 60, slot_size=256, stripes=16).close()
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_shared_cache_worker, args=(self.path, i, 300))
+            for i in range(4)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join(60)
+        self.assertEqual([p.exitcode for p in processes], [0] * 4)
+        cache = SharedMemoryTTLCache(self.path, 1024, 60, slot_size=256, stripes=16)
+        self.addCleanup(cache.close)
+        items = cache.dump()
+        self.assertLessEqual(len(items), cache.maxsize)
+        self.assertEqual(len(items), len(set(key for key, _, _ in items)))
+        for key, value, _ in items:
+            worker, i = map(int, key[0].split("_")[1:])
+            self.assertEqual(value, {"worker": worker, "i": i, "pad": "x" * (i % 50)})
+        self.assertGreater(len(items), cache.maxsize // 2)
+
+
+if __name__ == "__main__":
+    unittest.main()